@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+Business Data Builder Benchmark
+Builds workbooks from synthetic configs of increasing size and reports time per tab,
+peak memory, cell count and output size, optionally checked against a stored baseline
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+import multiprocessing
+import subprocess
+import argparse
+import signal
+import platform
+import resource
+import socket
+import time
+import json
+import sys
+import urllib.request
+import io
+import os
+
+import server
+
+# The questionnaire's team and non-staff options (TEAM_OPTIONS / NON_STAFF_CATEGORIES in index.html)
+TEAMS = [
+    'Executive / Management', 'Operations', 'Engineering / Technical', 'Product Management',
+    'Sales', 'Marketing', 'Customer Support', 'Customer Success / Account Management',
+    'Finance & Accounting', 'Human Resources', 'IT / Information Systems',
+    'Supply Chain / Procurement', 'Manufacturing / Production', 'Logistics / Distribution',
+    'Quality Assurance', 'Legal / Compliance', 'Data & Analytics', 'Project Management',
+]
+
+NON_STAFF_CATEGORIES = {
+    '🏢 Facilities & Premises': 9,
+    '💻 Technology & IT': 7,
+    '📦 Equipment & Supplies': 5,
+    '🚚 Operations & Delivery Costs': 6,
+    '📣 Sales & Marketing': 9,
+    '🧾 Professional & External Services': 7,
+    '🚗 Travel & Transport': 7,
+    '🛡️ Insurance': 5,
+    '🏦 Financial & Administrative': 6,
+    '🎓 Training & Development': 5,
+}
+
+# One sales item per model, with the questionnaire's field names for that model
+SALES_ITEM_FIELDS = {
+    'product': {'productName': 'Product', 'startingUnits': '120', 'unitPrice': '24.99',
+                'costPerUnit': '9.5', 'monthlyGrowth': '4'},
+    'service': {'serviceName': 'Service', 'startingHours': '80', 'hourlyRate': '65',
+                'deliveryCost': '20', 'monthlyGrowth': '3'},
+    'saas': {'planName': 'Plan', 'startingSubscribers': '400', 'monthlyPrice': '29',
+             'churnRate': '3.5', 'growthRate': '8', 'costPerSubscriber': '4'},
+    'marketplace': {'transactionType': 'Bookings', 'startingGMV': '50000', 'commissionRate': '12',
+                    'processingFee': '2.5', 'monthlyGrowth': '6'},
+    'manufacturing': {'productLine': 'Line', 'startingUnits': '1000', 'pricePerUnit': '12',
+                      'materialCost': '3', 'laborCost': '2', 'overheadCost': '1', 'monthlyGrowth': '2'},
+    'usage': {'usageMetric': 'API Calls', 'startingVolume': '1000000', 'pricePerUnit': '0.002',
+              'costPerUnit': '0.0005', 'monthlyGrowth': '10'},
+    'hybrid': {'streamName': 'Stream', 'streamType': 'Subscription', 'startingVolume': '300',
+               'price': '15', 'cost': '5', 'monthlyGrowth': '5'},
+}
+
+# Case sizes per tier; each tier also runs the sizes of the tiers before it
+STAFF_SIZES = {'quick': [10, 100], 'standard': [1000], 'full': [5000]}
+SALES_SIZES = {'quick': [1, 10], 'standard': [100], 'full': [1000]}
+NON_STAFF_QUANTITIES = {'quick': [1], 'standard': [10], 'full': [50]}
+TIERS = ['quick', 'standard', 'full']
+
+# Writers measured by --calibrate: COST_PROFILES name -> (engine, formulas, values, format)
+CALIBRATION_PROFILES = {
+    'openpyxl': ('openpyxl', 'plain', 'none', 'xlsx'),
+    'streaming': ('streaming', 'plain', 'none', 'xlsx'),
+    'streaming-shared': ('streaming', 'shared', 'none', 'xlsx'),
+    'streaming-cached': ('streaming', 'plain', 'cached', 'xlsx'),
+    'csv': (None, 'plain', 'none', 'csv'),
+    'ods': (None, 'plain', 'none', 'ods'),
+}
+# Simulations measured by --calibrate: paths, product items and weekly periods
+CALIBRATION_SIMULATIONS = ((10000, 100, 52), (10000, 1, 1300), (2500, 300, 1300))
+
+# Timing differences below this many seconds are treated as noise
+MIN_TIME_DELTA = 0.05
+
+# Cold starts measured per run (the fastest counts) and how long to wait for the port
+STARTUP_RUNS = 3
+STARTUP_TIMEOUT = 30
+
+# Throughput runs (--throughput): workbooks requested per run, kept two in flight per process
+THROUGHPUT_REQUESTS = 60
+THROUGHPUT_EMPLOYEES = 100
+
+
+def staff_config(employees):
+    """Every team selected, employees spread across them, with an extra category"""
+    counts = {team: employees // len(TEAMS) for team in TEAMS}
+    for team in TEAMS[:employees % len(TEAMS)]:
+        counts[team] += 1
+    return {
+        'selectedTeams': TEAMS,
+        'employeeCounts': counts,
+        'extraCategory': {'name': 'Region', 'options': ['North', 'South', 'East', 'West']},
+        'nonStaffItems': {},
+        'nonStaffQuantities': {},
+        'salesModel': 'product',
+        'salesItems': [SALES_ITEM_FIELDS['product']],
+    }
+
+
+def sales_config(model, items):
+    """items sales items for one sales model, each with its own name and growth"""
+    sales_items = []
+    for idx in range(items):
+        item = dict(SALES_ITEM_FIELDS[model])
+        for name_field in ('productName', 'serviceName', 'planName', 'transactionType',
+                           'productLine', 'usageMetric', 'streamName'):
+            if name_field in item:
+                item[name_field] = f'{item[name_field]} {idx + 1}'
+        sales_items.append(item)
+    return {
+        'selectedTeams': TEAMS[:1],
+        'employeeCounts': {TEAMS[0]: 1},
+        'extraCategory': None,
+        'nonStaffItems': {},
+        'nonStaffQuantities': {},
+        'salesModel': model,
+        'salesItems': sales_items,
+    }
+
+
+def non_staff_config(quantity):
+    """Every non-staff item selected at the given quantity"""
+    items = {}
+    quantities = {}
+    for category, count in NON_STAFF_CATEGORIES.items():
+        for idx in range(count):
+            key = f'{category}|Item {idx + 1}'
+            items[key] = True
+            quantities[key] = quantity
+    return {
+        'selectedTeams': TEAMS[:1],
+        'employeeCounts': {TEAMS[0]: 1},
+        'extraCategory': None,
+        'nonStaffItems': items,
+        'nonStaffQuantities': quantities,
+        'salesModel': 'product',
+        'salesItems': [SALES_ITEM_FIELDS['product']],
+    }
+
+
+def benchmark_cases(tier):
+    """(name, config) pairs for every size up to and including tier"""
+    tiers = TIERS[:TIERS.index(tier) + 1]
+    cases = []
+    for size_tier in tiers:
+        for employees in STAFF_SIZES[size_tier]:
+            cases.append((f'staff-{employees}', staff_config(employees)))
+        for items in SALES_SIZES[size_tier]:
+            for model in SALES_ITEM_FIELDS:
+                cases.append((f'sales-{model}-{items}', sales_config(model, items)))
+        for quantity in NON_STAFF_QUANTITIES[size_tier]:
+            cases.append((f'non-staff-x{quantity}', non_staff_config(quantity)))
+    return cases
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(config, engine, formulas, values, output_format='xlsx'):
+    """Build one workbook and measure it; runs in a fresh process so peak memory is per case"""
+    options = server.OutputOptions(engine, formulas, values, output_format)
+    # openpyxl is imported on first use; keep that out of the build timings (see measure_startup)
+    server.load_openpyxl()
+    baseline_rss = _peak_rss_bytes()
+
+    cells = 0
+    for plan in server.workbook_plans(config, options.shared_formulas, options.cached_values):
+        for row in plan.rows:
+            cells += sum(1 for cell in row if cell is not None)
+
+    timings = {}
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    server.build_workbook(config, buffer, options, timings)
+    total = time.perf_counter() - started
+
+    return {
+        'tabs': {phase: round(timings[phase], 4) for phase in ('sales', 'staff', 'non_staff')},
+        'save': round(timings['save'], 4),
+        'total': round(total, 4),
+        'peak_rss': _peak_rss_bytes(),
+        'rss_growth': _peak_rss_bytes() - baseline_rss,
+        'cells': cells,
+        'output_bytes': len(buffer.getvalue()),
+    }
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _server_script():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+
+def _wait_for_health(process, port, started):
+    while True:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1) as response:
+                response.read()
+            return
+        except OSError:
+            if process.poll() is not None or time.perf_counter() - started > STARTUP_TIMEOUT:
+                raise RuntimeError('server.py did not start')
+            time.sleep(0.005)
+
+
+def measure_startup(runs=STARTUP_RUNS):
+    """Seconds from launching server.py to its first /health response, fastest of runs"""
+    env = dict(os.environ, GENERATION_WORKERS='0', PRELOAD_OPENPYXL='1', WARM_WORKERS='0')
+    fastest = None
+    for _ in range(runs):
+        port = _free_port()
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, _server_script(), str(port)], env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_health(process, port, started)
+            elapsed = time.perf_counter() - started
+        finally:
+            process.kill()
+            process.wait()
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return {'first_health': round(fastest, 4)}
+
+
+def measure_throughput(processes, requests=THROUGHPUT_REQUESTS):
+    """Workbooks per second served by server.py with SERVER_PROCESSES=processes over HTTP.
+    
+    Every process builds in its request threads (GENERATION_WORKERS=0), so one process
+    uses one core and the figure shows how serving scales with processes.
+    """
+    in_flight = 2 * processes
+    # Connections are not spread evenly between the processes, and a slot is freed just after
+    # its response is sent, so each process gets room for twice the requests in flight
+    env = dict(os.environ, SERVER_PROCESSES=str(processes), GENERATION_WORKERS='0',
+               GENERATION_QUEUE_DEPTH=str(2 * in_flight), WORKBOOK_CACHE_BYTES='0', RATE_LIMIT_PER_MINUTE='0')
+    body = json.dumps(staff_config(THROUGHPUT_EMPLOYEES)).encode()
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, _server_script(), str(port)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def generate(_):
+        request = urllib.request.Request(f'http://127.0.0.1:{port}/generate-excel', body,
+                                         {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=STARTUP_TIMEOUT) as response:
+            response.read()
+
+    try:
+        _wait_for_health(process, port, time.perf_counter())
+        with ThreadPoolExecutor(in_flight) as executor:
+            # One round first, so every process has imported openpyxl
+            list(executor.map(generate, range(in_flight)))
+            started = time.perf_counter()
+            list(executor.map(generate, range(requests)))
+            elapsed = time.perf_counter() - started
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+    return {'processes': processes, 'requests': requests, 'workbooks_per_second': round(requests / elapsed, 2)}
+
+
+def _fit_line(points):
+    """Least-squares (slope, intercept) through (x, y) points"""
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / spread if spread else 0
+    return slope, mean_y - slope * mean_x
+
+
+def _fit_rates(points):
+    """Least-squares (a, b) for y = a * x1 + b * x2 through (x1, x2, y) points"""
+    s11 = sum(x1 * x1 for x1, _, _ in points)
+    s12 = sum(x1 * x2 for x1, x2, _ in points)
+    s22 = sum(x2 * x2 for _, x2, _ in points)
+    s1y = sum(x1 * y for x1, _, y in points)
+    s2y = sum(x2 * y for _, x2, y in points)
+    determinant = s11 * s22 - s12 * s12
+    return (s1y * s22 - s2y * s12) / determinant, (s2y * s11 - s1y * s12) / determinant
+
+
+def calibrate(cases):
+    """server.COST_PROFILES rates fitted to builds of cases with every writer, and the simulation's
+    (SIMULATION_STEP_SECONDS, SIMULATION_VALUE_SECONDS)
+    """
+    profiles = {}
+    for profile, (engine, formulas, values, output_format) in CALIBRATION_PROFILES.items():
+        measured = []
+        for name, config in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_case, config, engine, formulas, values, output_format).result()
+            measured.append((server.compile_config(config).size.cells, result))
+        seconds = _fit_line([(cells, result['total']) for cells, result in measured])
+        output = _fit_line([(cells, result['output_bytes']) for cells, result in measured])
+        memory = _fit_line([(cells, result['rss_growth']) for cells, result in measured])
+        # A negative intercept is noise from the small cases, not a saving
+        profiles[profile] = (seconds[0], max(seconds[1], 0), output[0], max(output[1], 0), max(memory[0], 0))
+        print(f'{profile:<18} {seconds[0] * 1e6:>8.2f} us/cell {output[0]:>8.2f} B/cell {memory[0]:>8.1f} B/cell peak')
+
+    measured = []
+    for paths, items, periods in CALIBRATION_SIMULATIONS:
+        config = sales_config('product', items)
+        config.update({'granularity': 'weekly', 'forecastPeriods': periods, 'simulation': {'paths': paths}})
+        model = server.compile_config(config)
+        started = time.perf_counter()
+        server.simulate_sales(model)
+        measured.append((model.size.simulation_steps, model.size.simulation_values, time.perf_counter() - started))
+    simulation_rates = _fit_rates(measured)
+    print(f"{'simulation':<18} {simulation_rates[0] * 1e9:>8.2f} ns/step {simulation_rates[1] * 1e9:>8.1f} ns/value")
+    return profiles, simulation_rates
+
+
+def compare(results, baseline, threshold, startup=None):
+    """Regressions in results against a baseline file's results, as printable lines"""
+    previous = {(entry['case'], entry['engine'], entry['formulas'], entry['values']): entry
+                for entry in baseline.get('results', [])}
+    regressions = []
+    for entry in results:
+        before = previous.get((entry['case'], entry['engine'], entry['formulas'], entry['values']))
+        if before is None:
+            continue
+        checks = [('total', MIN_TIME_DELTA), ('peak_rss', 0), ('output_bytes', 0)]
+        for metric, min_delta in checks:
+            old, new = before[metric], entry[metric]
+            if new > old * (1 + threshold) and new - old > min_delta:
+                growth = f' (+{(new - old) / old:.0%})' if old else ''
+                regressions.append(f"{entry['case']} [{entry['engine']}]: {metric} {old} -> {new}{growth}")
+    before = baseline.get('startup')
+    if startup and before:
+        old, new = before['first_health'], startup['first_health']
+        if new > old * (1 + threshold) and new - old > MIN_TIME_DELTA:
+            regressions.append(f'startup: first_health {old} -> {new} (+{(new - old) / old:.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark workbook generation on synthetic configs')
+    parser.add_argument('--tier', choices=TIERS, default='standard',
+                        help='largest case sizes to run (default: standard)')
+    parser.add_argument('--engine', choices=sorted(server.WORKBOOK_ENGINES), action='append',
+                        help='engine to benchmark, may be repeated (default: all)')
+    parser.add_argument('--formulas', choices=server.OutputOptions.FORMULA_MODES, default='plain')
+    parser.add_argument('--values', choices=server.OutputOptions.VALUE_MODES, default='none')
+    parser.add_argument('--format', choices=sorted(server.OUTPUT_FORMATS), default='xlsx',
+                        help='output format; csv and ods have their own writer, so --engine is ignored')
+    parser.add_argument('--case', action='append', help='only run cases whose name starts with this')
+    parser.add_argument('--skip-startup', action='store_true',
+                        help='do not measure the time from launching server.py to its first /health response')
+    parser.add_argument('--calibrate', action='store_true',
+                        help="fit the cost estimator's rates to the cases with every writer and print "
+                             "COST_PROFILES for server.py")
+    parser.add_argument('--throughput', metavar='PROCESSES',
+                        help='comma-separated SERVER_PROCESSES values (e.g. 1,2,4) to measure workbooks per '
+                             'second over HTTP with, instead of running the cases')
+    parser.add_argument('--output', default='benchmark-results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed growth over the baseline before flagging (default: 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    engines = args.engine or sorted(server.WORKBOOK_ENGINES)
+    if args.format != 'xlsx':
+        engines = [args.format]
+    cases = benchmark_cases(args.tier)
+    if args.case:
+        cases = [(name, config) for name, config in cases if name.startswith(tuple(args.case))]
+
+    if args.throughput:
+        print(f"{'processes':>9} {'workbooks/s':>12} {'speedup':>8}")
+        runs = []
+        for processes in [int(value) for value in args.throughput.split(',')]:
+            run = measure_throughput(processes)
+            runs.append(run)
+            speedup = run['workbooks_per_second'] / runs[0]['workbooks_per_second']
+            print(f"{processes:>9} {run['workbooks_per_second']:>12.2f} {speedup:>7.2f}x")
+        print(f'({os.cpu_count()} CPUs)')
+        return
+
+    if args.calibrate:
+        profiles, simulation_rates = calibrate(cases)
+        print('\nCOST_PROFILES = {')
+        for profile, rates in profiles.items():
+            print(f"    '{profile}': ({', '.join(f'{rate:.3g}' for rate in rates)}),")
+        print('}')
+        print(f'SIMULATION_STEP_SECONDS = {simulation_rates[0]:.3g}')
+        print(f'SIMULATION_VALUE_SECONDS = {simulation_rates[1]:.3g}')
+        return
+
+    print(f"{'case':<28} {'engine':<10} {'Sales':>8} {'Staff':>8} {'Non-Staff':>10} {'save':>8} "
+          f"{'total':>8} {'peak MB':>8} {'cells':>10} {'size KB':>9}")
+    results = []
+    for name, config in cases:
+        for engine in engines:
+            if args.values == 'cached' and engine == 'openpyxl':
+                continue
+            # A fresh process per case keeps peak memory from leaking between cases
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                measured = executor.submit(run_case, config, engine, args.formulas, args.values, args.format).result()
+            options = server.OutputOptions(engine, args.formulas, args.values, args.format)
+            entry = {'case': name, 'format': args.format, 'engine': options.engine, 'formulas': options.formulas,
+                     'values': options.values}
+            entry.update(measured)
+            results.append(entry)
+            tabs = measured['tabs']
+            print(f"{name:<28} {engine:<10} {tabs['sales']:>8.3f} {tabs['staff']:>8.3f} "
+                  f"{tabs['non_staff']:>10.3f} {measured['save']:>8.3f} {measured['total']:>8.3f} "
+                  f"{measured['peak_rss'] / 2 ** 20:>8.1f} {measured['cells']:>10} "
+                  f"{measured['output_bytes'] / 1024:>9.1f}")
+
+    startup = None
+    if not args.skip_startup:
+        startup = measure_startup()
+        print(f"\nCold start to first /health: {startup['first_health']:.3f}s")
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'tier': args.tier,
+        'results': results,
+        'startup': startup,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nResults written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, startup)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) against {args.baseline}:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,1228 @@ Business Data Builder Server
 Serves the HTML application and generates Excel files with proper formatting
 """
 
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import time
+_MODULE_STARTED = time.perf_counter()  # Start of the startup timings, see record_startup
+
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+from multiprocessing.managers import BaseManager
+import threading
+import signal
+import socket
+import queue
+import tempfile
+import shutil
 import json
 import sys
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.worksheet.datavalidation import DataValidation
-from datetime import datetime, timedelta
+import io
+import hashlib
+import itertools
+import functools
+import contextlib
+import math
+import gzip
+import email.utils
+import csv
+from copy import copy
+from collections import OrderedDict
+import re
+import zipfile
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from datetime import datetime, timedelta, timezone
 import subprocess
+import importlib.util
+import types
 import os
 
+try:
+    import brotli  # Optional: adds br variants of the static pages
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl  # Unix only: locks FileJobStore records against other processes
+except ImportError:
+    fcntl = None
+
+# Optional: computes the cached formula values (values=cached). Imported on first use,
+# like openpyxl (see load_openpyxl), so the server binds its port without waiting for it
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# Worker processes used to build workbooks (0 = build in the request thread)
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', os.cpu_count() or 1))
+# Builds allowed to wait for a free worker before new requests get a 503
+GENERATION_QUEUE_DEPTH = int(os.environ.get('GENERATION_QUEUE_DEPTH', 8))
+# Prefork mode: serving processes sharing one listening socket (1 serves from this
+# process alone). Each one is replaced after this many requests or above this
+# resident memory (0 = never), and gets this long to finish its requests when stopped
+SERVER_PROCESSES = int(os.environ.get('SERVER_PROCESSES', 1))
+MAX_REQUESTS_PER_PROCESS = int(os.environ.get('MAX_REQUESTS_PER_PROCESS', 0))
+MAX_PROCESS_RSS = int(os.environ.get('MAX_PROCESS_RSS', 0))
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get('SHUTDOWN_GRACE_SECONDS', 30))
+# Workbooks one batch request may ask for, and how many of them build at once
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 100))
+BATCH_PARALLELISM = int(os.environ.get('BATCH_PARALLELISM', GENERATION_WORKERS or 1))
+# Largest POST body accepted; larger requests get a 413 without their body being read
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', 2 * 1024 * 1024))
+# Per-client token bucket for POST requests: sustained requests per minute and burst
+# size (0 per minute disables it), and how many clients are tracked at once
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', 60))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))
+RATE_LIMIT_CLIENTS = int(os.environ.get('RATE_LIMIT_CLIENTS', 10000))
+# A separate, larger bucket for the preview routes (PREVIEW_ROUTES), which the UI calls as the user types
+PREVIEW_RATE_LIMIT_PER_MINUTE = int(os.environ.get('PREVIEW_RATE_LIMIT_PER_MINUTE', 600))
+PREVIEW_RATE_LIMIT_BURST = int(os.environ.get('PREVIEW_RATE_LIMIT_BURST', 60))
+# Behind a reverse proxy: rate limit by the address the proxy appends to X-Forwarded-For
+TRUST_FORWARDED_FOR = os.environ.get('TRUST_FORWARDED_FOR', '0') == '1'
+# Default workbook output engine ('openpyxl' or 'streaming')
+WORKBOOK_ENGINE = os.environ.get('WORKBOOK_ENGINE', 'openpyxl')
+# Default formula mode: 'plain' writes every formula, 'shared' writes one master
+# formula per repeated block as a SpreadsheetML shared formula
+FORMULA_MODE = os.environ.get('FORMULA_MODE', 'plain')
+# Default for cached formula results: 'none' leaves them for Excel to calculate,
+# 'cached' writes precomputed values next to the formulas (needs numpy)
+FORMULA_VALUES = os.environ.get('FORMULA_VALUES', 'none')
+# Default download format: 'xlsx', 'csv' (a ZIP of one CSV per tab) or 'ods'.
+# csv and ods carry computed values and are always written row by row (needs numpy)
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'xlsx')
+# Workbooks larger than this are spooled to a temp file instead of kept in memory
+SPOOL_MAX_MEMORY = int(os.environ.get('SPOOL_MAX_MEMORY', 8 * 1024 * 1024))
+# Size of each write when sending a workbook to the client
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# Memory budget for cached workbooks (0 disables the cache)
+WORKBOOK_CACHE_BYTES = int(os.environ.get('WORKBOOK_CACHE_BYTES', 64 * 1024 * 1024))
+# Optional directory for a second, on-disk cache tier and its budget
+WORKBOOK_CACHE_DIR = os.environ.get('WORKBOOK_CACHE_DIR', '')
+WORKBOOK_CACHE_DISK_BYTES = int(os.environ.get('WORKBOOK_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+
+# Background job API (/jobs): builder threads, jobs allowed to wait, how long finished
+# results are kept, and an optional directory to keep jobs in instead of memory
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', GENERATION_WORKERS or 1))
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', 32))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))
+JOB_STORE_DIR = os.environ.get('JOB_STORE_DIR', '')
+
+# What-if models kept in memory for POST /what-if, least recently used dropped first
+WHATIF_MODELS = int(os.environ.get('WHATIF_MODELS', 64))
+
+# Opt-in profiling: when set, /generate-excel requests sending "X-Profile: 1" are run under
+# cProfile and tracemalloc and the capture is saved here (listed at /profiles)
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+PROFILE_MAX_CAPTURES = int(os.environ.get('PROFILE_MAX_CAPTURES', 50))
+
+# Cold start: the port is bound before openpyxl is imported. PRELOAD_OPENPYXL imports it in
+# the background right after; WARM_WORKERS also starts every worker with a throwaway build
+PRELOAD_OPENPYXL = os.environ.get('PRELOAD_OPENPYXL', '1') == '1'
+WARM_WORKERS = os.environ.get('WARM_WORKERS', '0') == '1'
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+ODS_CONTENT_TYPE = 'application/vnd.oasis.opendocument.spreadsheet'
+
+# Download formats: format -> (file extension, content type)
+OUTPUT_FORMATS = {
+    'xlsx': ('xlsx', XLSX_CONTENT_TYPE),
+    'csv': ('zip', 'application/zip'),
+    'ods': ('ods', ODS_CONTENT_TYPE),
+}
+
+# Static pages served from memory: path -> (file name, content type, Cache-Control)
+STATIC_ROUTES = {
+    '/': ('index.html', 'text/html', 'no-cache'),
+    '/index.html': ('index.html', 'text/html', 'no-cache'),
+    '/diagnostic': ('diagnostic.html', 'text/html', 'no-cache'),
+    '/diagnostic.html': ('diagnostic.html', 'text/html', 'no-cache'),
+    '/test': ('test.html', 'text/html', 'no-cache'),
+    '/test.html': ('test.html', 'text/html', 'no-cache'),
+    '/sherloc_logo.jpg': ('sherloc_logo.jpg', 'image/jpeg', 'public, max-age=86400'),
+}
+COMPRESSIBLE_TYPES = ('text/html',)
+
+
+class OutputOptions:
+    """Per-request output settings: download format, workbook engine, formula mode and cached values"""
+    
+    FORMULA_MODES = ('plain', 'shared')
+    VALUE_MODES = ('none', 'cached')
+    
+    def __init__(self, engine=None, formulas=FORMULA_MODE, values=FORMULA_VALUES, output_format=OUTPUT_FORMAT):
+        if output_format != 'xlsx':
+            # CSV and ODS have their own writer and always carry the computed values
+            engine, formulas, values = output_format, 'plain', 'cached'
+        # openpyxl cannot write cached formula results, so cached values default to streaming
+        if engine is None:
+            engine = 'streaming' if values == 'cached' else WORKBOOK_ENGINE
+        self.output_format = output_format
+        self.engine = engine
+        self.formulas = formulas
+        self.values = values
+    
+    @classmethod
+    def from_query(cls, query):
+        """Options from a query string such as engine=streaming&formulas=shared&values=cached or format=csv"""
+        params = parse_qs(query)
+        output_format = params.get('format', [OUTPUT_FORMAT])[0]
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown format: {output_format}')
+        options = cls(params.get('engine', [None])[0],
+                      params.get('formulas', [FORMULA_MODE])[0],
+                      params.get('values', [FORMULA_VALUES])[0],
+                      output_format)
+        if options.output_format == 'xlsx' and options.engine not in WORKBOOK_ENGINES:
+            raise ValueError(f'Unknown engine: {options.engine}')
+        if options.formulas not in cls.FORMULA_MODES:
+            raise ValueError(f'Unknown formula mode: {options.formulas}')
+        if options.values not in cls.VALUE_MODES:
+            raise ValueError(f'Unknown values mode: {options.values}')
+        if options.cached_values:
+            if options.engine == 'openpyxl':
+                raise ValueError('Cached values are only written by the streaming engine')
+            if not HAS_NUMPY:
+                raise ValueError(f'{"Cached values" if output_format == "xlsx" else output_format} '
+                                 'needs numpy to be installed')
+        return options
+    
+    @property
+    def streamed(self):
+        """Whether the file is written row by row, so it can go to the client while it is built"""
+        return self.engine != 'openpyxl'
+    
+    @property
+    def shared_formulas(self):
+        return self.formulas == 'shared'
+    
+    @property
+    def cached_values(self):
+        return self.values == 'cached'
+    
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self.output_format][0]
+    
+    @property
+    def content_type(self):
+        return OUTPUT_FORMATS[self.output_format][1]
+    
+    def cache_token(self):
+        """Identifies these options in workbook cache keys"""
+        return f'{self.output_format}|{self.engine}|{self.formulas}|{self.values}'
+
+
+class Metrics:
+    """In-process counters, gauges and histograms, rendered in the Prometheus text format"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = OrderedDict()  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> number, or [bucket counts, sum, count] for histograms
+    
+    def declare(self, name, kind, help_text, buckets=None):
+        self._families[name] = (kind, help_text, tuple(buckets or ()))
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+    
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+    
+    def observe(self, name, value, **labels):
+        buckets = self._families[name][2]
+        key = self._key(name, labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for idx, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][idx] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+    
+    def snapshot(self):
+        """A copy of every series' value, e.g. to publish to the prefork supervisor"""
+        with self._lock:
+            return {key: [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+                    for key, value in self._values.items()}
+    
+    def render(self, snapshots=None):
+        """The Prometheus text of this process's series, or of snapshots ({process: snapshot})
+        with a process label on every series
+        """
+        if snapshots is None:
+            values = self.snapshot().items()
+        else:
+            values = [((name, tuple(sorted(labels + (('process', str(process)),)))), value)
+                      for process, snapshot in snapshots.items() for (name, labels), value in snapshot.items()]
+        values = sorted(values, key=lambda item: item[0])
+        lines = []
+        for name, (kind, help_text, buckets) in self._families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (series_name, labels), value in values:
+                if series_name != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append(f'{name}{_prometheus_labels(labels)} {value}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_prometheus_labels(labels + (("le", repr(float(bound))),))} {cumulative}')
+                lines.append(f'{name}_bucket{_prometheus_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_prometheus_labels(labels)} {total}')
+                lines.append(f'{name}_count{_prometheus_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(16 * 1024 * 4 ** n for n in range(7))  # 16KB .. 64MB
+
+METRICS = Metrics()
+METRICS.declare('bdb_http_requests_total', 'counter', 'HTTP requests by route, method and status')
+METRICS.declare('bdb_http_request_duration_seconds', 'histogram', 'HTTP request latency by route',
+                LATENCY_BUCKETS)
+METRICS.declare('bdb_http_requests_in_flight', 'gauge', 'HTTP requests being handled')
+METRICS.declare('bdb_generation_phase_seconds', 'histogram',
+                'Workbook build time by phase (Sales also by sales model)', LATENCY_BUCKETS)
+METRICS.declare('bdb_workbook_bytes', 'histogram', 'Size of generated workbooks', SIZE_BUCKETS)
+METRICS.declare('bdb_generation_slots_in_use', 'gauge', 'Builds running or queued on the generation pool')
+METRICS.declare('bdb_generation_slots', 'gauge', 'Generation pool capacity (workers plus queue depth)')
+METRICS.declare('bdb_generation_queued', 'gauge', 'Builds holding a slot while they wait for a free worker')
+METRICS.declare('bdb_requests_shed_total', 'counter', 'Requests turned away by route and reason')
+METRICS.declare('bdb_errors_total', 'counter', 'Errors by route and exception type')
+METRICS.declare('bdb_workbook_cache', 'gauge', 'Workbook cache counters')
+METRICS.declare('bdb_startup_seconds', 'gauge',
+                'Startup phases: listening and warm are seconds since module load, openpyxl_import a duration')
+
+# Sales models reported as themselves in metrics; anything else is 'other'
+METRIC_SALES_MODELS = {'product', 'service', 'saas', 'marketplace', 'manufacturing', 'usage', 'hybrid', 'custom'}
+# Routes reported as themselves in metrics; anything else is 'other'
+METRIC_ROUTES = {'/health', '/healthz', '/cache-stats', '/admission-stats', '/metrics', '/generate-excel',
+                 '/generate-batch', '/project', '/jobs', '/what-if', '/estimate'} | set(STATIC_ROUTES)
+# POST routes, all of which go through admission control before their body is read
+POST_ROUTES = {'/generate-excel', '/generate-batch', '/project', '/jobs', '/what-if', '/estimate'}
+# Cheap POST routes rate limited on their own bucket, so previews do not use up a client's builds
+PREVIEW_ROUTES = {'/project', '/estimate'}
+
+
+# Startup phase -> seconds, also exported as bdb_startup_seconds
+STARTUP_TIMINGS = {}
+
+
+def record_startup(phase, seconds=None):
+    """Record a startup phase; seconds defaults to the time since the module started loading"""
+    if seconds is None:
+        seconds = time.perf_counter() - _MODULE_STARTED
+    STARTUP_TIMINGS[phase] = seconds
+    METRICS.set('bdb_startup_seconds', seconds, phase=phase)
+
+
+def record_build_metrics(sales_model, timings, size):
+    """Report a finished build's phase timings and output size to METRICS"""
+    if sales_model not in METRIC_SALES_MODELS:
+        sales_model = 'other'
+    for phase, seconds in timings.items():
+        METRICS.observe('bdb_generation_phase_seconds', seconds, phase=phase,
+                        sales_model=sales_model if phase == 'sales' else '')
+    METRICS.observe('bdb_workbook_bytes', size)
+
+
+class GenerationQueueFull(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+
+
+class GenerationPool:
+    """Runs CPU-bound workbook builds in worker processes with a bounded queue"""
+    
+    def __init__(self, workers=GENERATION_WORKERS, queue_depth=GENERATION_QUEUE_DEPTH):
+        self.workers = max(workers, 0)
+        self.queue_depth = max(queue_depth, 0)
+        # One slot per running build plus one per queued build
+        self.capacity = max(self.workers, 1) + self.queue_depth
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._active_lock = threading.Lock()
+        self.active = 0
+        self._executor = None
+        if self.workers:
+            # spawn rather than fork: the front end is threaded
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    
+    def run(self, func, *args):
+        """Run func(*args) on a worker and wait for the result"""
+        if not self._slots.acquire(blocking=False):
+            raise GenerationQueueFull('Server is busy generating other workbooks, please retry shortly')
+        self._track(1)
+        try:
+            if self._executor is None:
+                return func(*args)
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._track(-1)
+            self._slots.release()
+    
+    def reserve(self, count):
+        """Take up to count slots for a batch, at least one; returns how many were taken"""
+        if not self._slots.acquire(blocking=False):
+            raise GenerationQueueFull('Server is busy generating other workbooks, please retry shortly')
+        held = 1
+        while held < count and self._slots.acquire(blocking=False):
+            held += 1
+        self._track(held)
+        return held
+    
+    def release(self, count):
+        self._track(-count)
+        for _ in range(count):
+            self._slots.release()
+    
+    def _track(self, delta):
+        with self._active_lock:
+            self.active += delta
+    
+    def map_unordered(self, func, arg_tuples, parallelism):
+        """Run func over each args tuple, parallelism at a time, on slots taken with reserve().
+        
+        Yields (index, result, error) in completion order; a failed build does not stop the rest.
+        """
+        if self._executor is None:
+            for index, args in enumerate(arg_tuples):
+                try:
+                    yield index, func(*args), None
+                except Exception as e:
+                    yield index, None, e
+            return
+        
+        queued = iter(enumerate(arg_tuples))
+        pending = {}
+        
+        def submit_next():
+            for index, args in queued:
+                pending[self._executor.submit(func, *args)] = index
+                return
+        
+        try:
+            for _ in range(max(parallelism, 1)):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    submit_next()
+                    try:
+                        yield index, future.result(), None
+                    except Exception as e:
+                        yield index, None, e
+        finally:
+            # The client went away or the batch failed: drop builds that have not started
+            for future in pending:
+                future.cancel()
+    
+    def map(self, func, arg_tuples):
+        """Run func over every args tuple on as many free slots as there are, results in order.
+        
+        Raises GenerationQueueFull if no slot is free and the first error of any call.
+        """
+        held = self.reserve(len(arg_tuples))
+        try:
+            results = [None] * len(arg_tuples)
+            for index, result, error in self.map_unordered(func, arg_tuples, held):
+                if error is not None:
+                    raise error
+                results[index] = result
+            return results
+        finally:
+            self.release(held)
+    
+    @property
+    def inline(self):
+        """True when builds run in the calling thread rather than a worker process"""
+        return self._executor is None
+    
+    @property
+    def queued(self):
+        """Builds holding a slot while they wait for a free worker (inline builds never wait)"""
+        return max(self.active - self.workers, 0) if self._executor is not None else 0
+    
+    def warm(self, func, *args):
+        """Start every worker process and run func(*args) once per worker, without taking a slot"""
+        if self._executor is None:
+            return func(*args)
+        # Submitting them together makes the executor start one process per call
+        futures = [self._executor.submit(func, *args) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Why a request was turned away: no room on the pool, over the client's rate, body too large
+SHED_REASONS = ('busy', 'rate_limited', 'too_large')
+
+
+class AdmissionControl:
+    """Per-client token buckets for POST requests, and counts of the requests turned away.
+    
+    Each client has one bucket for builds and one, larger, for the preview routes.
+    """
+    
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST, max_clients=RATE_LIMIT_CLIENTS,
+                 preview_per_minute=PREVIEW_RATE_LIMIT_PER_MINUTE, preview_burst=PREVIEW_RATE_LIMIT_BURST):
+        self.per_minute = per_minute
+        self.burst = max(burst, 1)
+        self.preview_per_minute = preview_per_minute
+        self.preview_burst = max(preview_burst, 1)
+        self.max_clients = max(max_clients, 1)
+        self._lock = threading.Lock()
+        # (client, preview) -> (tokens, time of the last request), least recent first
+        self._buckets = OrderedDict()
+        self.shed = dict.fromkeys(SHED_REASONS, 0)
+    
+    def take(self, client, now=None, preview=False):
+        """Spend one of client's tokens; returns 0 when the request may go ahead, else the seconds to wait"""
+        per_minute, burst = (self.preview_per_minute, self.preview_burst) if preview else (self.per_minute, self.burst)
+        if per_minute <= 0:
+            return 0
+        rate = per_minute / 60
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.pop((client, preview), (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[client, preview] = (tokens, now)
+            # The longest idle buckets are forgotten first and start again full
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return retry_after
+    
+    def record_shed(self, reason):
+        with self._lock:
+            self.shed[reason] += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'shed': dict(self.shed),
+                'clients': len({client for client, _ in self._buckets}),
+                'rateLimitPerMinute': self.per_minute,
+                'rateLimitBurst': self.burst,
+                'previewRateLimitPerMinute': self.preview_per_minute,
+                'previewRateLimitBurst': self.preview_burst,
+                'maxRequestBytes': MAX_REQUEST_BYTES,
+            }
+
+
+class WorkbookCache:
+    """LRU cache of generated workbooks under a byte budget, with an optional on-disk tier"""
+    
+    def __init__(self, max_bytes=WORKBOOK_CACHE_BYTES, directory=WORKBOOK_CACHE_DIR,
+                 max_disk_bytes=WORKBOOK_CACHE_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory or None
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+    
+    def get(self, key):
+        """Cached workbook bytes for key, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._store(key, data)
+        return data
+    
+    def put(self, key, data):
+        with self._lock:
+            self._store(key, data)
+        self._write_disk(key, data)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_evictions': self.disk_evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+    
+    def _store(self, key, data):
+        # Caller holds the lock. Workbooks bigger than the whole budget are never kept in memory
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+    
+    def _disk_path(self, key):
+        # Entries may be workbooks, ODS files or ZIPs of CSVs, so the suffix does not name a format
+        return os.path.join(self.directory, f'{key}.bin')
+    
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Keeps the disk tier in least-recently-used order
+            return data
+        except OSError:
+            return None
+    
+    def _write_disk(self, key, data):
+        if not self.directory or len(data) > self.max_disk_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        # Write then rename so other processes never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.bin'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        disk_bytes = sum(size for _, size, _ in files)
+        for _, size, old_path in sorted(files):
+            if disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(old_path)
+            except OSError:
+                continue
+            disk_bytes -= size
+            with self._lock:
+                self.disk_evictions += 1
+
+
+class StaticAsset:
+    """One static file held in memory, with precompressed variants and validators"""
+    
+    def __init__(self, body, mtime, size, content_type, cache_control):
+        self.mtime = mtime
+        self.size = size
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        # encoding -> (body, ETag); each variant gets its own strong ETag
+        self.variants = {'identity': (body, f'"{self.etag}"')}
+        if content_type in COMPRESSIBLE_TYPES:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants['gzip'] = (compressed, f'"{self.etag}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(body)
+                if len(compressed) < len(body):
+                    self.variants['br'] = (compressed, f'"{self.etag}-br"')
+    
+    def negotiate(self, accept_encoding):
+        """Best variant the client accepts, as (encoding, body, etag)"""
+        accepted = {}
+        for part in (accept_encoding or '').split(','):
+            coding, _, params = part.strip().partition(';')
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            if coding:
+                accepted[coding.lower()] = quality
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return (encoding,) + self.variants[encoding]
+        return ('identity',) + self.variants['identity']
+
+
+class StaticAssetStore:
+    """Loads static files on first use and reloads them when their mtime or size changes"""
+    
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._assets = {}
+        self._lock = threading.Lock()
+    
+    def get(self, file_name, content_type, cache_control):
+        """The asset for file_name, or None if the file does not exist"""
+        path = os.path.join(self.base_dir, file_name)
+        if not os.path.exists(path):
+            path = file_name  # Try current directory
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        
+        asset = self._assets.get(file_name)
+        if asset is not None and asset.mtime == stat.st_mtime and asset.size == stat.st_size:
+            return asset
+        with self._lock:
+            asset = self._assets.get(file_name)
+            if asset is None or asset.mtime != stat.st_mtime or asset.size != stat.st_size:
+                try:
+                    with open(path, 'rb') as f:
+                        body = f.read()
+                except OSError:
+                    return None
+                asset = StaticAsset(body, stat.st_mtime, stat.st_size, content_type, cache_control)
+                self._assets[file_name] = asset
+            return asset
+
+
+class CapturingWriter:
+    """Passes writes through to another file object and keeps a copy, up to a size limit"""
+    
+    def __init__(self, target, limit):
+        self._target = target
+        self._limit = limit
+        self._copy = io.BytesIO()
+        self.overflowed = False
+        self.size = 0
+    
+    def write(self, data):
+        self.size += len(data)
+        if not self.overflowed:
+            if self._copy.tell() + len(data) > self._limit:
+                self.overflowed = True
+                self._copy = None
+            else:
+                self._copy.write(data)
+        return self._target.write(data)
+    
+    def flush(self):
+        self._target.flush()
+    
+    def getvalue(self):
+        """Everything written so far, or None once the limit was passed"""
+        return None if self.overflowed else self._copy.getvalue()
+
+
+class ChunkedWriter:
+    """Write-only file object that frames its output as HTTP chunked transfer encoding"""
+    
+    def __init__(self, wfile, chunk_size=RESPONSE_CHUNK_SIZE):
+        self._wfile = wfile
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+    
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+        return len(data)
+    
+    def flush(self):
+        if self._buffer:
+            self._wfile.write(b'%X\r\n' % len(self._buffer))
+            self._wfile.write(self._buffer)
+            self._wfile.write(b'\r\n')
+            self._buffer.clear()
+    
+    def close(self):
+        """Send any buffered data and the terminating zero-length chunk"""
+        self.flush()
+        self._wfile.write(b'0\r\n\r\n')
+
+
+# === PROFILING ===
+# Only used when PROFILE_DIR is set; cProfile and tracemalloc are imported on first use.
+
+# One capture at a time: tracemalloc traces the whole process
+_PROFILE_LOCK = threading.Lock()
+_CAPTURE_NAME = re.compile(r'^[\w.-]+$')
+_NUMBER = re.compile(r'^-?\d+(\.\d+)?$')
+_FIELD_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9]*$')
+# Config fields holding one of a fixed set of options rather than the user's own text
+_CONFIG_OPTION_FIELDS = {'salesModel', 'streamType'}
+
+
+def sanitize_config(value):
+    """Config with its free text replaced by stable tokens, keeping structure, counts and numbers.
+    
+    The same text always maps to the same token, so keys that refer to each other still match
+    and the capture can be replayed through build_workbook.
+    """
+    if isinstance(value, dict):
+        sanitized = {}
+        for key, item in value.items():
+            if _FIELD_NAME.match(key):
+                sanitized[key] = item if key in _CONFIG_OPTION_FIELDS else sanitize_config(item)
+            else:
+                # Team names and non-staff items are used as keys
+                sanitized[sanitize_config(key)] = sanitize_config(item)
+        return sanitized
+    if isinstance(value, list):
+        return [sanitize_config(item) for item in value]
+    if isinstance(value, str):
+        if not value.strip() or _NUMBER.match(value.strip()):
+            return value
+        # Non-staff keys are 'category|item'; keep the separator the layout splits on
+        return '|'.join(f't{hashlib.sha256(part.encode()).hexdigest()[:10]}' for part in value.split('|'))
+    return value
+
+
+def save_profile_capture(profiler, snapshot, peak_bytes, elapsed, config, options, directory=None):
+    """Write a capture (pstats, text reports, sanitized config) and trim old captures; returns its id"""
+    import pstats
+    import tracemalloc
+    directory = directory or PROFILE_DIR
+    capture_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}"
+    path = os.path.join(directory, capture_id)
+    os.makedirs(path)
+    
+    profiler.dump_stats(os.path.join(path, 'profile.pstats'))
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(40)
+    with open(os.path.join(path, 'profile.txt'), 'w') as f:
+        f.write(report.getvalue())
+    
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    with open(os.path.join(path, 'allocations.txt'), 'w') as f:
+        # tracemalloc cannot tell threads apart, so say so next to the figures
+        f.write(f'Peak traced memory: {peak_bytes} bytes\n'
+                'Memory figures cover the whole process, including any other requests\n'
+                'it handled while this build ran (builds on worker processes are not included).\n'
+                '\nTop allocation sites:\n')
+        for stat in snapshot.statistics('lineno')[:25]:
+            f.write(f'{stat}\n')
+    
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump(sanitize_config(config), f, indent=2)
+    with open(os.path.join(path, 'capture.json'), 'w') as f:
+        json.dump({
+            'id': capture_id,
+            'elapsed_seconds': round(elapsed, 4),
+            'peak_traced_bytes': peak_bytes,
+            'memory_scope': 'process',
+            'format': options.output_format,
+            'engine': options.engine,
+            'formulas': options.formulas,
+            'values': options.values,
+        }, f, indent=2)
+    
+    captures = sorted(entry for entry in os.listdir(directory) if _CAPTURE_NAME.match(entry))
+    for old_id in captures[:-max(PROFILE_MAX_CAPTURES, 1)]:
+        shutil.rmtree(os.path.join(directory, old_id), ignore_errors=True)
+    return capture_id
+
+
+def list_profile_captures(directory=None):
+    """Summaries of the saved captures, newest first"""
+    directory = directory or PROFILE_DIR
+    captures = []
+    for capture_id in sorted(os.listdir(directory), reverse=True):
+        meta_path = os.path.join(directory, capture_id, 'capture.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        meta['files'] = sorted(os.listdir(os.path.join(directory, capture_id)))
+        captures.append(meta)
+    return captures
+
+
+# === JOBS ===
+# POST /jobs queues a build and returns at once; background threads run it on the
+# generation pool and keep its status, current tab and result in a job store.
+
+
+_JOB_ID = re.compile(r'^[0-9a-f]{24}$')
+
+
+class JobCancelled(Exception):
+    """Raised inside a build when its job has been cancelled"""
+
+
+class BuildProgress:
+    """Reports the tab a build is on and stops the build once its job is cancelled.
+    
+    shared is a dict, or a multiprocessing Manager dict when builds run in worker processes.
+    store, when the job store is shared with other processes, also gets the tab, and a cancel
+    recorded there by any process stops the build.
+    """
+    
+    def __init__(self, shared, job_id, store=None):
+        self.shared = shared
+        self.job_id = job_id
+        self.store = store
+    
+    def __call__(self, phase):
+        if self.shared.get(f'cancel:{self.job_id}'):
+            raise JobCancelled()
+        if self.store is not None and self.store.transition(self.job_id, ('running',), phase=phase) is None:
+            raise JobCancelled()
+        self.shared[self.job_id] = phase
+
+
+class MemoryJobStore:
+    """Job records and results kept in this process"""
+    
+    def __init__(self):
+        self._jobs = {}
+        self._results = {}
+        self._lock = threading.Lock()
+    
+    def save(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+    
+    def load(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+    
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(fields)
+            return dict(job)
+    
+    def transition(self, job_id, statuses, **fields):
+        """Update the job only if its status is one of statuses; returns the updated job or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] not in statuses:
+                return None
+            job.update(fields)
+            return dict(job)
+    
+    def save_result(self, job_id, data):
+        with self._lock:
+            self._results[job_id] = data
+    
+    def load_result(self, job_id):
+        with self._lock:
+            return self._results.get(job_id)
+    
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._results.pop(job_id, None)
+    
+    def job_ids(self):
+        with self._lock:
+            return list(self._jobs)
+
+
+class FileJobStore:
+    """Job records and results as files in a directory, e.g. a volume shared with other instances"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def __reduce__(self):
+        # Sent to worker processes inside BuildProgress; the copy gets its own thread lock
+        return (FileJobStore, (self.directory,))
+    
+    def _path(self, job_id, suffix):
+        return os.path.join(self.directory, f'{job_id}{suffix}')
+    
+    @contextlib.contextmanager
+    def _locked(self, job_id):
+        # The thread lock orders this process's threads; the flock on the job's .lock file
+        # orders the other processes and instances sharing the directory
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._path(job_id, '.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+    
+    def _write(self, path, data):
+        # Write then rename so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    def save(self, job):
+        self._write(self._path(job['id'], '.json'), json.dumps(job).encode())
+    
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id, '.json'), 'rb') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def update(self, job_id, **fields):
+        with self._locked(job_id):
+            job = self.load(job_id)
+            if job is None:
+                return None
+            job.update(fields)
+            self.save(job)
+            return job
+    
+    def transition(self, job_id, statuses, **fields):
+        """Update the job only if its status is one of statuses; returns the updated job or None"""
+        with self._locked(job_id):
+            job = self.load(job_id)
+            if job is None or job['status'] not in statuses:
+                return None
+            job.update(fields)
+            self.save(job)
+            return job
+    
+    # Results may be a workbook, an ODS file or a ZIP of CSVs, so the suffix does not name a format
+    def save_result(self, job_id, data):
+        self._write(self._path(job_id, '.bin'), data)
+    
+    def load_result(self, job_id):
+        try:
+            with open(self._path(job_id, '.bin'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def delete(self, job_id):
+        with self._locked(job_id):
+            # A process still waiting on the removed .lock file then finds no job to change
+            for suffix in ('.bin', '.json', '.lock'):
+                try:
+                    os.remove(self._path(job_id, suffix))
+                except OSError:
+                    pass
+    
+    def job_ids(self):
+        return [entry[:-len('.json')] for entry in os.listdir(self.directory) if entry.endswith('.json')]
+
+
+class JobRunner:
+    """Background threads that build queued jobs on the generation pool"""
+    
+    def __init__(self, store, pool, workers=JOB_WORKERS, queue_depth=JOB_QUEUE_DEPTH, ttl=JOB_RESULT_TTL):
+        self.store = store
+        self.pool = pool
+        self.ttl = ttl
+        self._queue = queue.Queue(maxsize=max(queue_depth, 1))
+        self._manager = None
+        self._progress = {}
+        self._progress_lock = threading.Lock()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(workers, 1))]
+        for thread in self._threads:
+            thread.start()
+    
+    def submit(self, config, options):
+        """Queue a build and return its job record.
+        
+        Raises ConfigError for an invalid or oversized config and GenerationQueueFull when the queue is full.
+        """
+        model = compile_config(config)
+        options = budget_options(model, options)
+        job = {
+            'id': os.urandom(12).hex(),
+            'status': 'queued',
+            'phase': None,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'format': options.output_format,
+            'engine': options.engine,
+            'formulas': options.formulas,
+            'values': options.values,
+        }
+        self.store.save(job)
+        try:
+            self._queue.put_nowait((job['id'], model, options))
+        except queue.Full:
+            self.store.delete(job['id'])
+            raise GenerationQueueFull('Job queue is full, please retry shortly')
+        return job
+    
+    def status(self, job_id):
+        """The job record with its current tab, or None if unknown or expired"""
+        job = self.store.load(job_id)
+        if job is None or self._expired(job):
+            return None
+        if job['status'] == 'running':
+            job['phase'] = self._progress.get(job_id, job.get('phase'))
+        return job
+    
+    def cancel(self, job_id):
+        """Cancel a queued or running job; a running build stops at its next tab"""
+        job = self.status(job_id)
+        if job is None or job['status'] not in ('queued', 'running'):
+            return job
+        if not isinstance(self.store, FileJobStore):
+            # A shared store's builds see the cancelled status itself, whichever process runs them
+            self._progress[f'cancel:{job_id}'] = True
+        cancelled = self.store.transition(job_id, ('queued', 'running'), status='cancelled', phase=None,
+                                          expires_at=time.time() + self.ttl)
+        # The build finished (or failed) since the status was read
+        return cancelled if cancelled is not None else self.status(job_id)
+    
+    def purge_expired(self):
+        for job_id in self.store.job_ids():
+            job = self.store.load(job_id)
+            if job is not None and self._expired(job):
+                self.store.delete(job_id)
+    
+    def shutdown(self):
+        self._closed = True
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        if self._manager is not None:
+            self._manager.shutdown()
+    
+    def _expired(self, job):
+        expires_at = job.get('expires_at')
+        return expires_at is not None and expires_at < time.time()
+    
+    def _shared_progress(self):
+        # Builds in worker processes report through a Manager dict, started on first use
+        if self.pool.inline:
+            return self._progress
+        with self._progress_lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context('spawn').Manager()
+                self._progress = self._manager.dict()
+        return self._progress
+    
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=60)
+            except queue.Empty:
+                self.purge_expired()
+                continue
+            if item is None:
+                return
+            self._run(*item)
+            self.purge_expired()
+    
+    def _run(self, job_id, model, options):
+        # Another process sharing a FileJobStore may cancel the job or ask for its tab
+        store = self.store if isinstance(self.store, FileJobStore) else None
+        progress = BuildProgress(self._shared_progress(), job_id, store)
+        try:
+            # A job cancelled while it waited in the queue is never started
+            started = self.store.transition(job_id, ('queued',), status='running',
+                                            started_at=datetime.now(timezone.utc).isoformat())
+            if started is None:
+                return
+            try:
+                data, timings = self._build(model, options, progress)
+            except JobCancelled:
+                self._finish(job_id, ('running', 'cancelled'), status='cancelled')
+                return
+            except Exception as e:
+                if self._closed:
+                    # The progress manager is gone; the build was cut off by the shutdown
+                    self._finish(job_id, status='failed', error='Server shut down before the job finished')
+                    return
+                METRICS.inc('bdb_errors_total', route='/jobs', type=type(e).__name__)
+                print(f"Error generating job {job_id}: {e}")
+                if not self._cancelled(job_id):
+                    self._finish(job_id, status='failed', error=str(e))
+                return
+            
+            record_build_metrics(model.sales_model, timings, len(data))
+            if self._cancelled(job_id):
+                return  # Cancelled after the last tab, when the build could no longer be stopped
+            self.store.save_result(job_id, data)
+            self._finish(job_id, status='done', size=len(data))
+        finally:
+            if not self._closed:
+                progress.shared.pop(job_id, None)
+                progress.shared.pop(f'cancel:{job_id}', None)
+    
+    def _cancelled(self, job_id):
+        job = self.store.load(job_id)
+        return job is None or job['status'] == 'cancelled'
+    
+    def _build(self, model, options, progress):
+        simulation = None
+        while True:
+            try:
+                if simulation is None and model.simulation is not None:
+                    # Spread over the workers like /project, before the build takes one of them
+                    simulation = simulate_on_pool(model, self.pool)
+                return self.pool.run(render_workbook_timed, model, options, progress, simulation)
+            except GenerationQueueFull:
+                # Interactive requests have the pool busy; the job waits its turn
+                time.sleep(1)
+    
+    def _finish(self, job_id, statuses=('running',), **fields):
+        # Conditional, so a cancel that lands while the result is saved is not overwritten
+        self.store.transition(job_id, statuses, phase=None, finished_at=datetime.now(timezone.utc).isoformat(),
+                              expires_at=time.time() + self.ttl, **fields)
+
+
 class BusinessDataHandler(SimpleHTTPRequestHandler):
     
     def do_GET(self):
@@ -23,680 +1235,3367 @@ class BusinessDataHandler(SimpleHTTPRequestHandler):
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             self.wfile.write(json.dumps({'status': 'healthy'}).encode())
-        elif self.path == '/diagnostic' or self.path == '/diagnostic.html':
-            # Diagnostic page
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            
-            diag_file = os.path.join(os.path.dirname(__file__), 'diagnostic.html')
-            if not os.path.exists(diag_file):
-                diag_file = 'diagnostic.html'
-            
-            with open(diag_file, 'rb') as f:
-                self.wfile.write(f.read())
-        elif self.path == '/test' or self.path == '/test.html':
-            # Test page for debugging
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            
-            test_file = os.path.join(os.path.dirname(__file__), 'test.html')
-            if not os.path.exists(test_file):
-                test_file = 'test.html'
-            
-            with open(test_file, 'rb') as f:
-                self.wfile.write(f.read())
-        elif self.path == '/' or self.path == '/index.html':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.send_header('Cache-Control', 'no-cache')
+        elif self.path == '/cache-stats':
+            # Workbook cache counters, for sizing WORKBOOK_CACHE_BYTES
+            cache = getattr(self.server, 'workbook_cache', None)
+            self.send_json(200, cache.stats() if cache is not None else {'enabled': False})
+        elif self.path == '/admission-stats':
+            self.send_admission_stats()
+        elif self.path == '/metrics':
+            self.send_metrics()
+        elif self.path.startswith('/jobs/'):
+            self.send_job(self.path[len('/jobs/'):])
+        elif PROFILE_DIR and (self.path == '/profiles' or self.path.startswith('/profiles/')):
+            self.send_profile_capture(self.path[len('/profiles/'):])
+        elif self.path in STATIC_ROUTES:
+            self.send_static(*STATIC_ROUTES[self.path])
+        else:
+            super().do_GET()
+    
+    def send_metrics(self):
+        """Prometheus scrape endpoint; pool and cache gauges are sampled at scrape time.
+        
+        In prefork mode every process's series are listed, with a process label: this one's
+        as of now, the others' as they last published them (see serve_process).
+        """
+        self.server.sample_gauges()
+        board = getattr(self.server, 'process_board', None)
+        if board is None:
+            body = METRICS.render().encode()
+        else:
+            snapshots = {slot: snapshot for slot, (snapshot, _) in board.entries().items()}
+            snapshots[self.server.process_slot] = METRICS.snapshot()
+            body = METRICS.render(snapshots).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_admission_stats(self):
+        """Pool occupancy and shed counts, for sizing the workers, queue depth and rate limit.
+        
+        In prefork mode the shed counts are the supervisor's and the pool figures are summed over the processes.
+        """
+        admission = getattr(self.server, 'admission', None)
+        stats = admission.stats() if admission is not None else {'shed': dict.fromkeys(SHED_REASONS, 0)}
+        figures = self.server.pool_figures()
+        board = getattr(self.server, 'process_board', None)
+        if board is not None:
+            published = {slot: process_figures for slot, (_, process_figures) in board.entries().items()}
+            published[self.server.process_slot] = figures
+            figures = {name: sum(process_figures[name] for process_figures in published.values()) for name in figures}
+            stats['processes'] = len(published)
+        stats.update(figures)
+        self.send_json(200, stats)
+    
+    def send_profile_capture(self, name):
+        """GET /profiles lists the captures, /profiles/<id>/<file> downloads one of their files"""
+        if not name:
+            self.send_json(200, list_profile_captures() if os.path.isdir(PROFILE_DIR) else [])
+            return
+        parts = name.split('/')
+        if len(parts) != 2 or not all(_CAPTURE_NAME.match(part) for part in parts):
+            self.send_error(404, 'File not found')
+            return
+        path = os.path.join(PROFILE_DIR, *parts)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        content_type = 'application/octet-stream'
+        if path.endswith('.txt'):
+            content_type = 'text/plain; charset=utf-8'
+        elif path.endswith('.json'):
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_static(self, file_name, content_type, cache_control):
+        """Serve a static file from memory with ETag/Last-Modified, compression and Range support"""
+        asset = self.server.static_assets.get(file_name, content_type, cache_control)
+        if asset is None:
+            self.send_error(404, 'File not found')
+            return
+        
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and if_range and if_range not in (asset.variants['identity'][1], asset.last_modified):
+            range_header = None  # The client's copy is stale, send the whole file
+        # Ranges are served from the uncompressed body so offsets stay stable
+        if range_header:
+            encoding, body, etag = ('identity',) + asset.variants['identity']
+        else:
+            encoding, body, etag = asset.negotiate(self.headers.get('Accept-Encoding'))
+        
+        if self._not_modified(asset, etag):
+            self.send_response(304)
+            self._send_static_headers(asset, etag)
             self.end_headers()
-            
-            # Read and serve the HTML file
-            html_file = os.path.join(os.path.dirname(__file__), 'index.html')
-            if not os.path.exists(html_file):
-                html_file = 'index.html'  # Try current directory
-            
-            with open(html_file, 'rb') as f:
-                self.wfile.write(f.read())
-        elif self.path == '/sherloc_logo.jpg':
-            self.send_response(200)
-            self.send_header('Content-type', 'image/jpeg')
-            self.send_header('Cache-Control', 'public, max-age=86400')
+            return
+        
+        byte_range = self._parse_range(range_header, len(body)) if range_header else None
+        if byte_range == 'unsatisfiable':
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(body)}')
+            self.send_header('Content-Length', '0')
             self.end_headers()
-            
-            logo_file = os.path.join(os.path.dirname(__file__), 'sherloc_logo.jpg')
-            if not os.path.exists(logo_file):
-                logo_file = 'sherloc_logo.jpg'
-            
-            with open(logo_file, 'rb') as f:
-                self.wfile.write(f.read())
+            return
+        
+        if byte_range:
+            first, last = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{len(body)}')
+            body = body[first:last + 1]
         else:
-            super().do_GET()
+            self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self._send_static_headers(asset, etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_static_headers(self, asset, etag):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Cache-Control', asset.cache_control)
+        self.send_header('Accept-Ranges', 'bytes')
+        if len(asset.variants) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+    
+    def _not_modified(self, asset, etag):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(asset.mtime) <= since.timestamp()
+        return False
+    
+    @staticmethod
+    def _parse_range(range_header, length):
+        """(first, last) for a single 'bytes=' range, 'unsatisfiable', or None to send everything"""
+        unit, _, spec = range_header.partition('=')
+        if unit.strip() != 'bytes' or ',' in spec:
+            return None  # Multiple ranges are answered with the full body
+        first, _, last = spec.strip().partition('-')
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix == 0:
+                    return 'unsatisfiable'
+                return max(length - suffix, 0), length - 1
+            first = int(first)
+            last = int(last) if last else length - 1
+        except ValueError:
+            return None
+        if first >= length:
+            return 'unsatisfiable'
+        if last < first:
+            return None
+        return first, min(last, length - 1)
     
     def do_POST(self):
-        if self.path == '/generate-excel':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            config = json.loads(post_data.decode('utf-8'))
+        url = urlparse(self.path)
+        if url.path in POST_ROUTES and not self._admit():
+            return
+        if url.path == '/generate-excel':
+            # Engine and formula mode can be chosen per request, e.g. ?engine=streaming&formulas=shared
+            try:
+                options = OutputOptions.from_query(url.query)
+                content_length = int(self.headers['Content-Length'])
+                config = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
             
             try:
-                # Generate Excel file
-                filepath = self.generate_excel(config)
-                
+                # Generate Excel file and send it
                 # Note: Formula recalculation happens when user opens file in Excel
                 # We don't need the recalc script on deployed environments
-                
-                # Send file
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                self.send_header('Content-Disposition', 'attachment; filename="business_model.xlsx"')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                
-                with open(filepath, 'rb') as f:
-                    self.wfile.write(f.read())
-                
+                if PROFILE_DIR and self.headers.get('X-Profile') == '1':
+                    self.generate_excel_profiled(config, options)
+                else:
+                    self.generate_excel(config, options)
+            except ConfigError as e:
+                self.send_json(400, {'error': f'Invalid config: {e}'})
+            except GenerationQueueFull as e:
+                self._send_busy(e)
             except Exception as e:
-                self.send_response(500)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                error_response = json.dumps({'error': str(e)})
-                self.wfile.write(error_response.encode())
+                self._record_error(e)
+                self.send_json(500, {'error': str(e)})
                 print(f"Error generating Excel: {e}")
+        elif url.path == '/jobs':
+            # Queue a build and answer at once; poll GET /jobs/<id> and fetch /jobs/<id>/result
+            try:
+                options = OutputOptions.from_query(url.query)
+                content_length = int(self.headers['Content-Length'])
+                config = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            if not isinstance(config, dict):
+                self.send_json(400, {'error': 'Expected a JSON config object'})
+                return
+            try:
+                job = self.server.job_runner.submit(config, options)
+            except ConfigError as e:
+                self.send_json(400, {'error': f'Invalid config: {e}'})
+                return
+            except GenerationQueueFull as e:
+                self._send_busy(e)
+                return
+            self.send_json(202, job, {'Location': f"/jobs/{job['id']}"})
+        elif url.path == '/generate-batch':
+            # Many workbooks in one ZIP: the body is a JSON array of configs
+            try:
+                options = OutputOptions.from_query(url.query)
+                content_length = int(self.headers['Content-Length'])
+                configs = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            if not isinstance(configs, list) or not all(isinstance(config, dict) for config in configs):
+                self.send_json(400, {'error': 'Expected a JSON array of configs'})
+                return
+            if not configs or len(configs) > MAX_BATCH_SIZE:
+                self.send_json(400, {'error': f'A batch holds 1 to {MAX_BATCH_SIZE} configs'})
+                return
+            try:
+                self.generate_batch(configs, options)
+            except GenerationQueueFull as e:
+                self._send_busy(e)
+        elif url.path == '/project':
+            # Live preview: the computed monthly series as JSON, no workbook is built
+            if not HAS_NUMPY:
+                self.send_json(501, {'error': 'Projections need numpy to be installed'})
+                return
+            try:
+                content_length = int(self.headers['Content-Length'])
+                config = json.loads(self.rfile.read(content_length).decode('utf-8'))
+                # A simulation in the config spreads its chunks of paths over the workers
+                pool = getattr(self.server, 'generation_pool', None)
+                self.send_json(200, project_config(config, pool.map if pool is not None else None))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': f'Invalid config: {e}'})
+            except GenerationQueueFull as e:
+                self._send_busy(e)
+        elif url.path == '/estimate':
+            # Pre-flight: what the build would cost and whether the budgets allow it, nothing is built
+            try:
+                options = OutputOptions.from_query(url.query)
+                content_length = int(self.headers['Content-Length'])
+                config = json.loads(self.rfile.read(content_length).decode('utf-8'))
+                self.send_json(200, estimate_config(config, options))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': f'Invalid config: {e}'})
+        elif url.path == '/what-if':
+            # Recalculate only the cells some edits reach, against a model kept from an earlier request
+            if not HAS_NUMPY:
+                self.send_json(501, {'error': 'What-if needs numpy to be installed'})
+                return
+            try:
+                content_length = int(self.headers['Content-Length'])
+                body = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            if not isinstance(body, dict) or ('config' in body) == ('model' in body):
+                self.send_json(400, {'error': 'Expected a JSON object with either "config" or "model", and "changes"'})
+                return
+            started = time.perf_counter()
+            try:
+                if 'config' in body:
+                    model_id, model = self.server.what_if_models.load(body['config'])
+                else:
+                    model_id = body['model']
+                    model = self.server.what_if_models.get(model_id) if isinstance(model_id, str) else None
+                    if model is None:
+                        self.send_json(404, {'error': 'Unknown or expired model, send the config instead'})
+                        return
+                changed = model.apply(body.get('changes', []))
+            except ConfigError as e:
+                self.send_json(400, {'error': f'Invalid config: {e}'})
+                return
+            except WhatIfError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.send_json(200, {'model': model_id, 'changed': changed,
+                                 'seconds': round(time.perf_counter() - started, 6)})
         else:
             self.send_response(404)
             self.end_headers()
     
+    def _admit(self):
+        """Turn a POST away before its body is read: 413 when too large, 429 over the client's rate
+        (the preview routes have a bucket of their own).
+        
+        Builds the generation pool has no room for are turned away later with a 503 (_send_busy).
+        """
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self.send_json(411, {'error': 'A Content-Length header is required'})
+            return False
+        if content_length > MAX_REQUEST_BYTES:
+            self._shed('too_large')
+            self.send_json(413, {'error': f'Request body is over the {MAX_REQUEST_BYTES} byte limit'})
+            return False
+        admission = getattr(self.server, 'admission', None)
+        preview = urlparse(self.path).path in PREVIEW_ROUTES
+        retry_after = admission.take(self._client_id(), preview=preview) if admission is not None else 0
+        if retry_after:
+            self._shed('rate_limited')
+            self.send_json(429, {'error': 'Too many requests, please retry shortly'},
+                           {'Retry-After': str(math.ceil(retry_after))})
+            return False
+        return True
+    
+    def _client_id(self):
+        if TRUST_FORWARDED_FOR:
+            forwarded = self.headers.get('X-Forwarded-For')
+            if forwarded:
+                # The proxy appends the address it saw; anything before it came from the client
+                return forwarded.split(',')[-1].strip()
+        return self.client_address[0]
+    
+    def _shed(self, reason):
+        # The body of a turned-away request is not read, so the connection cannot be reused
+        self.close_connection = True
+        METRICS.inc('bdb_requests_shed_total', route=self._metric_route(), reason=reason)
+        admission = getattr(self.server, 'admission', None)
+        if admission is not None:
+            admission.record_shed(reason)
+    
+    def _send_busy(self, error):
+        """503 for a build there is no worker or queue slot for"""
+        self._record_error(error)
+        METRICS.inc('bdb_requests_shed_total', route=self._metric_route(), reason='busy')
+        admission = getattr(self.server, 'admission', None)
+        if admission is not None:
+            admission.record_shed('busy')
+        self.send_json(503, {'error': str(error)}, {'Retry-After': '5'})
+    
+    def send_json(self, status, payload, headers=None):
+        """Send a JSON response with CORS enabled"""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(payload, separators=(',', ':')).encode())
+    
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        job_id = path[len('/jobs/'):] if path.startswith('/jobs/') else ''
+        if not _JOB_ID.match(job_id):
+            self.send_json(404, {'error': 'Not found'})
+            return
+        job = self.server.job_runner.cancel(job_id)
+        if job is None:
+            self.send_json(404, {'error': 'Unknown or expired job'})
+        elif job['status'] != 'cancelled':
+            self.send_json(409, {'error': f"Job is already {job['status']}", 'job': job})
+        else:
+            self.send_json(200, job)
+    
+    def send_job(self, name):
+        """GET /jobs/<id> reports status and current tab, /jobs/<id>/result downloads the workbook"""
+        job_id, _, rest = name.partition('/')
+        if not _JOB_ID.match(job_id) or rest not in ('', 'result'):
+            self.send_json(404, {'error': 'Not found'})
+            return
+        runner = self.server.job_runner
+        job = runner.status(job_id)
+        if job is None:
+            self.send_json(404, {'error': 'Unknown or expired job'})
+            return
+        if not rest:
+            self.send_json(200, job)
+            return
+        data = runner.store.load_result(job_id) if job['status'] == 'done' else None
+        if data is None:
+            self.send_json(409, {'error': f"Job is {job['status']}", 'job': job})
+            return
+        output_format = job.get('format', 'xlsx')
+        self._send_workbook_headers(len(data), output_format=output_format)
+        self._write_body(data)
+    
     def do_OPTIONS(self):
         # Handle preflight requests
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'POST, GET, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
     
-    def generate_excel(self, config):
-        """Generate Excel workbook based on configuration"""
-        workbook = Workbook()
-        workbook.remove(workbook.active)
-        
-        # Generate month headers
-        month_headers = []
-        current_date = datetime.now()
-        for i in range(48):
-            date = current_date + timedelta(days=30*i)
-            month_headers.append(date.strftime('%b %Y'))
-        
-        # === STAFF TAB ===
-        staff_sheet = workbook.create_sheet('Staff')
-        
-        # Prepare headers
-        headers = ['Position', 'Team', 'Type', 'Direct/Overhead']
-        
-        extra_category = config.get('extraCategory')
-        if extra_category and extra_category.get('name'):
-            headers.append(extra_category['name'])
-        
-        headers.append('Annual Salary')
-        headers.extend(month_headers)
-        
-        # Write headers
-        for col_idx, header in enumerate(headers, 1):
-            cell = staff_sheet.cell(row=1, column=col_idx, value=header)
-            cell.font = Font(bold=True, size=11)
-            cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Set column widths
-        staff_sheet.column_dimensions['A'].width = 20
-        staff_sheet.column_dimensions['B'].width = 30
-        staff_sheet.column_dimensions['C'].width = 12
-        staff_sheet.column_dimensions['D'].width = 18
-        
-        col_offset = 5
-        if extra_category and extra_category.get('name'):
-            staff_sheet.column_dimensions[chr(64 + col_offset)].width = 18
-            col_offset += 1
-        
-        staff_sheet.column_dimensions[chr(64 + col_offset)].width = 15
-        for i in range(48):
-            col_letter = chr(64 + col_offset + 1 + i) if col_offset + 1 + i <= 26 else \
-                         chr(64 + (col_offset + 1 + i - 1) // 26) + chr(65 + (col_offset + 1 + i - 1) % 26)
-            staff_sheet.column_dimensions[col_letter].width = 12
-        
-        # Create data validations
-        selected_teams = config.get('selectedTeams', [])
-        team_validation = DataValidation(
-            type="list",
-            formula1=f'"{",".join(selected_teams)}"',
-            allow_blank=False
-        )
-        staff_sheet.add_data_validation(team_validation)
-        
-        type_validation = DataValidation(
-            type="list",
-            formula1='"PAYE,Contract"',
-            allow_blank=False
-        )
-        staff_sheet.add_data_validation(type_validation)
-        
-        overhead_validation = DataValidation(
-            type="list",
-            formula1='"OVERHEAD,DIRECT"',
-            allow_blank=False
-        )
-        staff_sheet.add_data_validation(overhead_validation)
-        
-        extra_validation = None
-        if extra_category and extra_category.get('options'):
-            options = [opt for opt in extra_category['options'] if opt.strip()]
-            if options:
-                extra_validation = DataValidation(
-                    type="list",
-                    formula1=f'"{",".join(options)}"',
-                    allow_blank=True
-                )
-                staff_sheet.add_data_validation(extra_validation)
+    def generate_excel(self, config, options=None):
+        """Build the workbook for config on the server's generation pool and send it"""
+        cache = getattr(self.server, 'workbook_cache', None)
+        options = options or OutputOptions()
+        key = workbook_cache_key(config, options)
+        # Validated and checked against the budgets first, so a bad or oversized config gets
+        # a 400 before any of the response is sent, even when a copy is cached or the client
+        # holds one from before the rules changed
+        model = compile_config(config)
+        options = budget_options(model, options)
         
-        # Add employee rows
-        current_row = 2
-        employee_counts = config.get('employeeCounts', {})
-        
-        for team in selected_teams:
-            count = employee_counts.get(team, 0)
-            if count == 0:
-                continue
-            
-            team_abbr = ''.join([word[0].upper() for word in team.split()])
-            
-            for emp_num in range(1, count + 1):
-                # Position
-                staff_sheet.cell(row=current_row, column=1, value=f'{team_abbr} Employee {emp_num}')
-                
-                # Team with dropdown
-                team_cell = staff_sheet.cell(row=current_row, column=2, value=team)
-                team_validation.add(team_cell)
-                
-                # Type with dropdown
-                type_cell = staff_sheet.cell(row=current_row, column=3, value='PAYE')
-                type_validation.add(type_cell)
-                
-                # Direct/Overhead with dropdown
-                overhead_cell = staff_sheet.cell(row=current_row, column=4, value='OVERHEAD')
-                overhead_validation.add(overhead_cell)
-                
-                col = 5
-                
-                # Extra category column
-                if extra_category and extra_category.get('name'):
-                    extra_cell = staff_sheet.cell(row=current_row, column=col, value='')
-                    if extra_validation:
-                        extra_validation.add(extra_cell)
-                    col += 1
-                
-                # Annual Salary
-                salary_col_letter = chr(64 + col)
-                staff_sheet.cell(row=current_row, column=col, value=0)
-                staff_sheet.cell(row=current_row, column=col).number_format = '£#,##0'
-                col += 1
-                
-                # Monthly salary columns
-                for month_idx in range(48):
-                    formula = f'={salary_col_letter}{current_row}/12'
-                    cell = staff_sheet.cell(row=current_row, column=col + month_idx, value=formula)
-                    cell.number_format = '£#,##0'
-                
-                current_row += 1
+        # The key is derived from everything that shapes the file, so it doubles as the ETag
+        if self._etag_matches(key):
+            self.send_response(304)
+            self.send_header('ETag', f'"{key}"')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
         
-        # Add TOTAL row
-        total_row = current_row
-        total_cell = staff_sheet.cell(row=total_row, column=1, value='TOTAL')
-        total_cell.font = Font(bold=True, size=11)
-        
-        first_month_col = 6
-        if extra_category and extra_category.get('name'):
-            first_month_col = 7
-        
-        for month_idx in range(48):
-            col_num = first_month_col + month_idx
-            if col_num <= 26:
-                col_letter = chr(64 + col_num)
-            else:
-                col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-            
-            formula = f'=SUM({col_letter}2:{col_letter}{current_row - 1})'
-            cell = staff_sheet.cell(row=total_row, column=first_month_col + month_idx, value=formula)
-            cell.font = Font(bold=True)
-            cell.number_format = '£#,##0'
+        data = cache.get(key) if cache is not None else None
+        if data is not None:
+            self._send_workbook_headers(len(data), key, 'HIT', options.output_format)
+            self._write_body(data)
+            return
         
-        # Freeze panes at C2 (freezes columns A & B, and row 1)
-        staff_sheet.freeze_panes = 'C2'
+        capture_limit = cache.max_bytes if cache is not None else 0
+        pool = getattr(self.server, 'generation_pool', None)
+        if pool is None:
+            data = self._send_workbook_inline(model, options, key, capture_limit)
+        elif pool.inline:
+            data = pool.run(self._send_workbook_inline, model, options, key, capture_limit)
+        else:
+            # A simulation's chunks go over the workers first, then the build takes one of them
+            started = time.perf_counter()
+            simulation = simulate_on_pool(model, pool)
+            simulated = time.perf_counter() - started
+            data, timings = pool.run(render_workbook_timed, model, options, None, simulation)
+            if simulation is not None:
+                timings['simulation'] += simulated
+            record_build_metrics(model.sales_model, timings, len(data))
+            self._send_workbook_headers(len(data), key, 'MISS', options.output_format)
+            self._write_body(data)
         
-        # === SALES TAB ===
-        sales_sheet = workbook.create_sheet('Sales', 0)  # Make it first tab
+        if cache is not None and data is not None:
+            cache.put(key, data)
+    
+    def generate_excel_profiled(self, config, options):
+        """Build and send the workbook in this thread under cProfile and tracemalloc, then save the capture.
         
-        sales_model = config.get('salesModel')
-        sales_items = config.get('salesItems', [])
+        The cache and worker processes are bypassed so the profile shows the whole build, but the
+        build still holds a pool slot so profiled requests count against the concurrency cap.
+        """
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            # Another capture is running; serve this request normally
+            self.generate_excel(config, options)
+            return
+        pool = getattr(self.server, 'generation_pool', None)
+        try:
+            # Raises GenerationQueueFull (a 503) like any other build when the pool is full
+            held = pool.reserve(1) if pool is not None else 0
+        except GenerationQueueFull:
+            _PROFILE_LOCK.release()
+            raise
+        try:
+            import cProfile
+            import tracemalloc
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                self._send_workbook_inline(config, options)
+            finally:
+                profiler.disable()
+                elapsed = time.perf_counter() - started
+                snapshot = tracemalloc.take_snapshot()
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            capture_id = save_profile_capture(profiler, snapshot, peak_bytes, elapsed, config, options)
+            print(f"Saved profile capture {capture_id} ({elapsed:.2f}s)")
+        finally:
+            if held:
+                pool.release(held)
+            _PROFILE_LOCK.release()
+    
+    def generate_batch(self, configs, options):
+        """Build configs in parallel and stream them back as one ZIP, each entry as soon as it is ready"""
+        cache = getattr(self.server, 'workbook_cache', None)
+        pool = getattr(self.server, 'generation_pool', None) or GenerationPool(0, 0)
+        width = len(str(len(configs)))
+        names = [f'business_model_{idx + 1:0{width}d}' for idx in range(len(configs))]
+        manifest = [None] * len(configs)
         
-        if sales_model == 'custom':
-            # Custom model: Item, Description 1, Description 2
-            custom_headers = ['Item', 'Description 1', 'Description 2'] + month_headers
-            for col_idx, header in enumerate(custom_headers, 1):
-                cell = sales_sheet.cell(row=1, column=col_idx, value=header)
-                cell.font = Font(bold=True, size=11)
-                cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            sales_sheet.column_dimensions['A'].width = 30
-            sales_sheet.column_dimensions['B'].width = 25
-            sales_sheet.column_dimensions['C'].width = 25
-            
-            sales_sheet.cell(row=2, column=1, value='[Add your sales items here]')
-            sales_sheet.freeze_panes = 'B2'
-            
-        elif sales_items:
-            # Generate model-specific sales tab
-            row_num = 1
-            
-            # REVENUE SECTION HEADER
-            revenue_header = sales_sheet.cell(row=row_num, column=1, value='REVENUE')
-            revenue_header.font = Font(bold=True, size=12)
-            revenue_header.fill = PatternFill(start_color='B4C7E7', end_color='B4C7E7', fill_type='solid')
-            sales_sheet.merge_cells(f'A{row_num}:D{row_num}')
-            row_num += 1
-            
-            # Headers row
-            headers = ['Item', 'Type', 'Unit Price', 'Growth %'] + month_headers
-            for col_idx, header in enumerate(headers, 1):
-                cell = sales_sheet.cell(row=row_num, column=col_idx, value=header)
-                cell.font = Font(bold=True, size=11)
-                cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            row_num += 1
-            
-            # Set column widths
-            sales_sheet.column_dimensions['A'].width = 30
-            sales_sheet.column_dimensions['B'].width = 20
-            sales_sheet.column_dimensions['C'].width = 18
-            sales_sheet.column_dimensions['D'].width = 12
-            
-            revenue_start_row = row_num
-            
-            # Pre-calculate where volume section will start
-            # After all revenue items + TOTAL row + 2 blanks + VOLUME header + Volume headers
-            volume_section_start_row = revenue_start_row + len(sales_items) + 1 + 2 + 1 + 1
-            
-            # Helper to safely convert to float
-            def to_float(val):
-                if val is None or val == '':
-                    return 0
-                return float(val)
-            
-            # Store item info for VOLUME and COGS sections
-            items_info = []
+        # Raises GenerationQueueFull before anything is sent if no worker slot is free
+        held = pool.reserve(BATCH_PARALLELISM)
+        try:
+            chunked = self.request_version == 'HTTP/1.1'
+            if chunked:
+                self.protocol_version = 'HTTP/1.1'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Disposition', 'attachment; filename="business_models.zip"')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('Connection', 'close')
+            self.end_headers()
             
-            # Add revenue items
-            for item in sales_items:
-                item_name = item.get('productName') or item.get('serviceName') or item.get('planName') or \
-                           item.get('transactionType') or item.get('productLine') or item.get('usageMetric') or \
-                           item.get('streamName', 'Item')
-                
-                # Extract pricing info
-                price = to_float(item.get('unitPrice')) or to_float(item.get('pricePerUnit')) or \
-                       to_float(item.get('hourlyRate')) or to_float(item.get('monthlyPrice')) or 0
-                
-                # Extract volume info
-                start_val = to_float(item.get('startingUnits')) or to_float(item.get('startingHours')) or \
-                           to_float(item.get('startingSubscribers')) or to_float(item.get('startingGMV')) or \
-                           to_float(item.get('startingVolume')) or 0
-                
-                # Extract growth
-                growth = to_float(item.get('monthlyGrowth')) or to_float(item.get('growthRate')) or 0
-                
-                # Store for later sections
-                items_info.append({
-                    'name': item_name,
-                    'model': sales_model,
-                    'price': price,
-                    'start_volume': start_val,
-                    'growth': growth / 100,
-                    'item_data': item
-                })
-                
-                sales_sheet.cell(row=row_num, column=1, value=item_name)
-                sales_sheet.cell(row=row_num, column=2, value=sales_model.upper())
-                sales_sheet.cell(row=row_num, column=3, value=price)
-                sales_sheet.cell(row=row_num, column=3).number_format = '£#,##0'
-                sales_sheet.cell(row=row_num, column=4, value=growth / 100)
-                sales_sheet.cell(row=row_num, column=4).number_format = '0.0%'
-                
-                # Revenue formulas: will reference volume section
-                volume_row_offset = row_num - revenue_start_row
-                
-                for month_idx in range(48):
-                    col_num = 5 + month_idx
-                    if col_num <= 26:
-                        col_letter = chr(64 + col_num)
+            writer = ChunkedWriter(self.wfile) if chunked else self.wfile
+            # Workbooks (and CSV archives) are zip files already, so entries are stored rather than compressed again
+            with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as archive:
+                def add_entry(idx, data, error):
+                    if error is None:
+                        archive.writestr(f'{names[idx]}.{options.extension}', data)
+                        manifest[idx] = {'file': f'{names[idx]}.{options.extension}', 'status': 'ok'}
                     else:
-                        col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-                    
-                    # Formula: Volume × Price
-                    # Reference the volume cell in the VOLUME section
-                    volume_row_ref = volume_section_start_row + volume_row_offset
-                    formula = f'={col_letter}{volume_row_ref}*C{row_num}'
-                    
-                    cell = sales_sheet.cell(row=row_num, column=col_num, value=formula)
-                    cell.number_format = '£#,##0'
-                
-                row_num += 1
-            
-            # TOTAL REVENUE row
-            total_rev_row = row_num
-            total_cell = sales_sheet.cell(row=total_rev_row, column=1, value='TOTAL REVENUE')
-            total_cell.font = Font(bold=True, size=11)
-            
-            for month_idx in range(48):
-                col_num = 5 + month_idx
-                if col_num <= 26:
-                    col_letter = chr(64 + col_num)
-                else:
-                    col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-                
-                formula = f'=SUM({col_letter}{revenue_start_row}:{col_letter}{row_num - 1})'
-                cell = sales_sheet.cell(row=total_rev_row, column=col_num, value=formula)
-                cell.font = Font(bold=True)
-                cell.number_format = '£#,##0'
-            
-            row_num += 2
-            
-            # ===== VOLUME SECTION =====
-            volume_header = sales_sheet.cell(row=row_num, column=1, value='VOLUME (UNITS / SUBSCRIBERS)')
-            volume_header.font = Font(bold=True, size=12)
-            volume_header.fill = PatternFill(start_color='FFF2CC', end_color='FFF2CC', fill_type='solid')
-            sales_sheet.merge_cells(f'A{row_num}:D{row_num}')
-            row_num += 1
-            
-            # Volume headers (no date headers - those are only in REVENUE section)
-            vol_headers = ['Item', 'Type', 'Starting Volume', 'Growth %'] + [''] * 48  # Empty headers for month columns
-            for col_idx, header in enumerate(vol_headers, 1):
-                cell = sales_sheet.cell(row=row_num, column=col_idx, value=header)
-                cell.font = Font(bold=True, size=11)
-                cell.fill = PatternFill(start_color='FFE699', end_color='FFE699', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            row_num += 1
-            
-            volume_start_row = row_num
-            
-            # Add volume items
-            for info in items_info:
-                sales_sheet.cell(row=row_num, column=1, value=info['name'])
-                sales_sheet.cell(row=row_num, column=2, value=info['model'].upper())
-                sales_sheet.cell(row=row_num, column=3, value=info['start_volume'])
-                sales_sheet.cell(row=row_num, column=3).number_format = '#,##0'
-                sales_sheet.cell(row=row_num, column=4, value=info['growth'])
-                sales_sheet.cell(row=row_num, column=4).number_format = '0.0%'
+                        error_file = f'{names[idx]}.error.json'
+                        archive.writestr(error_file, json.dumps({'error': str(error)}))
+                        manifest[idx] = {'file': error_file, 'status': 'error', 'error': str(error)}
+                        self._record_error(error)
+                        print(f"Error generating batch workbook {idx + 1}: {error}")
                 
-                # Monthly volume calculations - EDITABLE cells with formulas as starting point
-                for month_idx in range(48):
-                    col_num = 5 + month_idx
-                    
-                    if sales_model == 'saas':
-                        # SaaS: handle churn
-                        item_data = info['item_data']
-                        churn = float(item_data.get('churnRate', 0)) / 100
-                        growth_rate = float(item_data.get('growthRate', 0)) / 100
-                        
-                        if month_idx == 0:
-                            # Month 1: just starting value
-                            value = info['start_volume']
-                        else:
-                            # Previous month adjusted for churn and growth
-                            prev_col = chr(64 + col_num - 1) if col_num - 1 <= 26 else \
-                                      chr(64 + (col_num - 2) // 26) + chr(65 + (col_num - 2) % 26)
-                            formula = f'={prev_col}{row_num}*(1-{churn})*(1+{growth_rate})'
-                            cell = sales_sheet.cell(row=row_num, column=col_num, value=formula)
-                            cell.number_format = '#,##0'
+                # Cached workbooks go out first, the rest as their builds finish
+                keys = [workbook_cache_key(config, options) for config in configs]
+                to_build = []
+                for idx, key in enumerate(keys):
+                    data = cache.get(key) if cache is not None else None
+                    if data is not None:
+                        # A cached copy is only sent for a config that a fresh build would accept
+                        try:
+                            budget_options(compile_config(configs[idx]), options)
+                        except ConfigError as e:
+                            add_entry(idx, None, e)
                             continue
+                        add_entry(idx, data, None)
                     else:
-                        # Standard growth model
-                        if month_idx == 0:
-                            value = info['start_volume']
-                        else:
-                            formula = f'=C{row_num}*POWER(1+D{row_num},{month_idx})'
-                            cell = sales_sheet.cell(row=row_num, column=col_num, value=formula)
-                            cell.number_format = '#,##0'
-                            continue
-                    
-                    # For month 0, set value directly
-                    cell = sales_sheet.cell(row=row_num, column=col_num, value=value)
-                    cell.number_format = '#,##0'
-                
-                row_num += 1
-            
-            # TOTAL VOLUME row
-            total_vol_row = row_num
-            total_vol_cell = sales_sheet.cell(row=total_vol_row, column=1, value='TOTAL VOLUME')
-            total_vol_cell.font = Font(bold=True, size=11)
-            
-            for month_idx in range(48):
-                col_num = 5 + month_idx
-                if col_num <= 26:
-                    col_letter = chr(64 + col_num)
-                else:
-                    col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-                
-                formula = f'=SUM({col_letter}{volume_start_row}:{col_letter}{row_num - 1})'
-                cell = sales_sheet.cell(row=total_vol_row, column=col_num, value=formula)
-                cell.font = Font(bold=True)
-                cell.number_format = '#,##0'
-            
-            row_num += 2
-            
-            # COGS SECTION HEADER
-            cogs_header = sales_sheet.cell(row=row_num, column=1, value='COST OF GOODS SOLD (COGS)')
-            cogs_header.font = Font(bold=True, size=12)
-            cogs_header.fill = PatternFill(start_color='F4B084', end_color='F4B084', fill_type='solid')
-            sales_sheet.merge_cells(f'A{row_num}:D{row_num}')
-            row_num += 1
-            
-            # COGS headers (no date headers - those are only in REVENUE section)
-            cogs_headers = ['Item', 'Type', 'Unit Cost', 'Growth %'] + [''] * 48  # Empty headers for month columns
-            for col_idx, header in enumerate(cogs_headers, 1):
-                cell = sales_sheet.cell(row=row_num, column=col_idx, value=header)
-                cell.font = Font(bold=True, size=11)
-                cell.fill = PatternFill(start_color='FCE4D6', end_color='FCE4D6', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            row_num += 1
-            
-            cogs_start_row = row_num
-            
-            # Add COGS items - reference volume section
-            for idx, info in enumerate(items_info):
-                sales_sheet.cell(row=row_num, column=1, value=f"{info['name']} - COGS")
-                sales_sheet.cell(row=row_num, column=2, value='COGS')
-                
-                # Extract cost per unit
-                item_data = info['item_data']
-                
-                # Calculate cost - different models use different fields
-                cost = (to_float(item_data.get('costPerUnit')) or 
-                       to_float(item_data.get('deliveryCost')) or 
-                       to_float(item_data.get('costPerSubscriber')) or 
-                       (to_float(item_data.get('materialCost')) + 
-                        to_float(item_data.get('laborCost')) + 
-                        to_float(item_data.get('overheadCost'))) or 
-                       to_float(item_data.get('cost')))
-                
-                sales_sheet.cell(row=row_num, column=3, value=cost)
-                sales_sheet.cell(row=row_num, column=3).number_format = '£#,##0'
-                sales_sheet.cell(row=row_num, column=4, value=info['growth'])
-                sales_sheet.cell(row=row_num, column=4).number_format = '0.0%'
-                
-                # COGS formulas: Volume × Cost per unit
-                # Reference the corresponding volume row
-                volume_row_ref = volume_start_row + idx
-                
-                for month_idx in range(48):
-                    col_num = 5 + month_idx
-                    if col_num <= 26:
-                        col_letter = chr(64 + col_num)
-                    else:
-                        col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-                    
-                    # Formula: Volume × Cost
-                    formula = f'={col_letter}{volume_row_ref}*C{row_num}'
-                    cell = sales_sheet.cell(row=row_num, column=col_num, value=formula)
-                    cell.number_format = '£#,##0'
-                
-                row_num += 1
-            
-            # TOTAL COGS row
-            total_cogs_row = row_num
-            total_cogs_cell = sales_sheet.cell(row=total_cogs_row, column=1, value='TOTAL COGS')
-            total_cogs_cell.font = Font(bold=True, size=11)
-            
-            for month_idx in range(48):
-                col_num = 5 + month_idx
-                if col_num <= 26:
-                    col_letter = chr(64 + col_num)
-                else:
-                    col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
+                        to_build.append(idx)
                 
-                formula = f'=SUM({col_letter}{cogs_start_row}:{col_letter}{row_num - 1})'
-                cell = sales_sheet.cell(row=total_cogs_row, column=col_num, value=formula)
-                cell.font = Font(bold=True)
-                cell.number_format = '£#,##0'
-            
-            row_num += 2
-            
-            # GROSS PROFIT row
-            gross_profit_row = row_num
-            gp_cell = sales_sheet.cell(row=gross_profit_row, column=1, value='GROSS PROFIT')
-            gp_cell.font = Font(bold=True, size=12, color='00B050')
-            gp_cell.fill = PatternFill(start_color='E2EFDA', end_color='E2EFDA', fill_type='solid')
-            
-            for month_idx in range(48):
-                col_num = 5 + month_idx
-                if col_num <= 26:
-                    col_letter = chr(64 + col_num)
-                else:
-                    col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
+                # A workbook's simulation runs inside its build: the batch already keeps the workers busy
+                builds = pool.map_unordered(render_workbook_timed, [(configs[idx], options) for idx in to_build], held)
+                for position, result, error in builds:
+                    idx = to_build[position]
+                    data = None
+                    if error is None:
+                        data, timings = result
+                        record_build_metrics(configs[idx].get('salesModel'), timings, len(data))
+                    add_entry(idx, data, error)
+                    if error is None and cache is not None:
+                        cache.put(keys[idx], data)
                 
-                formula = f'={col_letter}{total_rev_row}-{col_letter}{total_cogs_row}'
-                cell = sales_sheet.cell(row=gross_profit_row, column=col_num, value=formula)
-                cell.font = Font(bold=True, color='00B050')
-                cell.fill = PatternFill(start_color='E2EFDA', end_color='E2EFDA', fill_type='solid')
-                cell.number_format = '£#,##0'
-            
-            sales_sheet.freeze_panes = 'E3'
-        
+                archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+            if chunked:
+                writer.close()
+        except Exception as e:
+            # Headers are out: drop the connection so the archive is visibly incomplete
+            self.close_connection = True
+            self._record_error(e)
+            print(f"Error streaming batch: {e}")
+        finally:
+            pool.release(held)
+    
+    def _etag_matches(self, key):
+        if_none_match = self.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or f'"{key}"' in tags or f'W/"{key}"' in tags
+    
+    def _send_workbook_headers(self, content_length=None, key=None, cache_status=None, output_format='xlsx'):
+        """Start a workbook download, chunked when the length is not known yet"""
+        if content_length is None:
+            # Chunked transfer encoding needs an HTTP/1.1 status line
+            self.protocol_version = 'HTTP/1.1'
+        extension, content_type = OUTPUT_FORMATS[output_format]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', f'attachment; filename="business_model.{extension}"')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if key:
+            self.send_header('ETag', f'"{key}"')
+        if cache_status:
+            self.send_header('X-Cache', cache_status)
+        if content_length is None:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('Connection', 'close')
         else:
-            # Empty template if no items
-            empty_headers = ['Item'] + month_headers
-            for col_idx, header in enumerate(empty_headers, 1):
-                cell = sales_sheet.cell(row=1, column=col_idx, value=header)
-                cell.font = Font(bold=True, size=11)
-                cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            sales_sheet.column_dimensions['A'].width = 30
-            sales_sheet.cell(row=2, column=1, value='[Add your sales items here]')
-            sales_sheet.freeze_panes = 'B2'
-        
-        # === NON-STAFF TAB ===
-        non_staff_sheet = workbook.create_sheet('Non-Staff')
-        
-        # Headers with Category and Annual Cost columns
-        ns_headers = ['Item', 'Category', 'Annual Cost'] + month_headers
-        for col_idx, header in enumerate(ns_headers, 1):
-            cell = non_staff_sheet.cell(row=1, column=col_idx, value=header)
-            cell.font = Font(bold=True, size=11)
-            cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        non_staff_sheet.column_dimensions['A'].width = 40
-        non_staff_sheet.column_dimensions['B'].width = 30
-        non_staff_sheet.column_dimensions['C'].width = 15
-        for i in range(48):
-            col_num = i + 4
-            if col_num <= 26:
-                col_letter = chr(64 + col_num)
-            else:
-                col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-            non_staff_sheet.column_dimensions[col_letter].width = 12
-        
-        # Add selected non-staff items
-        non_staff_items = config.get('nonStaffItems', {})
-        non_staff_quantities = config.get('nonStaffQuantities', {})
+            self.send_header('Content-Length', str(content_length))
+        self.end_headers()
+    
+    def _send_workbook_inline(self, config, options, key=None, capture_limit=0):
+        """Build the workbook in this thread, streaming it straight to the client when possible.
         
-        current_ns_row = 2
+        Returns the workbook bytes if they fit in capture_limit, for caching.
+        """
+        model = compile_config(config)
+        options = budget_options(model, options)
+        if options.streamed and self.request_version == 'HTTP/1.1':
+            # Rows go out as they are written, so nothing is buffered beyond one chunk
+            self._send_workbook_headers(None, key, 'MISS', options.output_format)
+            writer = ChunkedWriter(self.wfile)
+            capture = CapturingWriter(writer, capture_limit)
+            timings = {}
+            try:
+                # Writes go to the client as the tabs are built, so tab times include them
+                build_workbook(model, capture, options, timings)
+                writer.close()
+            except Exception as e:
+                # Too late for an error status: drop the connection so the download is incomplete
+                self.close_connection = True
+                self._record_error(e)
+                print(f"Error generating Excel: {e}")
+                return None
+            record_build_metrics(model.sales_model, timings, capture.size)
+            return capture.getvalue()
         
-        if non_staff_items:
-            for item_key, is_selected in non_staff_items.items():
-                if is_selected:
-                    category, item = item_key.split('|', 1)
-                    quantity = non_staff_quantities.get(item_key, 1)
-                    
-                    # Remove emoji from category for cleaner display
-                    clean_category = category.split(' ', 1)[1] if ' ' in category else category
-                    
-                    for i in range(1, quantity + 1):
-                        # Item name (add quantity suffix if > 1)
-                        item_name = f"{item} {i}" if quantity > 1 else item
-                        non_staff_sheet.cell(row=current_ns_row, column=1, value=item_name)
-                        
-                        # Category
-                        non_staff_sheet.cell(row=current_ns_row, column=2, value=clean_category)
-                        
-                        # Annual Cost (default 0)
-                        non_staff_sheet.cell(row=current_ns_row, column=3, value=0)
-                        non_staff_sheet.cell(row=current_ns_row, column=3).number_format = '£#,##0'
-                        
-                        # Monthly columns (formula: Annual/12)
-                        for month_idx in range(48):
-                            formula = f'=C{current_ns_row}/12'
-                            cell = non_staff_sheet.cell(row=current_ns_row, column=4 + month_idx, value=formula)
-                            cell.number_format = '£#,##0'
-                        
-                        current_ns_row += 1
-            
-            # Add TOTAL row
-            total_ns_row = current_ns_row
-            total_ns_cell = non_staff_sheet.cell(row=total_ns_row, column=1, value='TOTAL')
-            total_ns_cell.font = Font(bold=True, size=11)
-            
-            for month_idx in range(48):
-                col_num = 4 + month_idx
-                if col_num <= 26:
-                    col_letter = chr(64 + col_num)
-                else:
-                    col_letter = chr(64 + (col_num - 1) // 26) + chr(65 + (col_num - 1) % 26)
-                
-                formula = f'=SUM({col_letter}2:{col_letter}{current_ns_row - 1})'
-                cell = non_staff_sheet.cell(row=total_ns_row, column=col_num, value=formula)
-                cell.font = Font(bold=True)
-                cell.number_format = '£#,##0'
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as buffer:
+            timings = {}
+            build_workbook(model, buffer, options, timings)
+            content_length = buffer.tell()
+            record_build_metrics(model.sales_model, timings, content_length)
+            buffer.seek(0)
+            self._send_workbook_headers(content_length, key, 'MISS', options.output_format)
+            if content_length <= capture_limit:
+                data = buffer.read()
+                self._write_body(data)
+                return data
+            started = time.perf_counter()
+            shutil.copyfileobj(buffer, self.wfile, RESPONSE_CHUNK_SIZE)
+            METRICS.observe('bdb_generation_phase_seconds', time.perf_counter() - started,
+                            phase='response_write', sales_model='')
+            return None
+    
+    def _write_body(self, data):
+        started = time.perf_counter()
+        self.wfile.write(data)
+        METRICS.observe('bdb_generation_phase_seconds', time.perf_counter() - started,
+                        phase='response_write', sales_model='')
+    
+    def _record_error(self, error):
+        METRICS.inc('bdb_errors_total', route=self._metric_route(), type=type(error).__name__)
+    
+    def _metric_route(self):
+        path = urlparse(self.path).path
+        if path.startswith('/jobs/'):
+            return '/jobs/{id}/result' if path.endswith('/result') else '/jobs/{id}'
+        return path if path in METRIC_ROUTES else 'other'
+    
+    def handle_one_request(self):
+        """Handle a request and record its count, latency and errors in METRICS"""
+        self._request_started = None
+        self._response_status = None
+        try:
+            super().handle_one_request()
+        except Exception as e:
+            if self._request_started is not None:
+                self._record_error(e)
+            raise
+        finally:
+            if self._request_started is not None:
+                METRICS.inc('bdb_http_requests_in_flight', -1)
+                route = self._metric_route()
+                METRICS.inc('bdb_http_requests_total', route=route, method=self.command,
+                            status=self._response_status or 'none')
+                METRICS.observe('bdb_http_request_duration_seconds',
+                                time.perf_counter() - self._request_started, route=route)
+    
+    def parse_request(self):
+        # Timing starts once a request line has arrived, not while a kept-alive connection idles
+        parsed = super().parse_request()
+        if parsed:
+            self._request_started = time.perf_counter()
+            METRICS.inc('bdb_http_requests_in_flight')
+            count_request = getattr(self.server, 'count_request', None)
+            if count_request is not None:
+                count_request()
+        return parsed
+    
+    def send_response(self, code, message=None):
+        self._response_status = code
+        super().send_response(code, message)
+
+
+# === WORKBOOK LAYOUT ===
+# Each tab is described by a SheetPlan: its layout (column widths, frozen panes,
+# merged ranges, dropdowns) plus a generator that yields its rows in order.
+# A row is a list of cells, a cell is None (empty) or a (value, style) tuple.
+# Both output engines consume the same plans, so they produce the same workbook.
+
+# Forecast timeline: period length and horizon, unless a config sets 'granularity' and
+# 'forecastPeriods'. Granularity -> periods per year.
+GRANULARITIES = {'monthly': 12, 'weekly': 52}
+FORECAST_GRANULARITY = os.environ.get('FORECAST_GRANULARITY', 'monthly')
+FORECAST_YEARS = int(os.environ.get('FORECAST_YEARS', 4))
+# 25 years of weeks; Excel allows 16,384 columns
+MAX_FORECAST_PERIODS = 1300
+
+# Blank Staff rows carrying the dropdowns and formulas, for staff added in Excel
+STAFF_SPARE_ROWS = int(os.environ.get('STAFF_SPARE_ROWS', 0))
+MAX_STAFF_SPARE_ROWS = 1000
+
+# Prefix for the style names shown in Excel's Cell Styles gallery
+STYLE_NAME_PREFIX = 'BDB '
+
+# House style: named cell styles, registered once per workbook and applied to
+# cells by name. Change the look of every generated workbook here.
+CELL_STYLES = {
+    'header': {'font': {'bold': True, 'size': 11}, 'fill': 'D9E1F2', 'center': True},
+    'revenue_banner': {'font': {'bold': True, 'size': 12}, 'fill': 'B4C7E7'},
+    'volume_banner': {'font': {'bold': True, 'size': 12}, 'fill': 'FFF2CC'},
+    'volume_header': {'font': {'bold': True, 'size': 11}, 'fill': 'FFE699', 'center': True},
+    'cogs_banner': {'font': {'bold': True, 'size': 12}, 'fill': 'F4B084'},
+    'cogs_header': {'font': {'bold': True, 'size': 11}, 'fill': 'FCE4D6', 'center': True},
+    'total_label': {'font': {'bold': True, 'size': 11}},
+    'total_currency': {'font': {'bold': True}, 'number_format': '£#,##0'},
+    'total_count': {'font': {'bold': True}, 'number_format': '#,##0'},
+    'gross_profit_label': {'font': {'bold': True, 'size': 12, 'color': '00B050'}, 'fill': 'E2EFDA'},
+    'gross_profit': {'font': {'bold': True, 'color': '00B050'}, 'fill': 'E2EFDA', 'number_format': '£#,##0'},
+    'currency': {'number_format': '£#,##0'},
+    'percent': {'number_format': '0.0%'},
+    'count': {'number_format': '#,##0'},
+}
+
+
+def _column_address(col_num):
+    """Convert a 1-based column number to its letters (1 -> A, 27 -> AA, 703 -> AAA)"""
+    letters = ''
+    while col_num > 0:
+        col_num, remainder = divmod(col_num - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+# Letters of every column a sheet can use at the longest horizon, indexed by column number
+_COLUMN_LETTERS = tuple(_column_address(col_num) for col_num in range(MAX_FORECAST_PERIODS + 16))
+
+
+def _column_letter(col_num):
+    """Letters of a 1-based column number, from the precomputed table"""
+    if col_num < len(_COLUMN_LETTERS):
+        return _COLUMN_LETTERS[col_num]
+    return _column_address(col_num)
+
+
+def _to_float(val):
+    """Safely convert a questionnaire answer to float"""
+    if val is None or val == '':
+        return 0
+    return float(val)
+
+
+class ListValidation:
+    """Dropdown of fixed options over rows first_row..last_row of one column"""
+
+    def __init__(self, options, column, first_row, last_row, allow_blank=False):
+        self.formula1 = f'"{",".join(options)}"'
+        self.column = column
+        self.first_row = first_row
+        self.last_row = last_row
+        self.allow_blank = allow_blank
+
+    @property
+    def sqref(self):
+        return f'{self.column}{self.first_row}:{self.column}{self.last_row}'
+
+
+class SheetPlan:
+    """Layout and rows of one worksheet, independent of the output engine.
+    
+    skeleton, if given, is the cached SheetSkeleton the layout came from (see sheet_skeleton).
+    """
+
+    def __init__(self, title, rows, column_widths=None, freeze_panes=None,
+                 merged_cells=None, validations=None, skeleton=None):
+        self.title = title
+        self.rows = rows
+        self.column_widths = column_widths or {}
+        self.freeze_panes = freeze_panes
+        self.merged_cells = merged_cells or []
+        self.validations = validations or []
+        self.skeleton = skeleton
+
+
+class SharedFormula:
+    """Cell of a shared formula group. The group's first cell (the master) carries the
+    formula and the range it covers, every other cell only carries the group id."""
+
+    __slots__ = ('si', 'text', 'ref')
+
+    def __init__(self, si, text=None, ref=None):
+        self.si = si
+        self.text = text
+        self.ref = ref
+
+
+def _shared_block(group_ids, first_row_formulas, col_letters, first_row, last_row, style):
+    """Cells for a block where each column repeats one formula down rows first_row..last_row.
+
+    Returns the cells of the first row (the group masters) and the cells shared by every later row.
+    """
+    masters = []
+    followers = []
+    for formula, col_letter in zip(first_row_formulas, col_letters):
+        si = next(group_ids)
+        masters.append((SharedFormula(si, formula, f'{col_letter}{first_row}:{col_letter}{last_row}'), style))
+        followers.append((SharedFormula(si), style))
+    return masters, followers
+
+
+def _shared_row(group_ids, formula, col_letters, row_num, style):
+    """Cells for a row repeating one formula across col_letters, e.g. a TOTAL row"""
+    si = next(group_ids)
+    ref = f'{col_letters[0]}{row_num}:{col_letters[-1]}{row_num}'
+    return [(SharedFormula(si, formula, ref), style)] + [(SharedFormula(si), style)] * (len(col_letters) - 1)
+
+
+def _with_values(cells, values):
+    """Formula cells with their precomputed results attached as a third spec element"""
+    return [(value, style, cached) for (value, style), cached in zip(cells, values)]
+
+
+def _cost_rows(annual_costs, timeline):
+    """Annual cost / periods per year for every row (rows x periods), as the Staff and Non-Staff formulas give"""
+    import numpy
+    annual = numpy.asarray(annual_costs, dtype=float).reshape(-1)
+    return numpy.repeat((annual / timeline.periods_per_year)[:, None], timeline.periods, axis=1)
+
+
+def _cost_projection(annual_costs, timeline):
+    """Annual cost per period for every row plus the TOTAL row, computed in one batch"""
+    per_period = _cost_rows(annual_costs, timeline)
+    return per_period.tolist(), per_period.sum(axis=0).tolist()
+
+
+def _sales_volumes(items, sales_model, timeline, first_volumes=None):
+    """Volume (items x periods) the VOLUME formulas produce.
+    
+    first_volumes replaces the first period where the workbook holds it as a plain value
+    (monthly, and SaaS at any granularity); by default it is each item's starting volume.
+    """
+    import numpy
+    periods = timeline.periods
+    scaled = timeline.months_per_period is not None
+    start = numpy.array([item.start_volume for item in items], dtype=float)
+    first = start if first_volumes is None else numpy.asarray(first_volumes, dtype=float)
+
+    volume = numpy.empty((len(items), periods))
+    if sales_model == 'saas':
+        # Subscribers are a stock: the count carries over, only the rates are scaled
+        churn = numpy.array([item.churn for item in items])
+        growth = numpy.array([item.growth_rate for item in items])
+        volume[:, 0] = first
+        # Same evaluation order as the chained formula, so the values match Excel's
+        step = numpy.power((1 - churn) * (1 + growth), 12 / timeline.periods_per_year) if scaled else None
+        for period_idx in range(1, periods):
+            if scaled:
+                volume[:, period_idx] = volume[:, period_idx - 1] * step
+            else:
+                volume[:, period_idx] = volume[:, period_idx - 1] * (1 - churn) * (1 + growth)
+    else:
+        growth = numpy.array([item.growth for item in items], dtype=float)
+        if scaled:
+            # Volumes are per month: a period sells its share, growing by elapsed months
+            elapsed = numpy.arange(0, periods) * 12 / timeline.periods_per_year
+            volume[:] = start[:, None] * 12 / timeline.periods_per_year * numpy.power(1 + growth[:, None], elapsed)
         else:
-            # Empty template
-            non_staff_sheet.cell(row=2, column=1, value='[Add your non-staff costs here]')
-        
-        non_staff_sheet.freeze_panes = 'B2'
-        
-        # Save to temp file
-        filepath = '/tmp/business_model.xlsx'
-        workbook.save(filepath)
-        return filepath
+            volume[:, 0] = first
+            volume[:, 1:] = start[:, None] * numpy.power(1 + growth[:, None], numpy.arange(1, periods))
+    return volume
+
+
+def _sales_amounts(volume, unit_amounts, sales_model, timeline):
+    """Revenue or COGS rows: volume x unit price or cost"""
+    import numpy
+    amounts = volume * numpy.asarray(unit_amounts, dtype=float)[:, None]
+    if timeline.months_per_period is not None and sales_model == 'saas':
+        # Monthly price and cost per subscriber, charged for the period's share of a month
+        amounts = amounts * 12 / timeline.periods_per_year
+    return amounts
+
+
+def _sales_projection(items, sales_model, timeline):
+    """Volume, revenue and COGS (items x periods) with their totals, mirroring the Sales formulas.
+    
+    Growth, churn, prices and volumes are monthly figures; for shorter periods they are
+    scaled the same way the formulas scale them (see Timeline.months_per_period).
+    """
+    volume = _sales_volumes(items, sales_model, timeline)
+    revenue = _sales_amounts(volume, [item.price for item in items], sales_model, timeline)
+    cogs = _sales_amounts(volume, [item.cost for item in items], sales_model, timeline)
+    total_revenue = revenue.sum(axis=0)
+    total_cogs = cogs.sum(axis=0)
+    return {
+        'volume': volume.tolist(),
+        'revenue': revenue.tolist(),
+        'cogs': cogs.tolist(),
+        'total_volume': volume.sum(axis=0).tolist(),
+        'total_revenue': total_revenue.tolist(),
+        'total_cogs': total_cogs.tolist(),
+        'gross_profit': (total_revenue - total_cogs).tolist(),
+    }
+
+
+class Timeline:
+    """The forecast's period columns: their granularity and how many there are"""
+
+    __slots__ = ('granularity', 'periods', 'periods_per_year')
+
+    def __init__(self, granularity, periods):
+        self.granularity = granularity
+        self.periods = periods
+        self.periods_per_year = GRANULARITIES[granularity]
+
+    @property
+    def months_per_period(self):
+        """Formula text scaling a monthly figure to one period ('12/52' for weeks), None when monthly"""
+        if self.periods_per_year == 12:
+            return None
+        return f'12/{self.periods_per_year}'
+
+    def headers(self):
+        return period_headers(self.granularity, self.periods)
+
+
+# (date, {(granularity, periods): labels}); the labels only change with the date
+_PERIOD_HEADERS = (None, {})
+
+
+def period_headers(granularity, periods):
+    """Labels for the forecast periods: calendar months from this month, or weeks from this Monday"""
+    global _PERIOD_HEADERS
+    today = datetime.now().date()
+    if _PERIOD_HEADERS[0] != today:
+        _PERIOD_HEADERS = (today, {})
+    cached = _PERIOD_HEADERS[1]
+    headers = cached.get((granularity, periods))
+    if headers is None:
+        if granularity == 'weekly':
+            monday = today - timedelta(days=today.weekday())
+            headers = tuple((monday + timedelta(weeks=i)).strftime('%d %b %Y') for i in range(periods))
+        else:
+            headers = []
+            for i in range(periods):
+                year, month = divmod(today.month - 1 + i, 12)
+                headers.append(today.replace(year=today.year + year, month=month + 1, day=1).strftime('%b %Y'))
+            headers = tuple(headers)
+        cached[(granularity, periods)] = headers
+    return headers
+
+
+# === CONFIG COMPILER ===
+# compile_config validates a questionnaire config once and resolves it into compact
+# records, so the plans and projections never go back to the raw dict.
+
+# Questionnaire fields per resolved value, in the order they are tried (the sales
+# models name the same thing differently)
+# Sales models the questionnaire offers; 'custom' is a blank template with no items
+SALES_MODELS = ('product', 'service', 'saas', 'marketplace', 'manufacturing', 'usage', 'hybrid', 'custom')
+ITEM_NAME_FIELDS = ('productName', 'serviceName', 'planName', 'transactionType', 'productLine',
+                    'usageMetric', 'streamName')
+ITEM_PRICE_FIELDS = ('unitPrice', 'pricePerUnit', 'hourlyRate', 'monthlyPrice')
+ITEM_VOLUME_FIELDS = ('startingUnits', 'startingHours', 'startingSubscribers', 'startingGMV', 'startingVolume')
+ITEM_GROWTH_FIELDS = ('monthlyGrowth', 'growthRate')
+ITEM_COST_FIELDS = ('costPerUnit', 'deliveryCost', 'costPerSubscriber')
+ITEM_COST_PARTS = ('materialCost', 'laborCost', 'overheadCost')
+
+# Largest workbook (non-empty cells over all tabs) a config may describe; larger ones,
+# such as a mistyped 50,000 employees, are rejected before anything is expanded
+MAX_MODEL_CELLS = int(os.environ.get('MAX_MODEL_CELLS', 2000000))
+
+
+class ConfigError(ValueError):
+    """Raised when a config cannot be compiled; the message names the offending field"""
+
+
+class BudgetExceeded(ConfigError):
+    """Raised when a model is over the cell, memory or build-time budget.
+    
+    size is the model's ModelSize and options the last OutputOptions tried, when known.
+    """
+
+    size = None
+    options = None
+
+
+class StaffTeam:
+    """A selected team and its number of employee rows"""
+
+    __slots__ = ('name', 'abbreviation', 'count')
+
+    def __init__(self, name, abbreviation, count):
+        self.name = name
+        self.abbreviation = abbreviation
+        self.count = count
+
+
+class SalesItem:
+    """A sales item with its questionnaire fields resolved to numbers (growth, churn as fractions)"""
+
+    __slots__ = ('name', 'price', 'start_volume', 'growth', 'cost', 'churn', 'growth_rate')
+
+    def __init__(self, name, price, start_volume, growth, cost, churn=0.0, growth_rate=0.0):
+        self.name = name
+        self.price = price
+        self.start_volume = start_volume
+        self.growth = growth
+        self.cost = cost
+        # SaaS only: monthly churn and subscriber growth
+        self.churn = churn
+        self.growth_rate = growth_rate
+
+
+class NonStaffLine:
+    """One Non-Staff row: an item (numbered when its quantity is above 1) and its category"""
+
+    __slots__ = ('name', 'category')
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+
+
+class SimulationSettings:
+    """A Monte Carlo run: paths, standard deviations of monthly growth and churn (fractions) and the seed"""
+
+    __slots__ = ('paths', 'growth_spread', 'churn_spread', 'seed')
+
+    def __init__(self, paths, growth_spread, churn_spread, seed):
+        self.paths = paths
+        self.growth_spread = growth_spread
+        self.churn_spread = churn_spread
+        self.seed = seed
+
+
+class ModelSize:
+    """Cells and formulas of the workbook a config describes, counted without building it"""
+
+    __slots__ = ('periods', 'cells', 'formulas', 'simulation_steps', 'simulation_values', 'simulation_bytes')
+
+    def __init__(self, timeline, employees, spare_rows, staff_columns, sales_model, item_count, non_staff_rows,
+                 non_staff_template, simulation=None):
+        periods = timeline.periods
+        self.periods = periods
+        # Staff: header, one row per employee (five filled columns, the extra category is left
+        # to pick, and a formula per period), the spare rows' formulas, TOTAL
+        cells = staff_columns + periods + employees * (5 + periods) + spare_rows * periods + 1 + periods
+        formulas = (employees + spare_rows + 1) * periods
+        # Sales: three sections of one row per item, their banners, headers and totals, and gross profit
+        if sales_model == 'custom':
+            cells += 4 + periods
+        elif not item_count:
+            cells += 2 + periods
+        else:
+            cells += 3 * item_count * (4 + periods) + 5 * periods + 19
+            formulas += item_count * 3 * periods + 4 * periods
+            # The first volume is a value, except a weekly share of the monthly volume
+            if timeline.months_per_period is None or sales_model == 'saas':
+                formulas -= item_count
+        # Non-Staff: header, one row per line, TOTAL (or a placeholder row)
+        if non_staff_template:
+            cells += 4 + periods
+        else:
+            cells += (non_staff_rows + 1) * (3 + periods) + 1 + periods
+            formulas += (non_staff_rows + 1) * periods
+        # Simulation: a header and nine rows of bands, each path projecting every item
+        self.simulation_steps = self.simulation_values = self.simulation_bytes = 0
+        if simulation is not None and item_count and sales_model != 'custom':
+            cells += 10 * (2 + periods)
+            self.simulation_steps = simulation.paths * item_count * periods
+            self.simulation_values = simulation.paths * periods
+            # Every path's revenue and COGS totals, a chunk's running totals and the percentiles' copies
+            chunk_paths = min(simulation.paths, SIMULATION_CHUNK_PATHS)
+            self.simulation_bytes = (16 * periods * (simulation.paths + chunk_paths) +
+                                     24 * min(self.simulation_values, SIMULATION_PERCENTILE_BLOCK))
+        self.cells = cells
+        self.formulas = formulas
+
+
+class CompiledConfig:
+    """Everything a build reads from a config, validated and resolved once"""
+
+    __slots__ = ('timeline', 'sales_model', 'sales_items', 'selected_teams', 'teams', 'extra_name',
+                 'extra_options', 'spare_rows', 'non_staff_lines', 'non_staff_template', 'simulation', 'size')
+
+    def __init__(self, timeline, sales_model, sales_items, selected_teams, teams, extra_name, extra_options,
+                 spare_rows, non_staff_lines, non_staff_template, simulation=None, size=None):
+        self.timeline = timeline
+        self.sales_model = sales_model
+        self.sales_items = sales_items
+        self.selected_teams = selected_teams
+        self.teams = teams
+        self.extra_name = extra_name
+        self.extra_options = extra_options
+        self.spare_rows = spare_rows
+        self.non_staff_lines = non_staff_lines
+        # No non-staff items at all: the tab is a placeholder template
+        self.non_staff_template = non_staff_template
+        # SimulationSettings when the config asks for a Monte Carlo run, else None
+        self.simulation = simulation
+        # ModelSize, checked against MAX_MODEL_CELLS before the non-staff lines were expanded
+        self.size = size
+
+    @property
+    def staff_row_count(self):
+        """Employee rows plus spare rows on the Staff tab"""
+        return sum(team.count for team in self.teams) + self.spare_rows
+
+
+def _config_number(value, where):
+    try:
+        return _to_float(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f'{where} is not a number: {value!r}')
+
+
+def _config_count(value, where):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ConfigError(f'{where} must be a whole number of at least 0, got {value!r}')
+    return value
+
+
+def _config_field(config, name, expected, default):
+    value = config.get(name)
+    if value is None:
+        return default
+    if not isinstance(value, expected):
+        raise ConfigError(f'{name} must be a JSON {"object" if expected is dict else "array"}')
+    return value
+
+
+def _first_number(item, fields, where):
+    # The first field with a non-zero value wins, like a chain of `or`s
+    for field in fields:
+        value = _config_number(item.get(field), f'{where}.{field}')
+        if value:
+            return value
+    return 0
+
+
+def _compile_sales_item(item, sales_model, where):
+    if not isinstance(item, dict):
+        raise ConfigError(f'{where} must be a JSON object')
+    name = None
+    for field in ITEM_NAME_FIELDS[:-1]:
+        name = item.get(field)
+        if name:
+            break
+    else:
+        name = item.get(ITEM_NAME_FIELDS[-1], 'Item')
+
+    price = _first_number(item, ITEM_PRICE_FIELDS, where)
+    start_volume = _first_number(item, ITEM_VOLUME_FIELDS, where)
+    growth = _first_number(item, ITEM_GROWTH_FIELDS, where)
+
+    # Cost: a per-unit cost, else manufacturing's material + labor + overhead, else 'cost'
+    cost = (_first_number(item, ITEM_COST_FIELDS, where) or
+            sum(_config_number(item.get(field), f'{where}.{field}') for field in ITEM_COST_PARTS) or
+            _config_number(item.get('cost'), f'{where}.cost'))
+
+    if sales_model == 'saas':
+        churn = _config_number(item.get('churnRate', 0), f'{where}.churnRate') / 100
+        growth_rate = _config_number(item.get('growthRate', 0), f'{where}.growthRate') / 100
+        return SalesItem(name, price, start_volume, growth / 100, cost, churn, growth_rate)
+    return SalesItem(name, price, start_volume, growth / 100, cost)
+
+
+def compile_timeline(config):
+    """The config's forecast Timeline ('granularity', 'forecastPeriods'); raises ConfigError"""
+    granularity = config.get('granularity') or FORECAST_GRANULARITY
+    if granularity not in GRANULARITIES:
+        raise ConfigError(f"granularity must be one of {', '.join(GRANULARITIES)}, got {granularity!r}")
+    periods = config.get('forecastPeriods')
+    if periods is None:
+        periods = FORECAST_YEARS * GRANULARITIES[granularity]
+    periods = _config_count(periods, 'forecastPeriods')
+    if not 1 <= periods <= MAX_FORECAST_PERIODS:
+        raise ConfigError(f'forecastPeriods must be between 1 and {MAX_FORECAST_PERIODS}, got {periods}')
+    return Timeline(granularity, periods)
+
+
+def compile_simulation(config):
+    """The config's SimulationSettings ('simulation'), or None when it does not ask for one; raises ConfigError"""
+    simulation = _config_field(config, 'simulation', dict, None)
+    if simulation is None:
+        return None
+    if not HAS_NUMPY:
+        raise ConfigError('simulation needs numpy to be installed')
+    paths = _config_count(simulation.get('paths', DEFAULT_SIMULATION_PATHS), 'simulation.paths')
+    if not 1 <= paths <= MAX_SIMULATION_PATHS:
+        raise ConfigError(f'simulation.paths must be between 1 and {MAX_SIMULATION_PATHS}, got {paths}')
+    spreads = []
+    for field, default in (('growthStdDev', 1), ('churnStdDev', 0.5)):
+        spread = _config_number(simulation.get(field, default), f'simulation.{field}')
+        if spread < 0:
+            raise ConfigError(f'simulation.{field} must be at least 0, got {spread}')
+        spreads.append(spread / 100)
+    seed = _config_count(simulation.get('seed', 0), 'simulation.seed')
+    return SimulationSettings(paths, spreads[0], spreads[1], seed)
+
+
+def compile_config(config):
+    """Validate a questionnaire config and resolve it into a CompiledConfig; raises ConfigError"""
+    if isinstance(config, CompiledConfig):
+        return config
+    if not isinstance(config, dict):
+        raise ConfigError('The config must be a JSON object')
+
+    timeline = compile_timeline(config)
+    sales_model = config.get('salesModel')
+    if sales_model is not None and sales_model not in SALES_MODELS:
+        raise ConfigError(f"salesModel must be one of {', '.join(SALES_MODELS)}, got {sales_model!r}")
+    sales_items = []
+    if sales_model != 'custom':
+        sales_items = [_compile_sales_item(item, sales_model, f'salesItems[{idx}]')
+                       for idx, item in enumerate(_config_field(config, 'salesItems', list, []))]
+        if sales_items and sales_model is None:
+            # Without items the Sales tab is an empty template, which needs no model
+            raise ConfigError('salesModel is required when there are salesItems')
+
+    selected_teams = tuple(_config_field(config, 'selectedTeams', list, []))
+    employee_counts = _config_field(config, 'employeeCounts', dict, {})
+    teams = []
+    for team in selected_teams:
+        if not isinstance(team, str):
+            raise ConfigError(f'selectedTeams must hold team names, got {team!r}')
+        count = _config_count(employee_counts.get(team, 0), f'employeeCounts[{team!r}]')
+        abbreviation = ''.join([word[0].upper() for word in team.split()])
+        teams.append(StaffTeam(team, abbreviation, count))
+
+    extra_name = None
+    extra_options = ()
+    extra_category = config.get('extraCategory')
+    if extra_category:
+        if not isinstance(extra_category, dict):
+            raise ConfigError('extraCategory must be a JSON object')
+        extra_name = extra_category.get('name') or None
+        if extra_name is not None and not isinstance(extra_name, str):
+            raise ConfigError('extraCategory.name must be a string')
+        options = extra_category.get('options') or []
+        if not isinstance(options, list) or not all(isinstance(opt, str) for opt in options):
+            raise ConfigError('extraCategory.options must be an array of strings')
+        if extra_name:
+            extra_options = tuple(opt for opt in options if opt.strip())
+
+    try:
+        spare_rows = _spare_staff_rows(config)
+    except (TypeError, ValueError):
+        raise ConfigError(f"spareStaffRows must be a whole number, got {config.get('spareStaffRows')!r}")
+
+    non_staff_items = _config_field(config, 'nonStaffItems', dict, {})
+    non_staff_quantities = _config_field(config, 'nonStaffQuantities', dict, {})
+    non_staff_selected = []
+    for item_key, is_selected in non_staff_items.items():
+        if not is_selected:
+            continue
+        category, separator, item = item_key.partition('|')
+        if not separator:
+            raise ConfigError(f'nonStaffItems keys must look like "Category|Item", got {item_key!r}')
+        quantity = _config_count(non_staff_quantities.get(item_key, 1), f'nonStaffQuantities[{item_key!r}]')
+        non_staff_selected.append((category, item, quantity))
+
+    # Sized from the counts alone, so an oversized config is refused before its rows exist
+    simulation = compile_simulation(config)
+    size = ModelSize(timeline, sum(team.count for team in teams), spare_rows, 6 if extra_name else 5,
+                     sales_model, len(sales_items), sum(quantity for _, _, quantity in non_staff_selected),
+                     not non_staff_items, simulation)
+    if size.cells > MAX_MODEL_CELLS:
+        error = BudgetExceeded(f'The workbook would have {size.cells:,} cells, over the limit of {MAX_MODEL_CELLS:,}; '
+                               f'check employeeCounts, salesItems, nonStaffQuantities and forecastPeriods')
+        error.size = size
+        raise error
+
+    non_staff_lines = []
+    for category, item, quantity in non_staff_selected:
+        # Remove emoji from category for cleaner display
+        clean_category = category.split(' ', 1)[1] if ' ' in category else category
+        for i in range(1, quantity + 1):
+            # Item name (add quantity suffix if > 1)
+            non_staff_lines.append(NonStaffLine(f"{item} {i}" if quantity > 1 else item, clean_category))
+
+    return CompiledConfig(timeline, sales_model, sales_items, selected_teams, teams, extra_name, extra_options,
+                          spare_rows, non_staff_lines, not non_staff_items, simulation, size)
+
+
+# === SHEET SKELETONS ===
+# The parts of a tab that do not depend on the request's data (header rows, column
+# widths, period column letters) are built once per set of period headers and layout
+# variant and reused by every build; the plans only generate the data rows.
+
+# Skeletons kept (timelines and extra category names make variants)
+MAX_SKELETONS = 256
+
+# Row numbers a template row keeps rendered output for. Headers always sit on the same row,
+# but the Sales banners move with the item count, so their memo must not grow per config
+MAX_TEMPLATE_ROW_POSITIONS = 8
+
+
+class TemplateRow(list):
+    """A row that is the same in every workbook built from one skeleton.
+    
+    rendered is for the engines to memoize output by row number, for at most
+    MAX_TEMPLATE_ROW_POSITIONS row numbers.
+    """
+    
+    __slots__ = ('rendered',)
+    
+    def __init__(self, cells):
+        super().__init__(cells)
+        self.rendered = {}
+
+
+class SheetSkeleton:
+    """Request-independent layout of one tab: named template rows, column widths and period letters"""
+    
+    __slots__ = ('rows', 'column_widths', 'period_letters', 'rendered')
+    
+    def __init__(self, rows, column_widths, period_letters):
+        self.rows = {name: TemplateRow(cells) for name, cells in rows.items()}
+        self.column_widths = column_widths
+        self.period_letters = period_letters
+        self.rendered = {}
+
+
+def _header_row(headers, style='header'):
+    return [(header, style) for header in headers]
+
+
+def _period_letters(first_col, periods):
+    return _COLUMN_LETTERS[first_col:first_col + periods] if first_col + periods <= len(_COLUMN_LETTERS) \
+        else tuple(_column_letter(first_col + period_idx) for period_idx in range(periods))
+
+
+def _staff_skeleton(period_headers, extra_name):
+    first_period_col = 7 if extra_name else 6
+    headers = ['Position', 'Team', 'Type', 'Direct/Overhead']
+    column_widths = {1: 20, 2: 30, 3: 12, 4: 18}
+    if extra_name:
+        headers.append(extra_name)
+        column_widths[5] = 18
+    headers.append('Annual Salary')
+    column_widths[first_period_col - 1] = 15
+    for i in range(len(period_headers)):
+        column_widths[first_period_col + i] = 12
+    return SheetSkeleton({'header': _header_row(headers + list(period_headers))},
+                         column_widths, _period_letters(first_period_col, len(period_headers)))
+
+
+def _sales_skeleton(period_headers, variant):
+    placeholder = [('[Add your sales items here]', None)]
+    if variant == 'custom':
+        # Custom model: Item, Description 1, Description 2
+        headers = ['Item', 'Description 1', 'Description 2'] + list(period_headers)
+        return SheetSkeleton({'header': _header_row(headers), 'placeholder': placeholder},
+                             {1: 30, 2: 25, 3: 25}, ())
+    if variant == 'empty':
+        return SheetSkeleton({'header': _header_row(['Item'] + list(period_headers)), 'placeholder': placeholder},
+                             {1: 30}, ())
+    # Volume and COGS headers have no dates, those are only in the REVENUE section
+    blank_periods = [''] * len(period_headers)
+    return SheetSkeleton({
+        'revenue_banner': [('REVENUE', 'revenue_banner')],
+        'header': _header_row(['Item', 'Type', 'Unit Price', 'Growth %'] + list(period_headers)),
+        'volume_banner': [('VOLUME (UNITS / SUBSCRIBERS)', 'volume_banner')],
+        'volume_header': _header_row(['Item', 'Type', 'Starting Volume', 'Growth %'] + blank_periods,
+                                     'volume_header'),
+        'cogs_banner': [('COST OF GOODS SOLD (COGS)', 'cogs_banner')],
+        'cogs_header': _header_row(['Item', 'Type', 'Unit Cost', 'Growth %'] + blank_periods, 'cogs_header'),
+    }, {1: 30, 2: 20, 3: 18, 4: 12}, _period_letters(5, len(period_headers)))
+
+
+def _non_staff_skeleton(period_headers, variant=None):
+    column_widths = {1: 40, 2: 30, 3: 15}
+    for i in range(len(period_headers)):
+        column_widths[i + 4] = 12
+    return SheetSkeleton({
+        'header': _header_row(['Item', 'Category', 'Annual Cost'] + list(period_headers)),
+        'placeholder': [('[Add your non-staff costs here]', None)],
+    }, column_widths, _period_letters(4, len(period_headers)))
+
+
+_SKELETON_BUILDERS = {'staff': _staff_skeleton, 'sales': _sales_skeleton, 'non_staff': _non_staff_skeleton}
+_SKELETONS = OrderedDict()
+_SKELETONS_LOCK = threading.Lock()
+_SKELETONS_DATE = None
+
+
+def sheet_skeleton(kind, period_headers, variant=None):
+    """The cached skeleton for a tab kind, period headers and variant, built on first use.
+    
+    Period headers follow the calendar, so every skeleton is dropped when the date changes.
+    """
+    global _SKELETONS_DATE
+    period_headers = tuple(period_headers)
+    key = (kind, variant, period_headers)
+    today = datetime.now().date()
+    with _SKELETONS_LOCK:
+        if today != _SKELETONS_DATE:
+            _SKELETONS.clear()
+            _SKELETONS_DATE = today
+        skeleton = _SKELETONS.get(key)
+        if skeleton is not None:
+            _SKELETONS.move_to_end(key)
+            return skeleton
+    skeleton = _SKELETON_BUILDERS[kind](period_headers, variant)
+    with _SKELETONS_LOCK:
+        skeleton = _SKELETONS.setdefault(key, skeleton)
+        while len(_SKELETONS) > MAX_SKELETONS:
+            _SKELETONS.popitem(last=False)
+    return skeleton
+
+
+def _spare_staff_rows(config):
+    """Blank pre-validated rows to add below the employees (config 'spareStaffRows')"""
+    spare_rows = config.get('spareStaffRows', STAFF_SPARE_ROWS)
+    return min(max(int(spare_rows or 0), 0), MAX_STAFF_SPARE_ROWS)
+
+
+def _staff_plan(model, period_headers, shared_formulas=False, cached_values=False):
+    """Staff tab: one row per employee with per-period salary formulas"""
+    timeline = model.timeline
+    has_extra = model.extra_name is not None
+    skeleton = sheet_skeleton('staff', period_headers, model.extra_name)
+
+    first_period_col = 7 if has_extra else 6
+    salary_col_letter = _column_letter(first_period_col - 1)
+    period_letters = skeleton.period_letters
+    last_row = 1 + model.staff_row_count
+
+    # Create data validations, one range per column down to the last employee or spare row
+    validations = []
+    if last_row >= 2:
+        validations.append(ListValidation(model.selected_teams, 'B', 2, last_row))
+        validations.append(ListValidation(['PAYE', 'Contract'], 'C', 2, last_row))
+        validations.append(ListValidation(['OVERHEAD', 'DIRECT'], 'D', 2, last_row))
+        if model.extra_options:
+            validations.append(ListValidation(model.extra_options, 'E', 2, last_row, allow_blank=True))
+
+    group_ids = itertools.count()
+    if shared_formulas and last_row >= 2:
+        shared_periods = _shared_block(group_ids,
+                                       [f'={salary_col_letter}2/{timeline.periods_per_year}'] * timeline.periods,
+                                       period_letters, 2, last_row, 'currency')
+
+    if cached_values:
+        # Salaries start at 0 and spare rows are blank, so every row projects from 0
+        period_values, total_values = _cost_projection([0] * (last_row - 1), timeline)
+
+    def period_cells(row_num):
+        if shared_formulas:
+            cells = shared_periods[0] if row_num == 2 else shared_periods[1]
+        else:
+            cells = [(f'={salary_col_letter}{row_num}/{timeline.periods_per_year}', 'currency')] * timeline.periods
+        return _with_values(cells, period_values[row_num - 2]) if cached_values else cells
+
+    def rows():
+        yield skeleton.rows['header']
+
+        # Add employee rows
+        current_row = 2
+        for team in model.teams:
+            for emp_num in range(1, team.count + 1):
+                # Position, Team, Type, Direct/Overhead
+                row = [
+                    (f'{team.abbreviation} Employee {emp_num}', None),
+                    (team.name, None),
+                    ('PAYE', None),
+                    ('OVERHEAD', None),
+                ]
+
+                # Extra category column
+                if has_extra:
+                    row.append(('', None))
+
+                # Annual Salary
+                row.append((0, 'currency'))
+
+                # Monthly salary columns
+                row.extend(period_cells(current_row))
+                yield row
+                current_row += 1
+
+        # Spare rows: dropdowns and period formulas ready for staff added later,
+        # and already inside the TOTAL ranges
+        for _ in range(model.spare_rows):
+            row = [None] * (first_period_col - 2) + [(None, 'currency')]
+            row.extend(period_cells(current_row))
+            yield row
+            current_row += 1
+
+        # Add TOTAL row
+        row = [('TOTAL', 'total_label')] + [None] * (first_period_col - 2)
+        if shared_formulas:
+            first_letter = period_letters[0]
+            cells = _shared_row(group_ids, f'=SUM({first_letter}2:{first_letter}{current_row - 1})',
+                                period_letters, current_row, 'total_currency')
+        else:
+            cells = [(f'=SUM({col_letter}2:{col_letter}{current_row - 1})', 'total_currency')
+                     for col_letter in period_letters]
+        row.extend(_with_values(cells, total_values) if cached_values else cells)
+        yield row
+
+    # Freeze panes at C2 (freezes columns A & B, and row 1)
+    return SheetPlan('Staff', rows(), skeleton.column_widths, 'C2', validations=validations, skeleton=skeleton)
+
+
+class SalesLayout:
+    """Row numbers of the Sales tab sections for a number of items.
+    
+    Each section is a banner, a header row, the items and a TOTAL row, with two rows
+    before the next section.
+    """
+
+    __slots__ = ('revenue_start_row', 'total_rev_row', 'volume_banner_row', 'volume_start_row', 'total_vol_row',
+                 'cogs_banner_row', 'cogs_start_row', 'total_cogs_row', 'gross_profit_row')
+
+    def __init__(self, item_count):
+        self.revenue_start_row = 3
+        self.total_rev_row = self.revenue_start_row + item_count
+        self.volume_banner_row = self.total_rev_row + 2
+        self.volume_start_row = self.volume_banner_row + 2
+        self.total_vol_row = self.volume_start_row + item_count
+        self.cogs_banner_row = self.total_vol_row + 2
+        self.cogs_start_row = self.cogs_banner_row + 2
+        self.total_cogs_row = self.cogs_start_row + item_count
+        self.gross_profit_row = self.total_cogs_row + 2
+
+
+def _sales_plan(model, period_headers, shared_formulas=False, cached_values=False):
+    """Sales tab: REVENUE, VOLUME and COGS sections with GROSS PROFIT"""
+    sales_model = model.sales_model
+    items = model.sales_items
+
+    if sales_model == 'custom' or not items:
+        # Custom model, or an empty template if no items: just the headers and a placeholder
+        skeleton = sheet_skeleton('sales', period_headers, 'custom' if sales_model == 'custom' else 'empty')
+
+        def rows():
+            yield skeleton.rows['header']
+            yield skeleton.rows['placeholder']
+
+        return SheetPlan('Sales', rows(), skeleton.column_widths, 'B2', skeleton=skeleton)
+
+    skeleton = sheet_skeleton('sales', period_headers, 'standard')
+    template_rows = skeleton.rows
+    timeline = model.timeline
+    # Prices, volumes and rates are monthly; shorter periods scale them by months per period
+    scale = timeline.months_per_period
+    # SaaS charges the monthly price for the period's share of a month
+    per_period = f'*{scale}' if scale and sales_model == 'saas' else ''
+    # Non-SaaS volumes are per period, so the first period is a formula too when scaled
+    first_volume_period = 0 if scale and sales_model != 'saas' else 1
+
+    period_letters = skeleton.period_letters
+
+    layout = SalesLayout(len(items))
+    revenue_start_row = layout.revenue_start_row
+    total_rev_row = layout.total_rev_row
+    volume_banner_row = layout.volume_banner_row
+    volume_start_row = layout.volume_start_row
+    total_vol_row = layout.total_vol_row
+    cogs_banner_row = layout.cogs_banner_row
+    cogs_start_row = layout.cogs_start_row
+    total_cogs_row = layout.total_cogs_row
+    gross_profit_row = layout.gross_profit_row
+
+    merged_cells = [f'A{row}:D{row}' for row in (1, volume_banner_row, cogs_banner_row)]
+    projection = _sales_projection(items, sales_model, timeline) if cached_values else None
+
+    def volume_formula(row_num, period_idx):
+        if scale is None:
+            return f'=C{row_num}*POWER(1+D{row_num},{period_idx})'
+        if period_idx == 0:
+            return f'=C{row_num}*{scale}'
+        return f'=C{row_num}*{scale}*POWER(1+D{row_num},{period_idx}*{scale})'
+
+    group_ids = itertools.count()
+    if shared_formulas:
+        # One group per period column for each item block (row 0 holds the masters)
+        shared_revenue = _shared_block(
+            group_ids, [f'={col_letter}{volume_start_row}*C{revenue_start_row}{per_period}'
+                        for col_letter in period_letters],
+            period_letters, revenue_start_row, total_rev_row - 1, 'currency')
+        shared_cogs = _shared_block(
+            group_ids, [f'={col_letter}{volume_start_row}*C{cogs_start_row}{per_period}'
+                        for col_letter in period_letters],
+            period_letters, cogs_start_row, total_cogs_row - 1, 'currency')
+        if sales_model != 'saas':
+            shared_volume = _shared_block(
+                group_ids, [volume_formula(volume_start_row, period_idx)
+                            for period_idx in range(first_volume_period, timeline.periods)],
+                period_letters[first_volume_period:], volume_start_row, total_vol_row - 1, 'count')
+
+    def valued(cells, key, idx=None):
+        # Attach the projected results when cached values were requested
+        if not cached_values:
+            return cells
+        values = projection[key] if idx is None else projection[key][idx]
+        return _with_values(cells, values[-len(cells):])
+
+    def block_cells(shared, row_num, first_row, formulas, style):
+        if shared_formulas:
+            return shared[0] if row_num == first_row else shared[1]
+        return [(formula, style) for formula in formulas]
+
+    def total_row(label, first_row, last_row, style, key):
+        row = [(label, 'total_label'), None, None, None]
+        if shared_formulas:
+            first_letter = period_letters[0]
+            cells = _shared_row(group_ids, f'=SUM({first_letter}{first_row}:{first_letter}{last_row})',
+                                period_letters, last_row + 1, style)
+        else:
+            cells = [(f'=SUM({col_letter}{first_row}:{col_letter}{last_row})', style)
+                     for col_letter in period_letters]
+        row.extend(valued(cells, key))
+        return row
+
+    def rows():
+        # REVENUE SECTION HEADER
+        yield template_rows['revenue_banner']
+        yield template_rows['header']
+
+        # Add revenue items
+        for idx, item in enumerate(items):
+            row_num = revenue_start_row + idx
+            row = [
+                (item.name, None),
+                (sales_model.upper(), None),
+                (item.price, 'currency'),
+                (item.growth, 'percent'),
+            ]
+
+            # Revenue formulas: Volume × Price, referencing the VOLUME section
+            volume_row_ref = volume_start_row + idx
+            row.extend(valued(block_cells(
+                shared_revenue if shared_formulas else None, row_num, revenue_start_row,
+                [f'={col_letter}{volume_row_ref}*C{row_num}{per_period}' for col_letter in period_letters],
+                'currency'),
+                'revenue', idx))
+            yield row
+
+        # TOTAL REVENUE row
+        yield total_row('TOTAL REVENUE', revenue_start_row, total_rev_row - 1, 'total_currency', 'total_revenue')
+        yield []
+
+        # ===== VOLUME SECTION =====
+        yield template_rows['volume_banner']
+
+        # Volume headers (no date headers - those are only in REVENUE section)
+        yield template_rows['volume_header']
+
+        # Volume per period - EDITABLE cells with formulas as starting point
+        for idx, item in enumerate(items):
+            row_num = volume_start_row + idx
+            row = [
+                (item.name, None),
+                (sales_model.upper(), None),
+                (item.start_volume, 'count'),
+                (item.growth, 'percent'),
+            ]
+            if first_volume_period:
+                # Period 1: just starting value
+                row.append((item.start_volume, 'count'))
+
+            if sales_model == 'saas':
+                # SaaS: previous period adjusted for churn and growth
+                churn = item.churn
+                growth_rate = item.growth_rate
+                if scale is None:
+                    step = f'*(1-{churn})*(1+{growth_rate})'
+                else:
+                    step = f'*POWER((1-{churn})*(1+{growth_rate}),{scale})'
+                if shared_formulas and timeline.periods > 1:
+                    cells = _shared_row(group_ids, f'={period_letters[0]}{row_num}{step}',
+                                        period_letters[1:], row_num, 'count')
+                else:
+                    cells = [(f'={period_letters[period_idx - 1]}{row_num}{step}', 'count')
+                             for period_idx in range(1, timeline.periods)]
+            else:
+                # Standard growth model
+                cells = block_cells(
+                    shared_volume if shared_formulas else None, row_num, volume_start_row,
+                    [volume_formula(row_num, period_idx)
+                     for period_idx in range(first_volume_period, timeline.periods)],
+                    'count')
+            row.extend(valued(cells, 'volume', idx))
+            yield row
+
+        # TOTAL VOLUME row
+        yield total_row('TOTAL VOLUME', volume_start_row, total_vol_row - 1, 'total_count', 'total_volume')
+        yield []
+
+        # COGS SECTION HEADER
+        yield template_rows['cogs_banner']
+
+        # COGS headers (no date headers - those are only in REVENUE section)
+        yield template_rows['cogs_header']
+
+        # Add COGS items - reference volume section
+        for idx, item in enumerate(items):
+            row_num = cogs_start_row + idx
+            row = [
+                (f"{item.name} - COGS", None),
+                ('COGS', None),
+                (item.cost, 'currency'),
+                (item.growth, 'percent'),
+            ]
+
+            # COGS formulas: Volume × Cost per unit
+            volume_row_ref = volume_start_row + idx
+            row.extend(valued(block_cells(
+                shared_cogs if shared_formulas else None, row_num, cogs_start_row,
+                [f'={col_letter}{volume_row_ref}*C{row_num}{per_period}' for col_letter in period_letters],
+                'currency'),
+                'cogs', idx))
+            yield row
+
+        # TOTAL COGS row
+        yield total_row('TOTAL COGS', cogs_start_row, total_cogs_row - 1, 'total_currency', 'total_cogs')
+        yield []
+
+        # GROSS PROFIT row
+        row = [('GROSS PROFIT', 'gross_profit_label'), None, None, None]
+        if shared_formulas:
+            first_letter = period_letters[0]
+            cells = _shared_row(group_ids, f'={first_letter}{total_rev_row}-{first_letter}{total_cogs_row}',
+                                period_letters, gross_profit_row, 'gross_profit')
+        else:
+            cells = [(f'={col_letter}{total_rev_row}-{col_letter}{total_cogs_row}', 'gross_profit')
+                     for col_letter in period_letters]
+        row.extend(valued(cells, 'gross_profit'))
+        yield row
+
+    return SheetPlan('Sales', rows(), skeleton.column_widths, 'E3', merged_cells, skeleton=skeleton)
+
+
+def _non_staff_plan(model, period_headers, shared_formulas=False, cached_values=False):
+    """Non-Staff tab: selected cost items with Annual/periods-per-year formulas"""
+    timeline = model.timeline
+    # Headers with Category and Annual Cost columns
+    skeleton = sheet_skeleton('non_staff', period_headers)
+
+    period_letters = skeleton.period_letters
+    item_rows = len(model.non_staff_lines)
+    if cached_values:
+        # Annual costs are written as 0 for the user to fill in
+        period_values, total_values = _cost_projection([0] * item_rows, timeline)
+
+    group_ids = itertools.count()
+    if shared_formulas:
+        shared_periods = _shared_block(group_ids, [f'=C2/{timeline.periods_per_year}'] * timeline.periods,
+                                       period_letters, 2, 1 + item_rows, 'currency')
+
+    def rows():
+        yield skeleton.rows['header']
+
+        if model.non_staff_template:
+            # Empty template
+            yield skeleton.rows['placeholder']
+            return
+
+        # Add selected non-staff items
+        current_ns_row = 2
+        for line in model.non_staff_lines:
+            # Item, Category, Annual Cost (default 0)
+            row = [(line.name, None), (line.category, None), (0, 'currency')]
+
+            # Period columns (formula: Annual/12 monthly, Annual/52 weekly)
+            if shared_formulas:
+                cells = shared_periods[0] if current_ns_row == 2 else shared_periods[1]
+            else:
+                cells = [(f'=C{current_ns_row}/{timeline.periods_per_year}', 'currency')] * timeline.periods
+            if cached_values:
+                cells = _with_values(cells, period_values[current_ns_row - 2])
+            row.extend(cells)
+            yield row
+            current_ns_row += 1
+
+        # Add TOTAL row
+        row = [('TOTAL', 'total_label'), None, None]
+        if shared_formulas:
+            cells = _shared_row(group_ids, f'=SUM(D2:D{current_ns_row - 1})',
+                                period_letters, current_ns_row, 'total_currency')
+        else:
+            cells = [(f'=SUM({col_letter}2:{col_letter}{current_ns_row - 1})', 'total_currency')
+                     for col_letter in period_letters]
+        row.extend(_with_values(cells, total_values) if cached_values else cells)
+        yield row
+
+    return SheetPlan('Non-Staff', rows(), skeleton.column_widths, 'B2', skeleton=skeleton)
+
+
+def workbook_plans(config, shared_formulas=False, cached_values=False, period_headers=None, simulation=None):
+    """Sheet plans for the workbook, in tab order (Sales first); config may already be compiled.
+    
+    simulation is the simulate_sales result when it has already been run, e.g. on the generation pool.
+    """
+    model = compile_config(config)
+    period_headers = period_headers or model.timeline.headers()
+    plans = [
+        _sales_plan(model, period_headers, shared_formulas, cached_values),
+        _staff_plan(model, period_headers, shared_formulas, cached_values),
+        _non_staff_plan(model, period_headers, shared_formulas, cached_values),
+    ]
+    if model.simulation is not None and model.sales_items and model.sales_model != 'custom':
+        plans.append(_simulation_plan(model, period_headers, simulation))
+    return plans
+
+
+def project_config(config, map_chunks=None):
+    """Per-period series the workbook's formulas produce, without building a workbook.
+    
+    With a 'simulation' in the config the result also holds its bands (see simulate_sales).
+    """
+    model = compile_config(config)
+    if model.simulation is not None:
+        # The preview runs while the user waits, so a large simulation is refused up front
+        check_projection_budget(model)
+    timeline = model.timeline
+    sales_model = model.sales_model
+    items = model.sales_items
+    sales = _sales_projection(items, sales_model, timeline)
+    # Salaries and annual costs start at 0 in the workbook, as do their projections
+    _, staff_total = _cost_projection([0] * model.staff_row_count, timeline)
+    _, non_staff_total = _cost_projection([0] * len(model.non_staff_lines), timeline)
+    projection = {
+        'granularity': timeline.granularity,
+        'months': list(timeline.headers()),
+        'sales': {
+            'model': sales_model,
+            'items': [
+                {
+                    'name': item.name,
+                    'volume': sales['volume'][idx],
+                    'revenue': sales['revenue'][idx],
+                    'cogs': sales['cogs'][idx],
+                }
+                for idx, item in enumerate(items)
+            ],
+            'totalVolume': sales['total_volume'],
+            'totalRevenue': sales['total_revenue'],
+            'totalCogs': sales['total_cogs'],
+            'grossProfit': sales['gross_profit'],
+        },
+        'staffTotal': staff_total,
+        'nonStaffTotal': non_staff_total,
+    }
+    if model.simulation is not None:
+        projection['simulation'] = simulate_sales(model, map_chunks)
+    return projection
+
+
+# === MONTE CARLO ===
+# Optional simulation of the Sales tab. Each path draws every item's monthly growth (and,
+# for SaaS, churn) from a normal distribution around the item's figures and holds it for
+# the whole horizon, then projects volumes, revenue and COGS the way the formulas do. The
+# result is the P10/P50/P90 band of total revenue, total COGS and gross profit per period.
+#
+# Paths run in fixed-size chunks, each seeded from the run's seed and its chunk number,
+# so a seed always gives the same bands however the chunks are spread over processes.
+# A chunk carries its volumes forward one period at a time, so its memory is its running
+# totals (periods x paths) whatever the item count.
+
+DEFAULT_SIMULATION_PATHS = 10000
+MAX_SIMULATION_PATHS = 100000
+SIMULATION_CHUNK_PATHS = 2500
+# Items projected together, as one (items x paths) block of volumes
+SIMULATION_ITEM_BATCH = 16
+SIMULATION_PERCENTILES = (10, 50, 90)
+# Values the percentiles are taken over at a time, which bounds their temporary copies
+SIMULATION_PERCENTILE_BLOCK = 2 ** 21
+
+
+def _simulate_chunk(items, sales_model, timeline, settings, chunk_idx, paths):
+    """Total revenue and COGS (periods x paths) of one chunk of paths"""
+    import numpy
+    rng = numpy.random.default_rng([settings.seed, chunk_idx])
+    periods = timeline.periods
+    # Exponent turning a monthly factor into a per-period one (1 when monthly)
+    months = 12 / timeline.periods_per_year
+    scaled = timeline.months_per_period is not None
+    saas = sales_model == 'saas'
+    revenue = numpy.zeros((periods, paths))
+    cogs = numpy.zeros((periods, paths))
+    for first_item in range(0, len(items), SIMULATION_ITEM_BATCH):
+        batch = items[first_item:first_item + SIMULATION_ITEM_BATCH]
+        start = numpy.array([item.start_volume for item in batch], dtype=float)[:, None]
+        noise = rng.standard_normal((2 if saas else 1, len(batch), paths))
+        if saas:
+            churn = numpy.array([item.churn for item in batch])[:, None]
+            growth = numpy.array([item.growth_rate for item in batch])[:, None]
+            churn = numpy.clip(churn + settings.churn_spread * noise[0], 0, 1)
+            growth = numpy.maximum(growth + settings.growth_spread * noise[1], -1)
+            factor = (1 - churn) * (1 + growth)
+            first = start
+            # Monthly price and cost per subscriber, charged for the period's share of a month
+            unit = months if scaled else 1
+        else:
+            growth = numpy.array([item.growth for item in batch])[:, None]
+            factor = 1 + numpy.maximum(growth + settings.growth_spread * noise[0], -1)
+            # Volumes are per month: a shorter period sells its share
+            first = start * months if scaled else start
+            unit = 1
+        if scaled:
+            factor = numpy.power(factor, months)
+        price = numpy.array([item.price * unit for item in batch])
+        cost = numpy.array([item.cost * unit for item in batch])
+        # Each period is the previous one times the path's factor, like the chained formula
+        volume = numpy.repeat(first, paths, axis=1)
+        for period_idx in range(periods):
+            if period_idx:
+                volume *= factor
+            revenue[period_idx] += price @ volume
+            cogs[period_idx] += cost @ volume
+    return revenue, cogs
+
+
+def simulate_sales(model, map_chunks=None):
+    """P10/P50/P90 bands of total revenue, COGS and gross profit per period for model.simulation.
+    
+    map_chunks(func, arg_tuples) runs the chunks and returns their results in order; by default
+    they run one after another here (GenerationPool.map spreads them over the workers).
+    """
+    import numpy
+    settings = model.simulation
+    periods = model.timeline.periods
+    items = model.sales_items if model.sales_model != 'custom' else []
+    chunks = [(model.sales_items, model.sales_model, model.timeline, settings, chunk_idx,
+               min(SIMULATION_CHUNK_PATHS, settings.paths - chunk_idx * SIMULATION_CHUNK_PATHS))
+              for chunk_idx in range(math.ceil(settings.paths / SIMULATION_CHUNK_PATHS))] if items else []
+    if map_chunks is None or len(chunks) < 2:
+        # Lazily, so only one chunk's totals are held besides the merged ones
+        results = itertools.starmap(_simulate_chunk, chunks)
+    else:
+        mapped = map_chunks(_simulate_chunk, chunks)
+        # Popped as they are merged, so each chunk's totals are freed once copied
+        mapped.reverse()
+        results = (mapped.pop() for _ in range(len(mapped)))
+    # Every path's totals, periods first so a block of periods is contiguous
+    revenue = numpy.zeros((periods, settings.paths if chunks else 1))
+    cogs = numpy.zeros_like(revenue)
+    first_path = 0
+    for chunk_revenue, chunk_cogs in results:
+        last_path = first_path + chunk_revenue.shape[1]
+        revenue[:, first_path:last_path] = chunk_revenue
+        cogs[:, first_path:last_path] = chunk_cogs
+        first_path = last_path
+    bands = {key: {f'p{percentile}': [] for percentile in SIMULATION_PERCENTILES}
+             for key in ('revenue', 'cogs', 'grossProfit')}
+    block = max(SIMULATION_PERCENTILE_BLOCK // revenue.shape[1], 1)
+    for first_period in range(0, periods, block):
+        block_revenue = revenue[first_period:first_period + block]
+        block_cogs = cogs[first_period:first_period + block]
+        for key, totals in (('revenue', block_revenue), ('cogs', block_cogs),
+                            ('grossProfit', block_revenue - block_cogs)):
+            percentiles = numpy.percentile(totals, SIMULATION_PERCENTILES, axis=1)
+            for percentile, row in zip(SIMULATION_PERCENTILES, percentiles):
+                bands[key][f'p{percentile}'].extend(row.tolist())
+    return {
+        'paths': settings.paths,
+        'growthStdDev': settings.growth_spread * 100,
+        'churnStdDev': settings.churn_spread * 100,
+        'seed': settings.seed,
+        'bands': bands,
+    }
+
+
+def simulate_on_pool(model, pool):
+    """simulate_sales(model) with its chunks spread over pool's workers, for a build that then
+    takes one of them. None when there is no Simulation tab or builds run inline, where the
+    build runs the simulation itself.
+    """
+    if model.simulation is None or not model.sales_items or pool is None or pool.inline:
+        return None
+    return simulate_sales(model, pool.map)
+
+
+def _simulation_plan(model, period_headers, simulation=None):
+    """Simulation tab: the P10/P50/P90 bands of the Sales totals as values"""
+    column_widths = {1: 20, 2: 12}
+    for i in range(len(period_headers)):
+        column_widths[i + 3] = 12
+
+    def rows():
+        yield [('Metric', 'header'), ('Percentile', 'header')] + _header_row(period_headers)
+        bands = (simulation or simulate_sales(model))['bands']
+        for label, key in (('Revenue', 'revenue'), ('COGS', 'cogs'), ('Gross Profit', 'grossProfit')):
+            for percentile in SIMULATION_PERCENTILES:
+                row = [(label, None), (f'P{percentile}', None)]
+                row.extend((value, 'currency') for value in bands[key][f'p{percentile}'])
+                yield row
+
+    return SheetPlan('Simulation', rows(), column_widths, 'C2')
+
+
+# === COST ESTIMATE ===
+# A build's time, output size and peak memory grow with its cell count (ModelSize) at
+# rates that depend on the writer. The rates below were measured with
+# `benchmark.py --calibrate`, which prints a new table for other hardware. openpyxl builds
+# over the memory or time budget move to the streaming engine, and are refused if they
+# are over it even so.
+
+# Peak memory and build time a build may be estimated to need (0 disables either budget)
+MAX_BUILD_MEMORY = int(os.environ.get('MAX_BUILD_MEMORY', 512 * 1024 * 1024))
+MAX_BUILD_SECONDS = float(os.environ.get('MAX_BUILD_SECONDS', 120))
+
+# Writer -> (seconds per cell, seconds per build, output bytes per cell, output bytes per
+# build, peak memory bytes per cell)
+COST_PROFILES = {
+    'openpyxl': (3.92e-05, 0.051, 2.67, 1.58e+04, 425),
+    'streaming': (4.03e-06, 0.00599, 2.65, 1.36e+04, 0.979),
+    'streaming-shared': (2.85e-06, 0.00474, 3.24, 8.9e+03, 8.8),
+    'streaming-cached': (4.42e-06, 0.00871, 2.67, 1.92e+04, 58.7),
+    'csv': (1.31e-06, 0.00902, 0.0583, 3.76e+03, 50),
+    'ods': (5.93e-06, 0.0122, 0.612, 1.57e+04, 111),
+}
+# Seconds per simulated path, item and period, and per path and period (merging the chunks
+# and taking the percentiles)
+SIMULATION_STEP_SECONDS = 1.24e-09
+SIMULATION_VALUE_SECONDS = 1.46e-07
+# Seconds a /project simulation may be estimated to take; it runs while the preview waits
+MAX_PROJECTION_SECONDS = float(os.environ.get('MAX_PROJECTION_SECONDS', 10))
+
+
+def cost_profile(options):
+    """The COST_PROFILES writer a build with options uses"""
+    if options.output_format != 'xlsx':
+        return options.output_format
+    if options.engine == 'openpyxl':
+        return 'openpyxl'
+    if options.cached_values:
+        return 'streaming-cached'
+    return 'streaming-shared' if options.shared_formulas else 'streaming'
+
+
+def simulation_cost(size):
+    """Seconds and peak memory bytes of the simulation in a build of size (0 and 0 without one)"""
+    seconds = SIMULATION_STEP_SECONDS * size.simulation_steps + SIMULATION_VALUE_SECONDS * size.simulation_values
+    return seconds, size.simulation_bytes
+
+
+def estimate_cost(size, options=None):
+    """Cells, formulas, output bytes, build seconds and peak memory expected of a build of size"""
+    options = options or OutputOptions()
+    seconds_per_cell, base_seconds, bytes_per_cell, base_bytes, memory_per_cell = COST_PROFILES[cost_profile(options)]
+    simulation_seconds, simulation_bytes = simulation_cost(size)
+    return {
+        'cells': size.cells,
+        'formulas': size.formulas,
+        'bytes': round(base_bytes + bytes_per_cell * size.cells),
+        'seconds': round(base_seconds + seconds_per_cell * size.cells + simulation_seconds, 3),
+        'memoryBytes': round(memory_per_cell * size.cells + simulation_bytes),
+        'format': options.output_format,
+        'engine': options.engine,
+    }
+
+
+def _over_budget(estimate, max_seconds=None, action='build'):
+    """What an estimate is over the memory or time budget (MAX_BUILD_SECONDS by default) by, or None"""
+    max_seconds = MAX_BUILD_SECONDS if max_seconds is None else max_seconds
+    if MAX_BUILD_MEMORY and estimate['memoryBytes'] > MAX_BUILD_MEMORY:
+        return (f"about {estimate['memoryBytes'] / 2 ** 20:,.0f} MB of memory to {action}, "
+                f"over the {MAX_BUILD_MEMORY / 2 ** 20:,.0f} MB budget")
+    if max_seconds and estimate['seconds'] > max_seconds:
+        return f"about {estimate['seconds']:,.0f}s to {action}, over the {max_seconds:g}s budget"
+    return None
+
+
+def budget_options(model, options=None):
+    """The options to build model with: openpyxl moves to the streaming engine when over budget.
+    
+    Raises BudgetExceeded if the build is over the memory or time budget even so.
+    """
+    options = options or OutputOptions()
+    over = _over_budget(estimate_cost(model.size, options))
+    if over and options.engine == 'openpyxl':
+        # The same formulas, dropdowns and styles, written row by row in flat memory
+        options = OutputOptions('streaming', options.formulas, options.values, options.output_format)
+        over = _over_budget(estimate_cost(model.size, options))
+    if over:
+        error = BudgetExceeded(f'The workbook would take {over}')
+        error.size = model.size
+        error.options = options
+        raise error
+    return options
+
+
+def check_projection_budget(model):
+    """Raise BudgetExceeded if model's simulation is over the memory budget or MAX_PROJECTION_SECONDS"""
+    seconds, memory_bytes = simulation_cost(model.size)
+    over = _over_budget({'seconds': seconds, 'memoryBytes': memory_bytes}, MAX_PROJECTION_SECONDS, 'run')
+    if over:
+        error = BudgetExceeded(f'The simulation would take {over}; lower simulation.paths')
+        error.size = model.size
+        raise error
+
+
+def estimate_config(config, options=None):
+    """Pre-flight estimate for POST /estimate: the build's cost, the engine it would use and
+    whether it is within the budgets. Raises ConfigError for an invalid config.
+    """
+    options = options or OutputOptions()
+    try:
+        model = compile_config(config)
+        effective = budget_options(model, options)
+    except BudgetExceeded as e:
+        estimate = estimate_cost(e.size, e.options or options)
+        estimate.update({'withinBudget': False, 'downgraded': False, 'reason': str(e)})
+        return estimate
+    estimate = estimate_cost(model.size, effective)
+    estimate.update({'withinBudget': True, 'downgraded': effective.engine != options.engine})
+    return estimate
+
+
+# === WHAT-IF ===
+# A what-if model keeps the numbers of one generated workbook as NumPy rows, with the
+# formula graph between them at row level:
+#   Sales:     Unit Price -> revenue row; Starting Volume, Growth % and a first volume held
+#              as a value -> volume row -> revenue and COGS rows; Unit Cost -> COGS row;
+#              item rows -> TOTAL rows -> GROSS PROFIT
+#   Staff:     Annual Salary -> period row -> TOTAL
+#   Non-Staff: Annual Cost -> period row -> TOTAL
+# Applying changes to input cells recomputes only the rows they reach and reports the
+# cells whose value moved. The model itself is never modified, so requests can share it.
+
+# Input cells one what-if request may change
+MAX_WHATIF_CHANGES = 1000
+
+_COLUMN_NUMBERS = {letters: col_num for col_num, letters in enumerate(_COLUMN_LETTERS) if letters}
+_CELL_NAME = re.compile(r'([A-Z]{1,3})([0-9]+)')
+
+
+class WhatIfError(ValueError):
+    """Raised for a change that does not set an input cell of the model to a number"""
+
+
+def _changed_cells(cells, old_rows, new_rows, row_numbers, letters):
+    # Adds {cell: new value} for every period cell whose value differs
+    import numpy
+    for old_row, new_row, row_num in zip(old_rows, new_rows, row_numbers):
+        for col_idx in numpy.flatnonzero(old_row != new_row):
+            value = float(new_row[col_idx])
+            cells[f'{letters[col_idx]}{row_num}'] = value if math.isfinite(value) else None
+
+
+class WhatIfModel:
+    """The numeric cells of the workbook a config produces, for what-if recalculation"""
+    
+    def __init__(self, config):
+        import numpy
+        model = compile_config(config)
+        timeline = self.timeline = model.timeline
+        self.sales_model = model.sales_model
+        items = self.items = model.sales_items if model.sales_model != 'custom' else []
+        self.layout = SalesLayout(len(items))
+        self.price = numpy.array([item.price for item in items], dtype=float)
+        self.cost = numpy.array([item.cost for item in items], dtype=float)
+        self.start = numpy.array([item.start_volume for item in items], dtype=float)
+        self.growth = numpy.array([item.growth for item in items], dtype=float)
+        # Weekly non-SaaS volumes are formulas from the first period on; otherwise the
+        # first period is a plain value, written as the starting volume
+        self.first_is_value = model.sales_model == 'saas' or timeline.months_per_period is None
+        self.volume = _sales_volumes(items, model.sales_model, timeline)
+        self.revenue = _sales_amounts(self.volume, self.price, model.sales_model, timeline)
+        self.cogs = _sales_amounts(self.volume, self.cost, model.sales_model, timeline)
+        self.sales_totals = self._sales_totals(self.volume, self.revenue, self.cogs)
+        self.sales_letters = _period_letters(5, timeline.periods)
+        
+        # Salaries and annual costs are written as 0, so every period row starts at 0
+        self.salary_col = 6 if model.extra_name is not None else 5
+        self.staff = _cost_rows([0] * model.staff_row_count, timeline)
+        self.staff_letters = _period_letters(self.salary_col + 1, timeline.periods)
+        self.non_staff = _cost_rows([0] * (0 if model.non_staff_template else len(model.non_staff_lines)), timeline)
+        self.non_staff_letters = _period_letters(4, timeline.periods)
+    
+    @staticmethod
+    def _sales_totals(volume, revenue, cogs):
+        total_revenue = revenue.sum(axis=0)
+        total_cogs = cogs.sum(axis=0)
+        return volume.sum(axis=0), total_revenue, total_cogs, total_revenue - total_cogs
+    
+    def _input(self, change):
+        """(sheet, field, row index, value) of one {"sheet", "cell", "value"} change"""
+        if not isinstance(change, dict):
+            raise WhatIfError('Each change must be a JSON object with sheet, cell and value')
+        sheet = change.get('sheet')
+        cell = str(change.get('cell', '')).upper()
+        where = f'{sheet}!{cell}'
+        match = _CELL_NAME.fullmatch(cell)
+        if match is None or match[1] not in _COLUMN_NUMBERS:
+            raise WhatIfError(f'{where} is not a cell reference')
+        col_num, row_num = _COLUMN_NUMBERS[match[1]], int(match[2])
+        if 'value' not in change:
+            raise WhatIfError(f'{where} has no value')
+        value = change.get('value')
+        try:
+            value = _to_float(value)
+        except (TypeError, ValueError):
+            raise WhatIfError(f'{where} must be set to a number, got {value!r}')
+        
+        # The revenue and COGS rows show Growth % but no formula reads it ('display')
+        field = None
+        if sheet == 'Sales' and self.items:
+            layout = self.layout
+            item_count = len(self.items)
+            for first_row, fields in ((layout.revenue_start_row, {3: 'price', 4: 'display'}),
+                                      (layout.volume_start_row, {3: 'start', 4: 'growth', 5: 'first'}),
+                                      (layout.cogs_start_row, {3: 'cost', 4: 'display'})):
+                if first_row <= row_num < first_row + item_count:
+                    field = fields.get(col_num)
+                    if field == 'first' and not self.first_is_value:
+                        field = None
+                    idx = row_num - first_row
+                    break
+        elif sheet == 'Staff' and col_num == self.salary_col and 2 <= row_num < 2 + len(self.staff):
+            field, idx = 'salary', row_num - 2
+        elif sheet == 'Non-Staff' and col_num == 3 and 2 <= row_num < 2 + len(self.non_staff):
+            field, idx = 'annual', row_num - 2
+        if field is None:
+            raise WhatIfError(f'{where} is not an input cell (prices, costs, volumes, growth rates, '
+                              'salaries and annual costs can be changed)')
+        return sheet, field, idx, value
+    
+    def apply(self, changes):
+        """The cells whose value changes when the input cells are set, as {sheet: {cell: value}}.
+        
+        Raises WhatIfError for a change that is not a number for an input cell.
+        """
+        if not isinstance(changes, list) or len(changes) > MAX_WHATIF_CHANGES:
+            raise WhatIfError(f'changes must be a JSON array of up to {MAX_WHATIF_CHANGES} changes')
+        sales = {}
+        costs = {'Staff': {}, 'Non-Staff': {}}
+        for sheet, field, idx, value in [self._input(change) for change in changes]:
+            if sheet == 'Sales':
+                sales.setdefault(idx, {})[field] = value
+            else:
+                costs[sheet][idx] = value
+        
+        changed = {}
+        if sales:
+            changed['Sales'] = self._apply_sales(sales)
+        if costs['Staff']:
+            changed['Staff'] = self._apply_costs(self.staff, costs['Staff'], self.staff_letters)
+        if costs['Non-Staff']:
+            changed['Non-Staff'] = self._apply_costs(self.non_staff, costs['Non-Staff'], self.non_staff_letters)
+        return {sheet: cells for sheet, cells in changed.items() if cells}
+    
+    def _apply_sales(self, changes):
+        import numpy
+        rows = sorted(changes)
+        price = self.price[rows]
+        cost = self.cost[rows]
+        start = self.start[rows]
+        growth = self.growth[rows]
+        first = self.start[rows]
+        for position, idx in enumerate(rows):
+            fields = changes[idx]
+            price[position] = fields.get('price', price[position])
+            cost[position] = fields.get('cost', cost[position])
+            start[position] = fields.get('start', start[position])
+            growth[position] = fields.get('growth', growth[position])
+            first[position] = fields.get('first', first[position])
+        
+        # Volume rows are only recomputed for items whose volume inputs changed
+        volume_rows = self.volume[rows]
+        moved = [position for position, idx in enumerate(rows) if changes[idx].keys() & {'start', 'growth', 'first'}]
+        if moved:
+            items = [SalesItem(self.items[rows[position]].name, price[position], start[position], growth[position],
+                               cost[position], self.items[rows[position]].churn,
+                               self.items[rows[position]].growth_rate)
+                     for position in moved]
+            volume_rows[moved] = _sales_volumes(items, self.sales_model, self.timeline, first[moved])
+        revenue_rows = _sales_amounts(volume_rows, price, self.sales_model, self.timeline)
+        cogs_rows = _sales_amounts(volume_rows, cost, self.sales_model, self.timeline)
+        
+        layout = self.layout
+        letters = self.sales_letters
+        cells = {}
+        _changed_cells(cells, self.revenue[rows], revenue_rows, [layout.revenue_start_row + idx for idx in rows],
+                       letters)
+        _changed_cells(cells, self.volume[rows], volume_rows, [layout.volume_start_row + idx for idx in rows],
+                       letters)
+        _changed_cells(cells, self.cogs[rows], cogs_rows, [layout.cogs_start_row + idx for idx in rows], letters)
+        
+        # The TOTAL rows sum every item, as the SUM formulas do
+        volume = self.volume.copy()
+        revenue = self.revenue.copy()
+        cogs = self.cogs.copy()
+        volume[rows] = volume_rows
+        revenue[rows] = revenue_rows
+        cogs[rows] = cogs_rows
+        totals = self._sales_totals(volume, revenue, cogs)
+        _changed_cells(cells, numpy.array(self.sales_totals), numpy.array(totals),
+                       [layout.total_vol_row, layout.total_rev_row, layout.total_cogs_row, layout.gross_profit_row],
+                       letters)
+        return cells
+    
+    def _apply_costs(self, matrix, changes, letters):
+        rows = sorted(changes)
+        new_rows = _cost_rows([changes[idx] for idx in rows], self.timeline)
+        cells = {}
+        _changed_cells(cells, matrix[rows], new_rows, [2 + idx for idx in rows], letters)
+        updated = matrix.copy()
+        updated[rows] = new_rows
+        _changed_cells(cells, [matrix.sum(axis=0)], [updated.sum(axis=0)], [2 + len(matrix)], letters)
+        return cells
+
+
+class WhatIfModels:
+    """What-if models by id, built from a config on first use; the least recently used are dropped.
+    
+    shared_configs, in prefork mode, is the supervisor's WhatIfConfigs, so that a model built by
+    one process can be rebuilt by another from its id.
+    """
+    
+    def __init__(self, max_models=WHATIF_MODELS, shared_configs=None):
+        self.max_models = max_models
+        self.shared_configs = shared_configs
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, model_id):
+        with self._lock:
+            model = self._models.get(model_id)
+            if model is not None:
+                self._models.move_to_end(model_id)
+                return model
+        config = self.shared_configs.get(model_id) if self.shared_configs is not None else None
+        return self._keep(model_id, WhatIfModel(config)) if config is not None else None
+    
+    def load(self, config):
+        """(id, model) for config, building the model if it is not kept yet; raises ConfigError"""
+        model_id = hashlib.sha256(json.dumps(config, sort_keys=True, separators=(',', ':')).encode()).hexdigest()[:24]
+        model = self.get(model_id)
+        if model is None:
+            model = self._keep(model_id, WhatIfModel(config))
+            if self.shared_configs is not None:
+                self.shared_configs.put(model_id, config)
+        return model_id, model
+    
+    def _keep(self, model_id, model):
+        with self._lock:
+            self._models[model_id] = model
+            while len(self._models) > max(self.max_models, 1):
+                self._models.popitem(last=False)
+        return model
+
+
+class WhatIfConfigs:
+    """The configs of what-if models by id, kept by the prefork supervisor for every process"""
+    
+    def __init__(self, max_configs=WHATIF_MODELS):
+        self.max_configs = max_configs
+        self._configs = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, model_id):
+        with self._lock:
+            config = self._configs.get(model_id)
+            if config is not None:
+                self._configs.move_to_end(model_id)
+            return config
+    
+    def put(self, model_id, config):
+        with self._lock:
+            self._configs[model_id] = config
+            self._configs.move_to_end(model_id)
+            while len(self._configs) > max(self.max_configs, 1):
+                self._configs.popitem(last=False)
+
+
+# === OPENPYXL ENGINE ===
+# openpyxl takes a few hundred milliseconds to import, so it is loaded on first use (or in
+# the background once the port is bound, see PRELOAD_OPENPYXL) instead of at module load.
+
+_OPENPYXL = None
+_OPENPYXL_LOCK = threading.Lock()
+
+
+def load_openpyxl():
+    """Import openpyxl once and return the names the engine uses"""
+    global _OPENPYXL
+    if _OPENPYXL is not None:
+        return _OPENPYXL
+    with _OPENPYXL_LOCK:
+        if _OPENPYXL is None:
+            started = time.perf_counter()
+            from openpyxl import Workbook
+            from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
+            from openpyxl.styles.fonts import DEFAULT_FONT
+            from openpyxl.worksheet.datavalidation import DataValidation
+            from openpyxl.worksheet.formula import ArrayFormula
+            
+            class SharedFormula(ArrayFormula):
+                """openpyxl writes any ArrayFormula's attributes verbatim, so reuse it for t="shared" cells"""
+                
+                t = 'shared'
+                
+                def __init__(self, shared):
+                    super().__init__(shared.ref, shared.text)
+                    self.si = shared.si
+                
+                def __iter__(self):
+                    yield 't', self.t
+                    if self.ref:
+                        yield 'ref', self.ref
+                    yield 'si', str(self.si)
+            
+            _OPENPYXL = types.SimpleNamespace(
+                Workbook=Workbook, Font=Font, PatternFill=PatternFill, Alignment=Alignment,
+                NamedStyle=NamedStyle, DEFAULT_FONT=DEFAULT_FONT, DataValidation=DataValidation,
+                SharedFormula=SharedFormula,
+            )
+            record_startup('openpyxl_import', time.perf_counter() - started)
+    return _OPENPYXL
+
+
+def _register_named_styles(workbook, xl):
+    """Add every CELL_STYLES entry to the workbook as a NamedStyle, returns key -> style name"""
+    names = {}
+    for key, spec in CELL_STYLES.items():
+        style = xl.NamedStyle(name=f'{STYLE_NAME_PREFIX}{key}')
+        # Styles without a font keep the workbook's default font
+        style.font = xl.Font(**spec['font']) if 'font' in spec else copy(xl.DEFAULT_FONT)
+        if 'fill' in spec:
+            style.fill = xl.PatternFill(start_color=spec['fill'], end_color=spec['fill'], fill_type='solid')
+        if spec.get('center'):
+            style.alignment = xl.Alignment(horizontal='center', vertical='center')
+        if 'number_format' in spec:
+            style.number_format = spec['number_format']
+        workbook.add_named_style(style)
+        names[key] = style.name
+    return names
+
+
+def _save_openpyxl(plans, fileobj):
+    """Build the workbook in memory with openpyxl and save it"""
+    xl = load_openpyxl()
+    workbook = xl.Workbook()
+    workbook.remove(workbook.active)
+    style_names = _register_named_styles(workbook, xl)
+
+    for plan in plans:
+        sheet = workbook.create_sheet(plan.title)
+
+        for col_num, width in plan.column_widths.items():
+            sheet.column_dimensions[_column_letter(col_num)].width = width
+
+        for row_idx, row in enumerate(plan.rows, 1):
+            for col_idx, spec in enumerate(row, 1):
+                if spec is None:
+                    continue
+                value, style = spec[:2]
+                if isinstance(value, SharedFormula):
+                    value = xl.SharedFormula(value)
+                cell = sheet.cell(row=row_idx, column=col_idx, value=value)
+                if style:
+                    cell.style = style_names[style]
+
+        for cell_range in plan.merged_cells:
+            sheet.merge_cells(cell_range)
+
+        for validation in plan.validations:
+            data_validation = xl.DataValidation(
+                type="list",
+                formula1=validation.formula1,
+                allow_blank=validation.allow_blank
+            )
+            sheet.add_data_validation(data_validation)
+            data_validation.add(validation.sqref)
+
+        if plan.freeze_panes:
+            sheet.freeze_panes = plan.freeze_panes
+
+    workbook.save(fileobj)
+
+
+# === STREAMING ENGINE ===
+# Writes SpreadsheetML straight into the zip archive row by row, so memory stays
+# flat however many rows a tab has.
+
+_XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_NS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_NS_PKG_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_BUILTIN_NUMBER_FORMATS = {'General': 0, '0': 1, '0.00': 2, '#,##0': 3, '#,##0.00': 4, '0%': 9, '0.00%': 10}
+
+# Rows buffered before each write to the zip stream
+_STREAM_FLUSH_ROWS = 256
+
+
+def _xml_escape(text):
+    return escape(_XML_ILLEGAL_CHARS.sub('', text))
+
+
+def _stylesheet_xml():
+    """styles.xml with one named cell style per CELL_STYLES entry, in registry order"""
+    num_fmts = {}
+    fonts = ['<font><sz val="11"/><name val="Calibri"/><family val="2"/></font>']
+    fills = ['<fill><patternFill patternType="none"/></fill>', '<fill><patternFill patternType="gray125"/></fill>']
+    style_xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>']
+    xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+    cell_styles = ['<cellStyle name="Normal" xfId="0" builtinId="0"/>']
+
+    for xf_id, (key, spec) in enumerate(CELL_STYLES.items(), 1):
+        font_id = fill_id = num_fmt_id = 0
+        attrs = ''
+        if 'font' in spec:
+            font = spec['font']
+            xml = '<font>'
+            if font.get('bold'):
+                xml += '<b val="1"/>'
+            if 'size' in font:
+                xml += f'<sz val="{font["size"]}"/>'
+            if 'color' in font:
+                xml += f'<color rgb="00{font["color"]}"/>'
+            xml += '</font>'
+            if xml not in fonts:
+                fonts.append(xml)
+            font_id = fonts.index(xml)
+            attrs += ' applyFont="1"'
+        if 'fill' in spec:
+            xml = (f'<fill><patternFill patternType="solid"><fgColor rgb="00{spec["fill"]}"/>'
+                   f'<bgColor rgb="00{spec["fill"]}"/></patternFill></fill>')
+            if xml not in fills:
+                fills.append(xml)
+            fill_id = fills.index(xml)
+            attrs += ' applyFill="1"'
+        if 'number_format' in spec:
+            code = spec['number_format']
+            num_fmt_id = _BUILTIN_NUMBER_FORMATS.get(code)
+            if num_fmt_id is None:
+                num_fmt_id = num_fmts.setdefault(code, 164 + len(num_fmts))
+            attrs += ' applyNumberFormat="1"'
+        xf = f'<xf numFmtId="{num_fmt_id}" fontId="{font_id}" fillId="{fill_id}" borderId="0"{attrs}'
+        if spec.get('center'):
+            tail = ' applyAlignment="1"><alignment horizontal="center" vertical="center"/></xf>'
+        else:
+            tail = '/>'
+        # The named style itself, and the cell format that applies it
+        style_xfs.append(xf + tail)
+        xfs.append(f'{xf} xfId="{xf_id}"{tail}')
+        cell_styles.append(f'<cellStyle name="{_xml_escape(STYLE_NAME_PREFIX + key)}" xfId="{xf_id}"/>')
+
+    num_fmts_xml = ''.join(f'<numFmt numFmtId="{num_fmt_id}" formatCode="{_xml_escape(code)}"/>'
+                           for code, num_fmt_id in num_fmts.items())
+    return (
+        f'{_XML_DECL}<styleSheet xmlns="{_NS_MAIN}">'
+        f'<numFmts count="{len(num_fmts)}">{num_fmts_xml}</numFmts>'
+        f'<fonts count="{len(fonts)}">{"".join(fonts)}</fonts>'
+        f'<fills count="{len(fills)}">{"".join(fills)}</fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        f'<cellStyleXfs count="{len(style_xfs)}">{"".join(style_xfs)}</cellStyleXfs>'
+        f'<cellXfs count="{len(xfs)}">{"".join(xfs)}</cellXfs>'
+        f'<cellStyles count="{len(cell_styles)}">{"".join(cell_styles)}</cellStyles>'
+        '</styleSheet>'
+    )
+
+
+# The registry is fixed, so the stylesheet is rendered once per process
+_STYLESHEET_XML = _stylesheet_xml()
+
+
+# cellXfs index of each named style (0 is the default style)
+_STYLE_XF_IDS = {name: idx for idx, name in enumerate(CELL_STYLES, 1)}
+
+
+def _cell_xml(ref, value, style, cached=None):
+    style_attr = f' s="{_STYLE_XF_IDS[style]}"' if style else ''
+    if value is None or value == '':
+        return f'<c r="{ref}"{style_attr}/>' if style else ''
+    # Precomputed formula result, for readers that do not recalculate
+    cached_xml = f'<v>{cached!r}</v>' if cached is not None and math.isfinite(cached) else ''
+    if isinstance(value, SharedFormula):
+        if value.text is None:
+            return f'<c r="{ref}"{style_attr}><f t="shared" si="{value.si}"/>{cached_xml}</c>'
+        return (f'<c r="{ref}"{style_attr}><f t="shared" ref="{value.ref}" si="{value.si}">'
+                f'{_xml_escape(value.text[1:])}</f>{cached_xml}</c>')
+    if isinstance(value, str):
+        if value.startswith('='):
+            return f'<c r="{ref}"{style_attr}><f>{_xml_escape(value[1:])}</f>{cached_xml or "<v></v>"}</c>'
+        space = ' xml:space="preserve"' if value != value.strip() else ''
+        return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t{space}>{_xml_escape(value)}</t></is></c>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    return f'<c r="{ref}"{style_attr} t="n"><v>{value!r}</v></c>'
+
+
+def _sheet_view_xml(freeze_panes):
+    if not freeze_panes:
+        return '<sheetViews><sheetView workbookViewId="0"/></sheetViews>'
+    col_letters = freeze_panes.rstrip('0123456789')
+    x_split = sum((ord(c) - 64) * 26 ** i for i, c in enumerate(reversed(col_letters))) - 1
+    y_split = int(freeze_panes[len(col_letters):]) - 1
+    if x_split and y_split:
+        pane = 'bottomRight'
+    elif x_split:
+        pane = 'topRight'
+    else:
+        pane = 'bottomLeft'
+    splits = (f' xSplit="{x_split}"' if x_split else '') + (f' ySplit="{y_split}"' if y_split else '')
+    return (
+        '<sheetViews><sheetView workbookViewId="0">'
+        f'<pane{splits} topLeftCell="{freeze_panes}" activePane="{pane}" state="frozen"/>'
+        f'<selection pane="{pane}" activeCell="{freeze_panes}" sqref="{freeze_panes}"/>'
+        '</sheetView></sheetViews>'
+    )
+
+
+def _cols_xml(column_widths):
+    if not column_widths:
+        return ''
+    # Collapse runs of equal widths into one <col> element
+    spans = []
+    for col_num in sorted(column_widths):
+        width = column_widths[col_num]
+        if spans and spans[-1][1] == col_num - 1 and spans[-1][2] == width:
+            spans[-1][1] = col_num
+        else:
+            spans.append([col_num, col_num, width])
+    cols = ''.join(f'<col min="{first}" max="{last}" width="{width}" customWidth="1"/>'
+                   for first, last, width in spans)
+    return f'<cols>{cols}</cols>'
+
+
+def _row_xml(row, row_idx, letters):
+    while len(letters) < len(row):
+        letters.append(_column_letter(len(letters) + 1))
+    cells = ''.join(
+        _cell_xml(f'{letters[col_idx]}{row_idx}', *spec)
+        for col_idx, spec in enumerate(row) if spec is not None
+    )
+    return f'<row r="{row_idx}">{cells}</row>' if cells else f'<row r="{row_idx}"/>'
+
+
+def _write_sheet_xml(plan, stream):
+    # Everything before the rows only depends on the layout, so skeletons keep it rendered
+    rendered = plan.skeleton.rendered if plan.skeleton is not None else {}
+    head = rendered.get(plan.freeze_panes)
+    if head is None:
+        head = rendered[plan.freeze_panes] = (
+            f'{_XML_DECL}<worksheet xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+            '<sheetPr><outlinePr summaryBelow="1" summaryRight="1"/></sheetPr>'
+            f'{_sheet_view_xml(plan.freeze_panes)}'
+            '<sheetFormatPr baseColWidth="8" defaultRowHeight="15"/>'
+            f'{_cols_xml(plan.column_widths)}<sheetData>'
+        ).encode('utf-8')
+    stream.write(head)
+
+    letters = []
+    buffer = []
+    for row_idx, row in enumerate(plan.rows, 1):
+        if type(row) is TemplateRow:
+            xml = row.rendered.get(row_idx)
+            if xml is None:
+                xml = _row_xml(row, row_idx, letters)
+                if len(row.rendered) < MAX_TEMPLATE_ROW_POSITIONS:
+                    row.rendered[row_idx] = xml
+            buffer.append(xml)
+        else:
+            buffer.append(_row_xml(row, row_idx, letters))
+        if len(buffer) >= _STREAM_FLUSH_ROWS:
+            stream.write(''.join(buffer).encode('utf-8'))
+            buffer = []
+    buffer.append('</sheetData>')
+
+    if plan.merged_cells:
+        merges = ''.join(f'<mergeCell ref="{ref}"/>' for ref in plan.merged_cells)
+        buffer.append(f'<mergeCells count="{len(plan.merged_cells)}">{merges}</mergeCells>')
+
+    if plan.validations:
+        buffer.append(f'<dataValidations count="{len(plan.validations)}">')
+        for validation in plan.validations:
+            sqref = validation.sqref
+            buffer.append(
+                f'<dataValidation type="list" allowBlank="{int(validation.allow_blank)}" '
+                f'showInputMessage="0" showErrorMessage="0" sqref="{sqref}">'
+                f'<formula1>{_xml_escape(validation.formula1)}</formula1></dataValidation>'
+            )
+        buffer.append('</dataValidations>')
+
+    buffer.append('<pageMargins left="0.75" right="0.75" top="1" bottom="1" header="0.5" footer="0.5"/></worksheet>')
+    stream.write(''.join(buffer).encode('utf-8'))
+
+
+def _save_streaming(plans, fileobj):
+    """Stream SpreadsheetML for each plan into an xlsx archive"""
+    sheet_count = len(plans)
+    sheet_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+    overrides = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{idx}.xml" ContentType="{sheet_type}"/>'
+        for idx in range(1, sheet_count + 1)
+    )
+    content_types = (
+        f'{_XML_DECL}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '<Override PartName="/docProps/core.xml" '
+        'ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>'
+        '<Override PartName="/docProps/app.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.extended-properties+xml"/>'
+        f'{overrides}</Types>'
+    )
+    root_rels = (
+        f'{_XML_DECL}<Relationships xmlns="{_NS_PKG_REL}">'
+        f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+        '<Relationship Id="rId2" '
+        'Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" '
+        'Target="docProps/core.xml"/>'
+        f'<Relationship Id="rId3" Type="{_NS_REL}/extended-properties" Target="docProps/app.xml"/>'
+        '</Relationships>'
+    )
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    core = (
+        f'{_XML_DECL}<cp:coreProperties '
+        'xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+        '<dc:creator>Business Data Builder</dc:creator>'
+        f'<dcterms:created xsi:type="dcterms:W3CDTF">{now}</dcterms:created>'
+        f'<dcterms:modified xsi:type="dcterms:W3CDTF">{now}</dcterms:modified>'
+        '</cp:coreProperties>'
+    )
+    app = (
+        f'{_XML_DECL}<Properties '
+        'xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties">'
+        '<Application>Business Data Builder</Application></Properties>'
+    )
+    sheets = ''.join(
+        f'<sheet name="{_xml_escape(plan.title)}" sheetId="{idx}" r:id="rId{idx}"/>'
+        for idx, plan in enumerate(plans, 1)
+    )
+    workbook_xml = (
+        f'{_XML_DECL}<workbook xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+        '<bookViews><workbookView activeTab="0"/></bookViews>'
+        f'<sheets>{sheets}</sheets><calcPr calcId="124519" fullCalcOnLoad="1"/></workbook>'
+    )
+    workbook_rels = ''.join(
+        f'<Relationship Id="rId{idx}" Type="{_NS_REL}/worksheet" Target="worksheets/sheet{idx}.xml"/>'
+        for idx in range(1, sheet_count + 1)
+    )
+    workbook_rels = (
+        f'{_XML_DECL}<Relationships xmlns="{_NS_PKG_REL}">{workbook_rels}'
+        f'<Relationship Id="rId{sheet_count + 1}" Type="{_NS_REL}/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    )
+
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', content_types)
+        archive.writestr('_rels/.rels', root_rels)
+        archive.writestr('docProps/core.xml', core)
+        archive.writestr('docProps/app.xml', app)
+        archive.writestr('xl/workbook.xml', workbook_xml)
+        archive.writestr('xl/_rels/workbook.xml.rels', workbook_rels)
+        archive.writestr('xl/styles.xml', _STYLESHEET_XML)
+        for idx, plan in enumerate(plans, 1):
+            with archive.open(f'xl/worksheets/sheet{idx}.xml', 'w') as stream:
+                _write_sheet_xml(plan, stream)
+
+
+# === CSV AND ODS EXPORT ===
+# Unstyled formats for data pipelines, written from the same plans row by row. Plans are
+# built with cached values (see OutputOptions), so formula cells carry their results.
+
+# OpenFormula wraps cell references in brackets: A1 -> [.A1], A1:B2 -> [.A1:.B2]
+_CELL_REFERENCE = re.compile(r'(?<![A-Z])([A-Z]{1,3}[0-9]+)(?::([A-Z]{1,3}[0-9]+))?')
+
+_NS_ODS = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:of="urn:oasis:names:tc:opendocument:xmlns:of:1.2"'
+)
+
+
+def _cell_value(spec):
+    """What a cell shows: the cached result for a formula, the value otherwise"""
+    value = spec[0]
+    if isinstance(value, SharedFormula) or (isinstance(value, str) and value.startswith('=')):
+        cached = spec[2] if len(spec) > 2 else None
+        return cached if cached is not None and math.isfinite(cached) else None
+    return value
+
+
+def _csv_name(title, used):
+    name = re.sub(r'[^A-Za-z0-9_-]+', '_', title).strip('_').lower() or 'sheet'
+    while name in used:
+        name += '_'
+    used.add(name)
+    return f'{name}.csv'
+
+
+def _save_csv(plans, fileobj):
+    """Write a ZIP with one CSV of computed values per plan"""
+    used = set()
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for plan in plans:
+            with archive.open(_csv_name(plan.title, used), 'w') as stream:
+                text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+                writer = csv.writer(text)
+                for row in plan.rows:
+                    writer.writerow(['' if spec is None else _cell_value(spec) for spec in row])
+                text.flush()
+                text.detach()
+
+
+def _ods_formula(formula):
+    return 'of:=' + _CELL_REFERENCE.sub(
+        lambda match: f'[.{match[1]}:.{match[2]}]' if match[2] else f'[.{match[1]}]', formula[1:])
+
+
+def _ods_cell_xml(spec):
+    if spec is None:
+        return '<table:table-cell/>'
+    value = spec[0]
+    if isinstance(value, str) and value.startswith('='):
+        result = spec[2] if len(spec) > 2 else None
+        result_attrs = (f' office:value-type="float" office:value="{result!r}"'
+                        if result is not None and math.isfinite(result) else '')
+        return f'<table:table-cell table:formula="{_xml_escape(_ods_formula(value))}"{result_attrs}/>'
+    if value is None or value == '':
+        return '<table:table-cell/>'
+    if isinstance(value, str):
+        return f'<table:table-cell office:value-type="string"><text:p>{_xml_escape(value)}</text:p></table:table-cell>'
+    if isinstance(value, bool):
+        return f'<table:table-cell office:value-type="boolean" office:boolean-value="{str(value).lower()}"/>'
+    return f'<table:table-cell office:value-type="float" office:value="{value!r}"/>'
+
+
+def _save_ods(plans, fileobj):
+    """Stream an OpenDocument spreadsheet: plain formulas with their results, no styling"""
+    manifest = (
+        f'{_XML_DECL}<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+        'manifest:version="1.2">'
+        f'<manifest:file-entry manifest:full-path="/" manifest:media-type="{ODS_CONTENT_TYPE}"/>'
+        '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+        '</manifest:manifest>'
+    )
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # The mimetype entry must come first and uncompressed
+        archive.writestr('mimetype', ODS_CONTENT_TYPE, zipfile.ZIP_STORED)
+        archive.writestr('META-INF/manifest.xml', manifest)
+        with archive.open('content.xml', 'w') as stream:
+            stream.write(f'{_XML_DECL}<office:document-content {_NS_ODS} office:version="1.2">'
+                         '<office:body><office:spreadsheet>'.encode('utf-8'))
+            for plan in plans:
+                buffer = [f'<table:table table:name="{_xml_escape(plan.title)}">']
+                for row in plan.rows:
+                    buffer.append(f'<table:table-row>{"".join(_ods_cell_xml(spec) for spec in row)}</table:table-row>'
+                                  if row else '<table:table-row><table:table-cell/></table:table-row>')
+                    if len(buffer) >= _STREAM_FLUSH_ROWS:
+                        stream.write(''.join(buffer).encode('utf-8'))
+                        buffer = []
+                buffer.append('</table:table>')
+                stream.write(''.join(buffer).encode('utf-8'))
+            stream.write(b'</office:spreadsheet></office:body></office:document-content>')
+
+
+# Writers for the formats other than xlsx, which is written by the selected engine
+EXPORT_WRITERS = {
+    'csv': _save_csv,
+    'ods': _save_ods,
+}
+
+
+# Identifies this version of the generator, so cached files from older code are not reused
+with open(__file__, 'rb') as _source:
+    _SOURCE_VERSION = hashlib.sha256(_source.read()).hexdigest()
+
+# Output engines: 'openpyxl' builds the workbook in memory, 'streaming' writes
+# SpreadsheetML row by row
+WORKBOOK_ENGINES = {
+    'openpyxl': _save_openpyxl,
+    'streaming': _save_streaming,
+}
+
+
+class TimedRows:
+    """Wraps a plan's rows and records how long the engine spends between the first and last row"""
+    
+    def __init__(self, rows, on_start=None, on_finish=None):
+        self._rows = iter(rows)
+        self._on_start = on_start
+        self._on_finish = on_finish
+        self.started = None
+        self.finished = None
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        if self.started is None:
+            if self._on_start is not None:
+                self._on_start()
+            self.started = time.perf_counter()
+        try:
+            return next(self._rows)
+        except StopIteration:
+            if self.finished is None:
+                self.finished = time.perf_counter()
+                if self._on_finish is not None:
+                    self._on_finish()
+            raise
+    
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+def build_workbook(config, fileobj, options=None, timings=None, progress=None, simulation=None):
+    """Generate Excel workbook based on configuration and write it to fileobj (a path or file object).
+    
+    config may be a raw config or a CompiledConfig. If a timings dict is given it is filled
+    with seconds per phase: compile, month_headers (the period labels), sales, staff, non_staff and save
+    (everything the engine does outside the tabs). progress, if given, is called with each
+    tab's title as it starts and 'save' after it. simulation is the simulate_sales result
+    when it has already been run (see simulate_on_pool).
+    """
+    options = options or OutputOptions()
+    started = time.perf_counter()
+    model = compile_config(config)
+    options = budget_options(model, options)
+    compiled = time.perf_counter()
+    period_headers = model.timeline.headers()
+    headers_done = time.perf_counter()
+    plans = workbook_plans(model, shared_formulas=options.shared_formulas,
+                           cached_values=options.cached_values, period_headers=period_headers,
+                           simulation=simulation)
+    if timings is not None or progress is not None:
+        for plan in plans:
+            on_start = on_finish = None
+            if progress is not None:
+                on_start = functools.partial(progress, plan.title)
+                on_finish = functools.partial(progress, 'save')
+            plan.rows = TimedRows(plan.rows, on_start, on_finish)
+    writer = EXPORT_WRITERS.get(options.output_format) or WORKBOOK_ENGINES[options.engine]
+    writer(plans, fileobj)
+    if timings is not None:
+        finished = time.perf_counter()
+        timings['compile'] = compiled - started
+        timings['month_headers'] = headers_done - compiled
+        for plan in plans:
+            timings[plan.title.lower().replace('-', '_')] = plan.rows.elapsed
+        timings['save'] = finished - headers_done - sum(plan.rows.elapsed for plan in plans)
+    return fileobj
+
+
+def workbook_cache_key(config, options=None):
+    """Content address of the workbook a request would produce"""
+    options = options or OutputOptions()
+    digest = hashlib.sha256()
+    digest.update(_SOURCE_VERSION.encode())
+    digest.update(options.cache_token().encode())
+    digest.update(str(STAFF_SPARE_ROWS).encode())
+    # Period headers depend on the current date, so tomorrow's file may differ; the
+    # config's timeline falls back to the server's defaults
+    digest.update(f'{datetime.now().date()}|{FORECAST_GRANULARITY}|{FORECAST_YEARS}'.encode())
+    digest.update(json.dumps(config, sort_keys=True, separators=(',', ':')).encode())
+    return digest.hexdigest()
+
+
+def render_workbook(config, options=None):
+    """Generate Excel workbook based on configuration and return the xlsx bytes"""
+    buffer = io.BytesIO()
+    build_workbook(config, buffer, options)
+    return buffer.getvalue()
+
+
+# Smallest config that still builds every tab, for warming up workers
+WARMUP_CONFIG = {
+    'selectedTeams': ['Operations'],
+    'employeeCounts': {'Operations': 1},
+    'extraCategory': None,
+    'nonStaffItems': {'🏢 Facilities & Premises|Rent': True},
+    'nonStaffQuantities': {},
+    'salesModel': 'product',
+    'salesItems': [{'productName': 'Product', 'startingUnits': '1', 'unitPrice': '1',
+                    'costPerUnit': '0', 'monthlyGrowth': '0'}],
+}
+
+
+def warm_up():
+    """Import openpyxl and throw away one build in each engine, so the first real build is not slower"""
+    load_openpyxl()
+    for engine in WORKBOOK_ENGINES:
+        render_workbook(WARMUP_CONFIG, OutputOptions(engine, values='none'))
+
+
+def render_workbook_timed(config, options=None, progress=None, simulation=None):
+    """Like render_workbook, also returning the phase timings (for builds in worker processes)"""
+    buffer = io.BytesIO()
+    timings = {}
+    build_workbook(config, buffer, options, timings, progress, simulation)
+    return buffer.getvalue(), timings
+
+
+class BusinessDataServer(ThreadingHTTPServer):
+    """Threaded HTTP front end; workbook builds go to a process pool"""
+    
+    daemon_threads = True
+    
+    def __init__(self, server_address, handler_class, workers=GENERATION_WORKERS,
+                 queue_depth=GENERATION_QUEUE_DEPTH, listen_socket=None):
+        self._connections_lock = threading.Lock()
+        self.active_connections = 0
+        self.requests_handled = 0
+        super().__init__(server_address, handler_class, bind_and_activate=listen_socket is None)
+        if listen_socket is not None:
+            # A prefork process accepts on the supervisor's socket. Non-blocking, so losing
+            # a connection to another process does not block the serve loop in accept()
+            self.socket.close()
+            self.socket = listen_socket
+            self.socket.setblocking(False)
+            self.server_address = self.socket.getsockname()
+        self.generation_pool = GenerationPool(workers, queue_depth)
+        self.workbook_cache = WorkbookCache() if WORKBOOK_CACHE_BYTES > 0 else None
+        self.static_assets = StaticAssetStore(os.path.dirname(os.path.abspath(__file__)))
+        job_store = FileJobStore(JOB_STORE_DIR) if JOB_STORE_DIR else MemoryJobStore()
+        self.job_runner = JobRunner(job_store, self.generation_pool)
+        self.what_if_models = WhatIfModels()
+        self.admission = AdmissionControl()
+        # Set by serve_process in prefork mode: where this process publishes its figures, and as which process
+        self.process_board = None
+        self.process_slot = None
+    
+    def warm_up(self, preload=PRELOAD_OPENPYXL, warm_workers=WARM_WORKERS):
+        """Runs in a background thread once the port is bound"""
+        if preload:
+            load_openpyxl()
+        if warm_workers:
+            self.generation_pool.warm(warm_up)
+            record_startup('warm')
+        print(f"⏱️  Startup: {', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in STARTUP_TIMINGS.items())}")
+    
+    def sample_gauges(self):
+        """Set the pool and cache gauges in METRICS to their current values"""
+        pool = self.generation_pool
+        METRICS.set('bdb_generation_slots_in_use', pool.active)
+        METRICS.set('bdb_generation_slots', pool.capacity)
+        METRICS.set('bdb_generation_queued', pool.queued)
+        if self.workbook_cache is not None:
+            for counter, value in self.workbook_cache.stats().items():
+                METRICS.set('bdb_workbook_cache', value, counter=counter)
+    
+    def pool_figures(self):
+        pool = self.generation_pool
+        return {'running': pool.active - pool.queued, 'queued': pool.queued,
+                'capacity': pool.capacity, 'workers': pool.workers}
+    
+    def process_request_thread(self, request, client_address):
+        with self._connections_lock:
+            self.active_connections += 1
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._connections_lock:
+                self.active_connections -= 1
+    
+    def count_request(self):
+        with self._connections_lock:
+            self.requests_handled += 1
+    
+    def drain(self, timeout=SHUTDOWN_GRACE_SECONDS):
+        """Wait up to timeout seconds for the connections in progress (downloads included) to finish.
+        
+        Returns how many were still open.
+        """
+        deadline = time.monotonic() + timeout
+        while self.active_connections and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.active_connections
+    
+    def server_close(self):
+        super().server_close()
+        self.job_runner.shutdown()
+        self.generation_pool.shutdown()
+
+
+# === PREFORK ===
+# With SERVER_PROCESSES above 1, run_server starts a Supervisor instead of serving. It
+# binds the port once and starts that many serving processes, which inherit the socket
+# and accept on it in turn. A serving process stops accepting on SIGTERM (or when it
+# reaches MAX_REQUESTS_PER_PROCESS or MAX_PROCESS_RSS), lets its open connections finish
+# and exits; the supervisor then starts a replacement. SIGHUP starts a fresh set, which
+# imports server.py again, and stops the old set the same way once the new one is up.
+#
+# The socket stays open in the supervisor throughout, so connections arriving while
+# processes come and go wait in its backlog rather than being refused or reset (as they
+# would be with a listener per process through SO_REUSEPORT).
+#
+# State the processes must agree on lives in a SharedState manager process started by the
+# supervisor: the rate-limit buckets and shed counts, the configs behind what-if model ids,
+# and a board each process publishes its metrics and pool figures to every second. It
+# survives reloads, so rate limits and what-if ids carry over to the new set. Workbook
+# caches and the job store stay per process unless WORKBOOK_CACHE_DIR and JOB_STORE_DIR
+# point them at shared directories.
+
+# Exit code of a serving process that stopped on reaching its request or memory limit
+RECYCLE_EXIT_CODE = 75
+# A serving process that exits sooner than this after starting is restarted after a pause
+CRASH_BACKOFF_SECONDS = 1
+# How long a reload waits for the new serving processes to start serving
+PROCESS_START_TIMEOUT = 60
+# Seconds between a serving process's publications to the ProcessBoard
+PUBLISH_INTERVAL = 1
+
+
+class ProcessBoard:
+    """What each prefork serving process last published: its metrics snapshot and pool figures"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # slot -> (Metrics.snapshot(), BusinessDataServer.pool_figures())
+    
+    def publish(self, slot, snapshot, figures):
+        with self._lock:
+            self._entries[slot] = (snapshot, figures)
+    
+    def entries(self):
+        with self._lock:
+            return dict(self._entries)
+
+
+class SharedState(BaseManager):
+    """The supervisor's server for the state every prefork process uses, reached through proxies"""
+
+
+SharedState.register('AdmissionControl', AdmissionControl)
+SharedState.register('WhatIfConfigs', WhatIfConfigs)
+SharedState.register('ProcessBoard', ProcessBoard)
+
+
+def _ignore_interrupt():
+    # Ctrl+C reaches the whole process group; the shared state must outlive the draining processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _resident_bytes():
+    """This process's resident memory (its peak where /proc is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def serve_process(listen_socket, workers, queue_depth, ready=None, max_requests=MAX_REQUESTS_PER_PROCESS,
+                  max_rss=MAX_PROCESS_RSS, slot=0, shared=None):
+    """One prefork serving process: serve until SIGTERM or a recycle limit, then drain and exit.
+    
+    shared holds the supervisor's proxies (admission, what_if_configs, board); slot names
+    this process on the board.
+    """
+    httpd = BusinessDataServer(None, BusinessDataHandler, workers, queue_depth, listen_socket)
+    if shared is not None:
+        httpd.admission = shared.admission
+        httpd.what_if_models = WhatIfModels(shared_configs=shared.what_if_configs)
+        httpd.process_board = shared.board
+        httpd.process_slot = slot
+    record_startup('listening')
+    stopping = threading.Event()
+    recycled = []
+    # Ctrl+C reaches the whole process group; the supervisor turns it into a SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    
+    def publish():
+        httpd.sample_gauges()
+        try:
+            shared.board.publish(slot, METRICS.snapshot(), httpd.pool_figures())
+        except (OSError, EOFError) as e:
+            print(f"⚠️  Server process {os.getpid()} could not publish its metrics: {e}")
+    
+    def watch():
+        # shutdown() waits for serve_forever to return, so it cannot run in the signal handler
+        while not stopping.wait(PUBLISH_INTERVAL):
+            if shared is not None:
+                publish()
+            if max_requests and httpd.requests_handled >= max_requests:
+                recycled.append(f'{httpd.requests_handled} requests')
+                break
+            if max_rss and _resident_bytes() > max_rss:
+                recycled.append(f'{_resident_bytes() // 2 ** 20} MB resident')
+                break
+        httpd.shutdown()
+    
+    threading.Thread(target=watch, daemon=True).start()
+    threading.Thread(target=httpd.warm_up, daemon=True).start()
+    if ready is not None:
+        ready.set()
+    try:
+        httpd.serve_forever()
+    finally:
+        # Stop accepting first (the supervisor's socket stays open) so new connections go to the other processes
+        httpd.socket.close()
+        left = httpd.drain()
+        if left:
+            print(f"⚠️  Server process {os.getpid()} stopped with {left} connection(s) still open")
+        httpd.server_close()
+    if recycled:
+        print(f"♻️  Server process {os.getpid()} recycled after {recycled[0]}")
+        sys.exit(RECYCLE_EXIT_CODE)
+
+
+class Supervisor:
+    """Starts the prefork serving processes, replaces the ones that exit and handles SIGHUP/SIGTERM"""
+    
+    def __init__(self, port, processes, workers, queue_depth):
+        self.socket = socket.create_server(('', port), backlog=128)
+        self.processes = processes
+        self.workers = workers
+        self.queue_depth = queue_depth
+        # spawn like the generation pool, and so a reload imports server.py afresh
+        self._context = multiprocessing.get_context('spawn')
+        self._manager = None
+        self.shared = None
+        self._children = {}  # slot -> (process, started, ready event)
+        self._restart_at = {}  # slot -> when a crashed slot is started again
+        self._retiring = []  # processes of the previous set, draining after a reload
+        self._reload_requested = False
+        self._stop_requested = False
+    
+    def _start(self, slot):
+        ready = self._context.Event()
+        process = self._context.Process(target=serve_process, name=f'bdb-server-{slot}',
+                                        args=(self.socket, self.workers, self.queue_depth, ready),
+                                        kwargs={'slot': slot, 'shared': self.shared})
+        process.start()
+        # The event is kept with its process: the child cannot open it once it is garbage collected
+        self._children[slot] = (process, time.monotonic(), ready)
+        return ready
+    
+    def _on_stop(self, signum, frame):
+        self._stop_requested = True
+    
+    def _on_reload(self, signum, frame):
+        self._reload_requested = True
+    
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._on_reload)
+        self._manager = SharedState(ctx=self._context)
+        self._manager.start(_ignore_interrupt)
+        self.shared = types.SimpleNamespace(admission=self._manager.AdmissionControl(),
+                                            what_if_configs=self._manager.WhatIfConfigs(),
+                                            board=self._manager.ProcessBoard())
+        for slot in range(self.processes):
+            self._start(slot)
+        try:
+            while not self._stop_requested:
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self.reload()
+                self._check_children()
+                time.sleep(0.2)
+        finally:
+            self.stop()
+    
+    def _check_children(self):
+        now = time.monotonic()
+        for slot, (process, started, _) in list(self._children.items()):
+            if process.is_alive():
+                continue
+            if slot in self._restart_at:
+                if now >= self._restart_at.pop(slot):
+                    self._start(slot)
+                continue
+            if process.exitcode == RECYCLE_EXIT_CODE:
+                self._start(slot)
+                continue
+            print(f"⚠️  Server process {process.pid} exited with code {process.exitcode}, restarting it")
+            if now - started < CRASH_BACKOFF_SECONDS:
+                # Failing at startup (a bad deploy, the port taken): do not spin
+                self._restart_at[slot] = now + CRASH_BACKOFF_SECONDS
+            else:
+                self._start(slot)
+        self._retiring = [process for process in self._retiring if process.is_alive()]
+    
+    def reload(self):
+        """Start a fresh set of serving processes, then stop the old set once the new one listens"""
+        old = [process for process, _, _ in self._children.values()]
+        self._restart_at.clear()
+        ready = [self._start(slot) for slot in range(self.processes)]
+        deadline = time.monotonic() + PROCESS_START_TIMEOUT
+        for event in ready:
+            event.wait(max(deadline - time.monotonic(), 0))
+        for process in old:
+            if process.is_alive():
+                process.terminate()
+        self._retiring.extend(old)
+        print(f'🔄 Reloaded: {self.processes} new server processes, {len(old)} old ones draining')
+    
+    def stop(self):
+        """SIGTERM every serving process and wait for them to drain, killing those past the grace period"""
+        processes = [process for process, _, _ in self._children.values()] + self._retiring
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS + 5
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        if self._manager is not None:
+            self._manager.shutdown()
+        self.socket.close()
+
 
-def run_server(port=8000):
+def run_server(port=8000, workers=GENERATION_WORKERS, queue_depth=GENERATION_QUEUE_DEPTH,
+               processes=SERVER_PROCESSES):
+    if processes > 1:
+        # The serving processes are the parallelism: unless GENERATION_WORKERS is set,
+        # each builds in its request threads rather than starting a pool per process
+        if 'GENERATION_WORKERS' not in os.environ:
+            workers = 0
+        print(f'🚀 Business Data Builder Server')
+        print(f'📊 Server running on port {port} with {processes} processes')
+        print(f'⚙️  Generation workers per process: {workers or "inline"}, queue depth: {queue_depth}')
+        print('🔗 Rate limits, what-if models and /metrics are shared by the processes')
+        if not JOB_STORE_DIR:
+            print('⚠️  JOB_STORE_DIR is not set: a job is only known to the process that queued it')
+        if WORKBOOK_CACHE_BYTES > 0 and not WORKBOOK_CACHE_DIR:
+            print('⚠️  WORKBOOK_CACHE_DIR is not set: each process caches the workbooks it built itself')
+        if PROFILE_DIR:
+            print('⚠️  PROFILE_DIR is set: each process may run a profiled build at the same time')
+        print('SIGHUP reloads the server processes, Ctrl+C or SIGTERM stops them')
+        print('-' * 50)
+        Supervisor(port, processes, workers, queue_depth).run()
+        return
     server_address = ('', port)
-    httpd = HTTPServer(server_address, BusinessDataHandler)
+    httpd = BusinessDataServer(server_address, BusinessDataHandler, workers, queue_depth)
+    record_startup('listening')
+    # openpyxl and the workers load while the first requests (health checks, the page) are served
+    threading.Thread(target=httpd.warm_up, daemon=True).start()
     print(f'🚀 Business Data Builder Server')
     print(f'📊 Server running on port {port}')
+    print(f'⚙️  Generation workers: {workers or "inline"}, queue depth: {queue_depth}')
     print(f'🌐 Access at: http://localhost:{port}')
     print(f'📁 Serving files from: {os.getcwd()}')
     print(f'✅ index.html exists: {os.path.exists("index.html")}')
@@ -704,7 +4603,10 @@ def run_server(port=8000):
     print('')
     print('Press Ctrl+C to stop the server')
     print('-' * 50)
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
 
 if __name__ == '__main__':
     import os
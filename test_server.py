@@ -0,0 +1,133 @@
+"""Checks that the numbers the server computes itself match the formulas it writes.
+
+The streaming engine's cached values, the what-if deltas and the config validation are
+tested for the product and SaaS models, on monthly and weekly timelines.
+"""
+
+import io
+
+import pytest
+
+import server
+
+
+TIMELINES = [('monthly', 24), ('weekly', 30)]
+SALES_MODELS = ['product', 'saas']
+
+
+def make_config(sales_model, granularity, periods, **item_changes):
+    """A small config that builds every tab; item_changes override fields of the second sales item"""
+    items = []
+    for idx in range(3):
+        item = {'monthlyGrowth': str(2 + idx * 1.5)}
+        if sales_model == 'saas':
+            item.update(planName=f'Plan {idx}', monthlyPrice=str(20 + idx), startingSubscribers=str(50 + idx * 10),
+                        costPerSubscriber='2', churnRate=str(3 + idx * 2), growthRate='6')
+        else:
+            item.update(productName=f'Product {idx}', unitPrice=str(10 + idx), startingUnits=str(100 + idx * 25),
+                        costPerUnit='4')
+        items.append(item)
+    items[1].update(item_changes)
+    teams = ['Engineering Team', 'Sales Team']
+    return {
+        'granularity': granularity,
+        'forecastPeriods': periods,
+        'selectedTeams': teams,
+        'employeeCounts': {team: 3 for team in teams},
+        'extraCategory': {'name': 'Region', 'options': ['North', 'South']},
+        'nonStaffItems': {'🏢 Facilities & Premises|Rent': True, '💻 Technology & IT|Software subscriptions': True},
+        'nonStaffQuantities': {'💻 Technology & IT|Software subscriptions': 2},
+        'salesModel': sales_model,
+        'salesItems': items,
+    }
+
+
+def sales_cells(model):
+    """{cell: value} of every period cell a WhatIfModel holds for the Sales tab"""
+    layout = model.layout
+    rows = [(model.revenue, layout.revenue_start_row), (model.volume, layout.volume_start_row),
+            (model.cogs, layout.cogs_start_row)]
+    rows = [(values, first_row + idx) for matrix, first_row in rows for idx, values in enumerate(matrix)]
+    rows += zip(model.sales_totals,
+                [layout.total_vol_row, layout.total_rev_row, layout.total_cogs_row, layout.gross_profit_row])
+    return {f'{letter}{row_num}': float(value)
+            for values, row_num in rows for letter, value in zip(model.sales_letters, values)}
+
+
+@pytest.mark.parametrize('granularity,periods', TIMELINES)
+@pytest.mark.parametrize('sales_model', SALES_MODELS)
+def test_cached_values_match_recalculation(tmp_path, sales_model, granularity, periods):
+    pytest.importorskip('numpy')
+    openpyxl = pytest.importorskip('openpyxl')
+    pycel = pytest.importorskip('pycel')
+    config = make_config(sales_model, granularity, periods)
+    plain_path = tmp_path / 'plain.xlsx'
+    plain_path.write_bytes(server.render_workbook(config, server.OutputOptions('openpyxl', 'plain', 'none')))
+    cached = server.render_workbook(config, server.OutputOptions('streaming', 'plain', 'cached'))
+
+    recalculated = pycel.ExcelCompiler(filename=str(plain_path))
+    formulas = openpyxl.load_workbook(plain_path)
+    values = openpyxl.load_workbook(io.BytesIO(cached), data_only=True)
+    checked = 0
+    for sheet in formulas.worksheets:
+        for row in sheet.iter_rows():
+            for cell in row:
+                if isinstance(cell.value, str) and cell.value.startswith('='):
+                    expected = recalculated.evaluate(f"'{sheet.title}'!{cell.coordinate}")
+                    assert values[sheet.title][cell.coordinate].value == pytest.approx(expected, rel=1e-9), \
+                        f'{sheet.title}!{cell.coordinate} {cell.value}'
+                    checked += 1
+    assert checked > 0
+
+
+@pytest.mark.parametrize('granularity,periods', TIMELINES)
+@pytest.mark.parametrize('sales_model', SALES_MODELS)
+def test_what_if_matches_rebuilt_model(sales_model, granularity, periods):
+    pytest.importorskip('numpy')
+    model = server.WhatIfModel(make_config(sales_model, granularity, periods))
+    price_field, volume_field, cost_field = (('monthlyPrice', 'startingSubscribers', 'costPerSubscriber')
+                                             if sales_model == 'saas' else ('unitPrice', 'startingUnits', 'costPerUnit'))
+    rebuilt = server.WhatIfModel(make_config(sales_model, granularity, periods, monthlyGrowth='3.1',
+                                             **{price_field: '77.5', volume_field: '555', cost_field: '3.25'}))
+    layout = model.layout
+    changes = [
+        {'sheet': 'Sales', 'cell': f'C{layout.revenue_start_row + 1}', 'value': 77.5},
+        {'sheet': 'Sales', 'cell': f'C{layout.volume_start_row + 1}', 'value': 555},
+        {'sheet': 'Sales', 'cell': f'D{layout.volume_start_row + 1}', 'value': 3.1 / 100},
+        {'sheet': 'Sales', 'cell': f'C{layout.cogs_start_row + 1}', 'value': 3.25},
+    ]
+    if model.first_is_value:
+        # The first period's volume is its own input cell, written as the starting volume
+        changes.append({'sheet': 'Sales', 'cell': f'E{layout.volume_start_row + 1}', 'value': 555})
+
+    changed = model.apply(changes)
+    assert set(changed) == {'Sales'}
+    before = sales_cells(model)
+    assert set(changed['Sales']) <= set(before)
+    assert {**before, **changed['Sales']} == pytest.approx(sales_cells(rebuilt), rel=1e-12)
+
+
+@pytest.mark.parametrize('config,message', [
+    ({'extraCategory': {'name': 'Region', 'options': [1]}}, 'extraCategory.options must be an array of strings'),
+    ({'extraCategory': {'name': 'Region', 'options': 'abc'}}, 'extraCategory.options must be an array of strings'),
+    ({'extraCategory': {'name': 5, 'options': ['North']}}, 'extraCategory.name must be a string'),
+    ({'extraCategory': ['Region']}, 'extraCategory must be a JSON object'),
+    ({'salesModel': 'barter'}, 'salesModel must be one of'),
+    ({'salesModel': None}, 'salesModel is required'),
+    ({'selectedTeams': [7]}, 'selectedTeams must hold team names'),
+    ({'nonStaffItems': {'Rent': True}}, 'nonStaffItems keys must look like "Category|Item"'),
+])
+def test_malformed_config_is_rejected(config, message):
+    with pytest.raises(server.ConfigError, match=message.replace('|', r'\|')):
+        server.compile_config({**make_config('product', 'monthly', 12), **config})
+
+
+@pytest.mark.parametrize('config', [[], 'config', None])
+def test_config_must_be_an_object(config):
+    with pytest.raises(server.ConfigError):
+        server.compile_config(config)
+
+
+def test_unit_price_must_be_a_number():
+    with pytest.raises(server.ConfigError, match='unitPrice'):
+        server.compile_config(make_config('product', 'monthly', 12, unitPrice='x'))